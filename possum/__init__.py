@@ -14,6 +14,13 @@ if os.environ.get('TRAVIS') != 'true' and \
    os.environ.get('CI') != 'true':
     import pos_itk_core
     import pos_itk_transforms
+    import pos_slice_store
+    import pos_landmarks
+    import pos_reslice
+    import pos_virtual_stack
+    import pos_histogram_matching
+    import pos_source_ingestion
+    import pos_median_filter
 
 import pos_parameters
 import pos_wrapper_skel
@@ -23,3 +30,4 @@ import pos_deformable_wrappers
 
 import deformable_histology_iterations
 import pos_input_data_preprocessor
+import pos_manifest_store
@@ -3,6 +3,8 @@
 
 import os
 import sys
+import csv
+import numpy as np
 import itk
 
 from optparse import OptionGroup
@@ -11,6 +13,9 @@ from possum.pos_wrapper_skel import enclosed_workflow
 from possum.pos_common import r
 from possum import pos_itk_transforms
 from possum import pos_itk_core
+from possum import pos_reslice
+from possum.pos_itk_transforms import get_image_geometry, \
+    indexes_to_physical_points, physical_points_to_indexes
 
 
 # Forward direction of processing. This means the images are transformed
@@ -36,6 +41,21 @@ C_NN_INTERPOLATOR = 0
 C_LINEAR_INTERPOLATOR = 1
 C_BSPLINE_INTERPOLATOR = 2
 
+# The routine processing the sections and the sections to process. The state
+# is set before the worker processes are forked (see
+# `bidirectional_coregistration_mapper._map_sections`), so the workers share
+# the sections with the parent process instead of receiving their copies.
+_sections_state = {}
+
+
+def _map_section_job(index):
+    """
+    Process a single section described by the `_sections_state`. The
+    function is executed by the worker processes.
+    """
+    state = _sections_state
+    return state['function'](state['sections'][index])
+
 
 class bidirectional_coregistration_mapper(enclosed_workflow):
     """
@@ -101,6 +121,15 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         --offset 1 \
         --interpolation 1
 
+    The sections are independent of each other, so on a multicore machine
+    add e.g. `--workers 8` to reslice the sections using eight processes.
+
+    Individual points (e.g. cell detections or landmarks) can be mapped
+    instead of whole images. Replace the `-i` and `-o` arguments with
+    `--input-points points_raw.csv --output-points points_atlas.csv`; the
+    `-r` image (the raw stack) is then used only to determine the geometry
+    of the stack.
+
     """
 
     _slicing_planes_settings = {
@@ -117,6 +146,13 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         C_LINEAR_INTERPOLATOR: itk.LinearInterpolateImageFunction,
         C_BSPLINE_INTERPOLATOR: itk.BSplineInterpolateImageFunction}
 
+    # Spline orders corresponding to the interpolation types. Used by the
+    # vector workflow.
+    _interpolation_orders = {
+        C_NN_INTERPOLATOR: 0,
+        C_LINEAR_INTERPOLATOR: 1,
+        C_BSPLINE_INTERPOLATOR: 3}
+
     def _validate_options(self):
         super(self.__class__, self)._validate_options()
 
@@ -125,13 +161,20 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         # after this validation step and cannot be validated
         # here. They will be checked individually later.
 
-        assert self.options.input_image, \
-            self._logger.error(r("Moving image is required, Please provide \
-            the `--input-image` parameter."))
+        # When mapping points, the reference image only provides the
+        # geometry of the stack and no other images are needed.
+        if self.options.input_points:
+            assert self.options.output_points, \
+                self._logger.error(r("Output points file is required. Please \
+                provide the `--output-points` parameter."))
+        else:
+            assert self.options.input_image, \
+                self._logger.error(r("Moving image is required, Please \
+                provide the `--input-image` parameter."))
 
-        assert self.options.output_image, \
-            self._logger.error(r("Output image is required, Please provide \
-            the `--output-image` parameter."))
+            assert self.options.output_image, \
+                self._logger.error(r("Output image is required, Please \
+                provide the `--output-image` parameter."))
 
         assert self.options.reference_image, \
             self._logger.error(r("Reference image is required. Please provide \
@@ -272,8 +315,13 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         # for the direction of the computations
         self.direction = self.options.direction
 
+        # Mapping points does not involve any images processing at all.
+        if self.options.input_points:
+            self.use_points_workflow()
+            super(self.__class__, self)._post_launch()
+            return
+
         self._load_images()
-        self._load_coregistration_transformation()
 
         # Define the single component processing type All single component data
         # type will be converted to this tupe for the purpose of processing.
@@ -289,12 +337,23 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         self._numbers_of_components = \
             self._moving_image.GetNumberOfComponentsPerPixel()
 
+        # The sections to process are determined (and their transformations
+        # are verified) once, before the processing starts.
+        self._sections_range = self._get_sections_range()
+
         # There are different workflows depending on the number of components,
-        # of the provided input image.
-        if self._numbers_of_components > 1:
+        # of the provided input image. The vector workflow reads the
+        # transformations on its own.
+        if self._numbers_of_components > 1 and \
+                self.options.vector_resampling:
+            processed_image = \
+                self.use_vector_workflow()
+        elif self._numbers_of_components > 1:
+            self._load_coregistration_transformation()
             processed_image = \
                 self.use_multicomponent_workflow()
         else:
+            self._load_coregistration_transformation()
             processed_image = \
                 self.use_single_component_workflow()
 
@@ -353,7 +412,9 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         This method executes a multichannel workflow. This part of the mapping
         workflow is a bit more complicated. In this workflow, the multichannel
         / multicomponent image is siplit into individual components and each of
-        the components is processed separately. At the end of the processing,
+        the components is processed separately (the components are processed
+        concurrently, see :func:`pos_itk_core.process_multichannel_image`).
+        At the end of the processing,
         all individual channels are merged back into a multicomponent image and
         returned.
         """
@@ -381,29 +442,13 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         component_type = \
             pos_itk_core.io_component_string_name_to_image_type[image_type_tuple]
 
-        # We will collect the consecutive processed components
-        # into this array
-        processed_components = []
-
-        # Extract the component `i` from the composite image,
-        # and process each component independently.
-        for i in range(self._numbers_of_components):
-
-            self._logger.debug("Starting processing channel %d of %d.",
-                i + 1, self._numbers_of_components)
-
-            extract_filter = \
-                itk.VectorIndexSelectionCastImageFilter[
-                self._moving_type, component_type].New()
-            extract_filter.SetIndex(i)
-            extract_filter.SetInput(self._moving_image)
-
+        def process_component(component):
             # Cast the image to an intermediate data type fo the
             # purposes of processing.
             cast_filter = \
                 itk.CastImageFilter[
                     (component_type, self._processing_type)].New()
-            cast_filter.SetInput(extract_filter)
+            cast_filter.SetInput(component)
             cast_filter.Update()
 
             # Process the component.
@@ -418,28 +463,336 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
             writer_cast_filter.SetInput(processed_component)
             writer_cast_filter.Update()
 
-            # Store the processed component in an array.
-            processed_components.append(writer_cast_filter.GetOutput())
+            return writer_cast_filter.GetOutput()
+
+        # Extract the individual components from the composite image and
+        # process them concurrently. The processed components are then
+        # composed back into a multicomponent image. In theory arbitrary
+        # number of components is supported but it has to be more than one :)
+        self._logger.info(r("Processing %d channels and composing them back \
+            into multichannel image."), self._numbers_of_components)
+        processed_image = pos_itk_core.process_multichannel_image(
+            self._moving_image, process_component,
+            component_type=component_type, output_type=self._moving_type)
+
+        return processed_image
+
+    def use_vector_workflow(self):
+        """
+        Maps all the components of a multicomponent image at once. Instead of
+        processing each component separately, the transformations are read
+        and the coordinates of the resampling grids are computed only once
+        (for the coregistration and for every section) and then all the
+        components are sampled at these coordinates. Therefore mapping an
+        RGB stack costs about as much as mapping a grayscale one.
+
+        The sampling is done with spline interpolation of the order matching
+        the `--interpolation` option. Otherwise the workflow is equivalent to
+        :meth:`use_multicomponent_workflow`.
+
+        :return: The processed image of the same type as the input image.
+        :rtype: `itk.Image`
+        """
+
+        self._logger.debug("Entering vector workflow.")
+
+        array = itk.GetArrayFromImage(self._moving_image)
+        component_type = array.dtype
+        geometry = get_image_geometry(self._moving_image)
+        order = self._interpolation_orders[self.options.interpolation]
+
+        if self.direction == C_DIR_INV:
+            array, geometry = self._resample_volume(array, geometry, order)
+
+        array = self._reslice_section_arrays(array, geometry, order)
+
+        if self.direction == C_DIR_FWD:
+            array, geometry = self._resample_volume(array, geometry, order)
+
+        # Cast the data back to the initial data type. Integer types are
+        # clipped first, as the spline interpolation may overshoot.
+        if np.issubdtype(component_type, np.integer):
+            limits = np.iinfo(component_type)
+            array = np.clip(array, limits.min, limits.max)
+        array = np.ascontiguousarray(array.astype(component_type))
+
+        processed_image = itk.PyBuffer[self._moving_type].GetImageFromArray(
+            array, is_vector=True)
+        processed_image.SetOrigin(map(float, geometry[0]))
+        processed_image.SetSpacing(map(float, geometry[1]))
+        processed_image.SetDirection(itk.GetMatrixFromArray(geometry[2]))
+
+        self._logger.debug("Exiting vector workflow.")
+
+        return processed_image
+
+    def _resample_volume(self, array, geometry, order):
+        """
+        Resamples the multicomponent volume into the space of the fixed image
+        using the coregistration transformation. The transformed coordinates
+        are computed plane by plane (to limit the memory required by the
+        intermediate arrays) and all the components are sampled at once. The
+        spline interpolation of a higher order requires the coordinates of
+        the whole volume to be computed before sampling.
+
+        :param array: Volume shaped (z, y, x, components).
+        :type array: `numpy.ndarray`
+
+        :param geometry: Origin, spacing and direction of the volume.
+        :type geometry: tuple
+
+        :param order: Spline interpolation order.
+        :type order: int
+
+        :return: The resampled volume and its geometry (the fixed image's
+            geometry).
+        :rtype: (`numpy.ndarray`, tuple)
+        """
+
+        transformations = self._load_point_transformations(
+            self._get_coregistration_transformation_files(self.direction))
 
-            self._logger.debug("Finished processing channel %d of %d.",
-                i + 1, self._numbers_of_components)
+        fixed_geometry = get_image_geometry(self._fixed_image)
+        shape = tuple(map(int,
+            self._fixed_image.GetLargestPossibleRegion().GetSize()))[::-1]
 
-        # After iterating over all channels, compose the individual
-        # components back into multichannel image.
-        self._logger.info(r("Composing processed channels back \
-            into multichannel image."))
+        plane_indexes = np.indices(shape[1:]).reshape(2, -1)[::-1].T
 
-        # Compose individual components back into multicomponent image.  In
-        # theory arbitrary number of components is supported but it has to be
-        # more than one :)
-        compose = \
-            itk.ComposeImageFilter[component_type, self._moving_type].New()
+        def plane_to_indexes(z):
+            points = indexes_to_physical_points(
+                np.column_stack([plane_indexes,
+                                 np.full(len(plane_indexes), z)]),
+                *fixed_geometry)
+            return physical_points_to_indexes(
+                pos_reslice.transform_points(points, transformations),
+                *geometry)
 
-        for i in range(self._numbers_of_components):
-            compose.SetInput(i, processed_components[i])
-        compose.Update()
+        if order > 1:
+            indexes = np.concatenate(map(plane_to_indexes, range(shape[0])))
+            return self._resample_components(
+                array, indexes, shape, order), fixed_geometry
 
-        return compose.GetOutput()
+        output = np.empty(shape + (array.shape[-1],))
+        for z in range(shape[0]):
+            output[z] = self._resample_components(
+                array, plane_to_indexes(z), shape[1:], order)
+
+        return output, fixed_geometry
+
+    def _reslice_section_arrays(self, array, geometry, order):
+        """
+        Reslices all the sections of the multicomponent volume with their
+        transformations. All the sections share the same grid, so the
+        physical coordinates of the grid are computed only once.
+
+        :param array: Volume shaped (z, y, x, components).
+        :type array: `numpy.ndarray`
+
+        :param geometry: Origin, spacing and direction of the volume.
+        :type geometry: tuple
+
+        :param order: Spline interpolation order.
+        :type order: int
+
+        :return: The volume with all the sections resliced.
+        :rtype: `numpy.ndarray`
+
+        The transformations are chained in the same order as in the ITK
+        based workflow (see :meth:`_get_raw_to_deformable_transformation`
+        and :meth:`_get_deformable_to_raw_transformation`): the last
+        transformation is applied first. A scaling and a translation do not
+        commute, so they reveal the order. The section holds the `x` index
+        of the voxels:
+
+        >>> from optparse import Values
+        >>> pos_itk_transforms.write_transformation_txt_file(
+        ...     '/tmp/pos_mapper_test_0000.txt', [.5, 0, 0, .5, 0, 0], [0, 0])
+        >>> for name, shift in [('fwd', 2), ('inv', 1)]:
+        ...     itk.imwrite(itk.GetImageFromArray(np.tile(np.array(
+        ...         [shift, 0], dtype=np.float32), (8, 8, 1)), is_vector=True),
+        ...         '/tmp/pos_mapper_test_%s_0000.nii.gz' % name)
+        >>> mapper = object.__new__(bidirectional_coregistration_mapper)
+        >>> mapper.options = Values({'slicing_axis': 2, 'offset': 0,
+        ...     'workers': 1,
+        ...     'section_affine_template': '/tmp/pos_mapper_test_%04d.txt',
+        ...     'section_deformable_fwd_template':
+        ...         '/tmp/pos_mapper_test_fwd_%04d.nii.gz',
+        ...     'section_deformable_inv_template':
+        ...         '/tmp/pos_mapper_test_inv_%04d.nii.gz'})
+        >>> mapper._sections_range = [0]
+        >>> stack = np.tile(np.arange(8.), (1, 8, 1))[..., np.newaxis]
+        >>> geometry = (np.zeros(3), np.ones(3), np.eye(3))
+
+        In the forward direction, the displacement is applied first and then
+        the affine transformation: x -> 0.5 * (x + 2).
+
+        >>> mapper.direction = C_DIR_FWD
+        >>> mapper._reslice_section_arrays(stack, geometry, 1)[0, 3, :, 0]
+        array([1. , 1.5, 2. , 2.5, 3. , 3.5, 4. , 4.5])
+
+        In the inverse direction, the inverted affine transformation is
+        applied first and then the displacement: x -> 2 * x + 1.
+
+        >>> mapper.direction = C_DIR_INV
+        >>> mapper._reslice_section_arrays(stack, geometry, 1)[0, 3, :4, 0]
+        array([1., 3., 5., 7.])
+
+        >>> for name in ['0000.txt', 'fwd_0000.nii.gz', 'inv_0000.nii.gz']:
+        ...     os.remove('/tmp/pos_mapper_test_' + name)
+        """
+
+        # Index of the slicing axis in the (z, y, x) array and the axes
+        # spanning the sections. The sections are extracted with their
+        # direction collapsed to identity (see `_extract_section`).
+        axis = 2 - self.options.slicing_axis
+        in_plane = [i for i in range(3) if i != self.options.slicing_axis]
+        section_geometry = \
+            (geometry[0][in_plane], geometry[1][in_plane], np.eye(2))
+
+        shape = tuple(np.delete(array.shape[:3], axis))
+        points = indexes_to_physical_points(
+            np.indices(shape).reshape(2, -1)[::-1].T, *section_geometry)
+
+        def reslice(section_index):
+            transformations = self._load_point_transformations(
+                self._get_section_transformation_files(
+                    section_index, self.direction))
+            indexes = physical_points_to_indexes(
+                pos_reslice.transform_points(points, transformations),
+                *section_geometry)
+
+            plane_index = section_index - self.options.offset
+            return self._resample_components(
+                np.take(array, plane_index, axis=axis), indexes, shape, order)
+
+        # The resliced sections are stacked back along the slicing axis.
+        return np.stack(
+            self._map_sections(reslice, self._sections_range), axis=axis)
+
+    @staticmethod
+    def _resample_components(array, indexes, shape, order):
+        """
+        Samples all the components of the array at the provided continuous
+        indexes (see :func:`pos_reslice.resample_channels`).
+
+        :param array: Multicomponent array shaped (..., components).
+        :type array: `numpy.ndarray`
+
+        :param indexes: Continuous indexes, one point per row.
+        :type indexes: `numpy.ndarray`
+
+        :param shape: Shape of the output array (without the components).
+        :type shape: tuple
+
+        :param order: Spline interpolation order.
+        :type order: int
+
+        :return: Resampled array shaped `shape` + (components,).
+        :rtype: `numpy.ndarray`
+        """
+
+        return pos_reslice.resample_channels(array, indexes, order).reshape(
+            shape + (array.shape[-1],))
+
+    def use_points_workflow(self):
+        """
+        Maps the points listed in the `--input-points` file instead of an
+        image and saves them to the `--output-points` file. Only the header
+        of the `--reference-image` (the raw image stack) is read.
+        """
+
+        self._logger.debug("Entering points workflow.")
+
+        with open(self.options.input_points, 'rb') as points_file:
+            rows = filter(None, csv.reader(points_file))
+
+        # Only the coordinates are parsed, all the other columns are copied
+        # as they are. The first row is a header when its coordinates are
+        # not numbers.
+        header_row = None
+        if rows:
+            try:
+                map(float, rows[0][:3])
+            except ValueError:
+                header_row = rows.pop(0)
+
+        points = np.array([map(float, row[:3]) for row in rows],
+                          dtype=np.float64).reshape(-1, 3)
+        self._logger.info("Mapping %d points.", len(points))
+
+        header = pos_itk_core.read_image_header(self.options.reference_image)
+        geometry = (np.array(header['Origin']),
+                    np.array(header['Spacing']),
+                    np.array(header['Direction'], dtype=np.float64).T)
+        sections_number = header['Dimensions'][self.options.slicing_axis]
+
+        mapped_points = self.map_points(points, geometry, sections_number)
+
+        with open(self.options.output_points, 'wb') as points_file:
+            writer = csv.writer(points_file, lineterminator='\n')
+            if header_row is not None:
+                writer.writerow(header_row)
+            for point, row in zip(mapped_points, rows):
+                writer.writerow(map(lambda x: '%.12g' % x, point) + row[3:])
+
+        self._logger.debug("Exiting points workflow.")
+
+    def map_points(self, points, geometry, sections_number):
+        """
+        Maps the physical points in the `direction` of the mapping. The
+        points are pushed through the same transformations the images are
+        resliced with, but as the images are resampled (each voxel of the
+        output image pulls its value from the input image), the points are
+        mapped using the transformations of the opposite direction: the
+        raw image stack is resliced into the atlas space with the
+        transformations which map the atlas' points into the raw stack.
+
+        The transformations of each section are read only once and applied
+        to all the points of the section at once (see
+        :func:`pos_reslice.transform_section_points`).
+
+        :param points: Physical coordinates, one point per row.
+        :type points: `numpy.ndarray`
+
+        :param geometry: Origin, spacing and direction of the raw image
+            stack.
+        :type geometry: tuple
+
+        :param sections_number: Number of sections in the raw image stack.
+        :type sections_number: int
+
+        :return: The mapped points. Points located outside of the stack get
+            `nan` coordinates.
+        :rtype: `numpy.ndarray`
+        """
+
+        transformations_direction = {
+            C_DIR_FWD: C_DIR_INV,
+            C_DIR_INV: C_DIR_FWD}[self.direction]
+
+        coregistration = self._load_point_transformations(
+            self._get_coregistration_transformation_files(
+                transformations_direction))
+
+        def section_transformations(section_index):
+            self._inspect_input_images([section_index])
+            return self._load_point_transformations(
+                self._get_section_transformation_files(
+                    section_index, transformations_direction))
+
+        def map_sections(points):
+            return pos_reslice.transform_section_points(
+                points, geometry, self.options.slicing_axis,
+                section_transformations, sections_number,
+                self.options.offset)
+
+        # From the raw stack, the points are taken to the reconstruction
+        # and then to the atlas. The other way around, otherwise.
+        if self.direction == C_DIR_FWD:
+            return pos_reslice.transform_points(
+                map_sections(points), coregistration)
+        return map_sections(
+            pos_reslice.transform_points(points, coregistration))
 
     def process_single_component(self, single_component_image):
         """
@@ -483,30 +836,10 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         self._section_type = \
             pos_itk_core.types_reduced_dimensions[self._processing_type]
 
-        # This array will hold individual sections once they are processed.
-        collect_sections = []
-
-        # Here we determine the number of individual 2D sections to be
-        # processed. The number of sections is determined based on the provided
-        # slicing axis.
-        sections_number = \
-            input_image.GetLargestPossibleRegion().GetSize()[\
-            self.options.slicing_axis]
-        sections_range = \
-            range(self.options.offset,
-                  sections_number + self.options.offset)
-
-        self._logger.info("Determined number of sections: %d.",
-            sections_number)
-        self._logger.info("Indexes of sections to be processed: %s.",
-            " ".join(map(str, sections_range)))
-        self._inspect_input_images(sections_range)
-
-        # Nothing special going one, we process each section one
-        # by one.
-        for section_index in sections_range:
-            collect_sections.append(
-                self._process_single_section(input_image, section_index))
+        # The sections are extracted from the stack one by one and then
+        # resliced, possibly concurrently (see `--workers`).
+        collect_sections = \
+            self._process_sections(input_image, self._sections_range)
 
         # Once all sections are processed, we merge them back into
         # 3D image. Pretty cool, huh...
@@ -550,6 +883,122 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
                 interpolator=interpolator)
             return coregistered_to_atlas
 
+    def _get_sections_range(self):
+        """
+        Determines the indexes of the sections to process (as passed to the
+        filename templates) and verifies that all the sections'
+        transformations are available. The sections are cut from the fixed
+        image when mapping from the atlas (as the moving image is resliced
+        into the fixed image first) and from the moving image otherwise.
+
+        :rtype: list
+        """
+
+        stack = {
+            C_DIR_INV: self._fixed_image,
+            C_DIR_FWD: self._moving_image}[self.direction]
+        sections_number = \
+            stack.GetLargestPossibleRegion().GetSize()[\
+            self.options.slicing_axis]
+
+        sections_range = \
+            range(self.options.offset,
+                  sections_number + self.options.offset)
+
+        self._logger.info("Determined number of sections: %d.",
+            sections_number)
+        self._logger.info("Indexes of sections to be processed: %s.",
+            " ".join(map(str, sections_range)))
+        self._inspect_input_images(sections_range)
+
+        return sections_range
+
+    def _process_sections(self, input_image, sections_range):
+        """
+        Extract and reslice all the sections of the provided stack. The
+        sections are independent of each other, so when more than one worker
+        is requested, they are resliced concurrently by a pool of worker
+        processes (see :meth:`_map_sections`).
+
+        All the sections are extracted upfront, in the parent process, and
+        the workers return the resliced sections as arrays (see
+        :func:`pos_itk_core.image_to_buffer`) which are turned back into
+        images in the parent process.
+
+        :param input_image: The three-dimensional stack.
+        :type input_image: `itk.Image`
+
+        :param sections_range: Indexes of the sections to process (as passed
+            to the filename templates).
+        :type sections_range: list
+
+        :return: Resliced sections, in the order of the `sections_range`.
+        :rtype: list of `itk.Image`
+        """
+
+        if self._sections_workers(len(sections_range)) <= 1:
+            return [self._process_single_section(input_image, section_index)
+                    for section_index in sections_range]
+
+        sections = [(section_index,
+                     self._extract_section(input_image, section_index))
+                    for section_index in sections_range]
+
+        def reslice(section):
+            return pos_itk_core.image_to_buffer(self._reslice_section(*section))
+
+        return map(pos_itk_core.image_from_buffer,
+                   self._map_sections(reslice, sections))
+
+    def _sections_workers(self, sections_number):
+        """
+        :return: Number of the worker processes used to process the given
+            number of sections. No processes are started when the workflow
+            itself runs in a worker process (e.g. when processing a component
+            of a multichannel image, see
+            :func:`pos_itk_core.process_multichannel_image`).
+        :rtype: int
+        """
+
+        if not pos_itk_core.worker_processes_allowed():
+            return 1
+        return min(self.options.workers, sections_number)
+
+    def _map_sections(self, function, sections):
+        """
+        Applies the `function` to all the `sections` using `--workers`
+        processes. The processes are forked once the sections are prepared,
+        so the `function` and the `sections` are shared with the workers,
+        while the results of the `function` are sent back to the parent
+        process (so they have to be picklable).
+
+        The first section is always processed in the parent process. This
+        way the ITK modules required to process the sections are loaded
+        before the workers are forked instead of in each of the workers.
+
+        :return: Results of the function, in the order of the `sections`.
+        :rtype: list
+        """
+
+        workers = self._sections_workers(len(sections))
+        if workers <= 1:
+            return map(function, sections)
+
+        self._logger.info("Reslicing %d sections using %d processes.",
+                          len(sections), workers)
+        results = [function(sections[0])]
+
+        _sections_state.clear()
+        _sections_state.update({'function': function, 'sections': sections})
+
+        pool = pos_itk_core.process_pool(workers)
+        results += pool.map(_map_section_job, range(1, len(sections)))
+        pool.close()
+        pool.join()
+        _sections_state.clear()
+
+        return results
+
     def _build_interpolator(self, image_to_interpolate):
         """
         This function is a bit irritating as preparing a correct validator
@@ -609,6 +1058,19 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
 
         """
 
+        return self._reslice_section(section_index,
+            self._extract_section(section, section_index))
+
+    def _extract_section(self, section, section_index):
+        """
+        Extracts a single two dimensional image from the 3D stack. See
+        :meth:`_process_single_section` for the description of the
+        parameters.
+
+        :return: The extracted section.
+        :rtype: `itk.Image`
+        """
+
         # This is super irritating, but yes, we have to
         # convert the section index back to plane_index
         # to propoerly define an itk region.
@@ -623,12 +1085,30 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
         extract_single_section.SetDirectionCollapseToIdentity()
         extract_single_section.Update()
 
+        return extract_single_section.GetOutput()
+
+    def _reslice_section(self, section_index, section_image):
+        """
+        Applies the transformations of the given section to the already
+        extracted two dimensional image. As this method does not modify the
+        state of the workflow, it can be called by many worker processes.
+
+        :param section_index: Index of the section (as passed to the filename
+            templates).
+        :type section_index: int
+
+        :param section_image: The extracted section.
+        :type section_image: `itk.Image`
+
+        :return: Image resliced with appropriate transformations.
+        :rtype: `itk.Image`
+        """
+
         section_transform = self.section_transform(section_index)
 
-        interpolator = \
-            self._build_interpolator(extract_single_section.GetOutput())
+        interpolator = self._build_interpolator(section_image)
         transformed_image = pos_itk_transforms.reslice_image(
-            section_transform, extract_single_section.GetOutput(),
+            section_transform, section_image,
             interpolator=interpolator)
 
         return transformed_image
@@ -721,6 +1201,62 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
             [transforms[0], transforms[1]]
         return transforms
 
+    def _get_section_transformation_files(self, section_index, direction):
+        """
+        Lists the transformations of a single section, in the same order as
+        :meth:`_get_deformable_to_raw_transformation` (for the inverse
+        direction) and :meth:`_get_raw_to_deformable_transformation` (for the
+        forward direction) do.
+
+        :param section_index: Index of the section (as passed to the filename
+            templates).
+        :type section_index: int
+
+        :param direction: Direction of the mapping.
+        :type direction: str
+
+        :return: Pairs of (filename, whether to invert the transformation).
+        :rtype: [(str, bool), ...]
+        """
+
+        affine = self.options.section_affine_template % section_index
+        if direction == C_DIR_INV:
+            return [(self.options.section_deformable_inv_template %
+                     section_index, False), (affine, True)]
+        return [(affine, False), (self.options.section_deformable_fwd_template
+                                  % section_index, False)]
+
+    def _get_coregistration_transformation_files(self, direction):
+        """
+        Lists the coregistration transformations, in the same order as
+        :meth:`_get_atlas_to_reconstruction_coreg` (for the inverse
+        direction) and :meth:`_get_reconstruction_to_atlas_coreg` (for the
+        forward direction) do.
+
+        :param direction: Direction of the mapping.
+        :type direction: str
+
+        :return: Pairs of (filename, whether to invert the transformation).
+        :rtype: [(str, bool), ...]
+        """
+
+        affine = self.options.coregistration_affine
+        if direction == C_DIR_INV:
+            return [(affine, False),
+                    (self.options.coregistration_deformable_forward, False)]
+        return [(self.options.coregistration_deformable_inverse, False),
+                (affine, True)]
+
+    @staticmethod
+    def _load_point_transformations(transformation_files):
+        """
+        Loads the listed transformations as point transformations (see
+        :func:`pos_reslice.load_point_transformation`).
+        """
+
+        return [pos_reslice.load_point_transformation(filename, invert)
+                for filename, invert in transformation_files]
+
     def _get_atlas_to_reconstruction_coreg(self):
         """
         Reads a series of transformations which map the deformable
@@ -788,7 +1324,7 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
             [other options]"
 
         parser = \
-            enclosed._getCommandLineParser()
+            enclosed_workflow._getCommandLineParser()
         parser.set_description(r("""The main purpose of the %prog workflow is to \
             map any kind of spatial imaging data defined in the space of \
             the experimental image into the space of the reference image \
@@ -884,6 +1420,33 @@ class bidirectional_coregistration_mapper(enclosed_workflow):
             they are warps from deformably reconstructed sections into the \
             affine recosntruction spcae. The values should be like this: \
             'section_\%04d_Warp.nii.gz'."))
+        parser.add_option('--workers', dest='workers',
+            default=1, type='int', metavar="INT",
+            help=r('Number of processes reslicing the sections. The \
+            sections are independent of each other so they can be resliced \
+            concurrently. Default is 1 (the sections are processed one by \
+            one).'))
+        parser.add_option('--input-points', dest='input_points',
+            type='str', default=None, metavar="FILE",
+            help=r("Map the points listed in the provided file instead of \
+            an image. The file is a comma separated list of the points' \
+            physical coordinates (x, y, z), one point per line, \
+            optionally preceded by a header line. Any additional columns \
+            (e.g. identifiers or labels of the points) are copied to the \
+            output unchanged, as text. The points are mapped in the direction \
+            given by `--direction` and the `--reference-image` (only its \
+            header is read) defines the geometry of the raw image stack."))
+        parser.add_option('--output-points', dest='output_points',
+            type='str', default=None, metavar="FILE",
+            help=r("The mapped points are saved to this file in the same \
+            format as the `--input-points`. Points located outside of the \
+            image stack get `nan` coordinates."))
+        parser.add_option('--vector-resampling', dest='vector_resampling',
+            default=False, action='store_const', const=True,
+            help=r('Map all the components of a multicomponent (e.g. RGB) \
+            image at once: the transformations are read and the resampling \
+            coordinates are computed only once for all the components \
+            instead of processing each component separately.'))
 
         (options, args) = parser.parse_args()
         return (options, args)
@@ -1,5 +1,7 @@
 import logging
 import os
+import threading
+import collections
 
 
 IDENTITY_TRANSFORM_2D_STRING = """#Insight Transform File V1.0
@@ -161,6 +163,56 @@ def remove_multiple_spaces_from_string(string):
     """
     return " ".join(string.strip().split())
 
+
+class lru_cache(object):
+    """
+    A bounded cache with the least recently used entries evicted first. The
+    cache may be shared by a number of threads.
+
+    >>> cache = lru_cache(maxsize=2)
+    >>> cache.put('a', {'x': 1})
+    >>> cache.put('b', {'x': 2})
+    >>> cache.get('a')
+    {'x': 1}
+    >>> cache.put('c', {'x': 3})
+    >>> len(cache), cache.get('b'), cache.get('c')
+    (2, None, {'x': 3})
+    >>> cache.clear()
+    >>> len(cache)
+    0
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: Maximum number of the entries kept in the cache.
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 """
 Here we just create an alias we do not have to import the function using its
 full name which is long and therefore difficult to use in the codpe.
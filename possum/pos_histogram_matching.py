@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+import logging
+
+import numpy as np
+import itk
+
+import possum.pos_itk_transforms
+
+"""
+In-process, lookup table based histogram matching of 8-bit sections. The
+cumulative histograms of the reference sections are computed once and then
+reused for all the sections matched to given reference. Matching a section
+to a weighted pair of references reduces to building a single lookup table
+per channel and applying it to the section's voxels.
+"""
+
+# Number of intensity levels of an 8-bit image.
+LEVELS = 256
+
+
+def section_cdf(array):
+    """
+    Calculates the normalized cumulative histogram of each channel of the
+    provided 8-bit section.
+
+    :param array: Section as an array. Single channel sections are given
+        as (rows, columns) arrays, the multichannel ones as
+        (rows, columns, channels) arrays.
+    :type array: `numpy.ndarray`
+
+    :return: Cumulative histograms, one row per channel.
+    :rtype: `numpy.ndarray` of shape (channels, 256)
+
+    >>> cdf = section_cdf(np.array([[0, 0], [2, 255]], dtype=np.uint8))
+    >>> cdf.shape
+    (1, 256)
+    >>> cdf[0, :4]
+    array([0.5 , 0.5 , 0.75, 0.75])
+    >>> cdf[0, -1]
+    1.0
+    """
+
+    array = np.asarray(array, dtype=np.uint8)
+    channels = array.reshape(-1, array.shape[2]).T if array.ndim == 3 \
+        else array.reshape(1, -1)
+
+    counts = np.array([np.bincount(channel, minlength=LEVELS)
+                       for channel in channels], dtype=np.float64)
+    cdf = np.cumsum(counts, axis=1)
+
+    return cdf / cdf[:, -1:]
+
+
+def matching_lut(source_cdf, target_cdf):
+    """
+    Builds the lookup tables mapping the intensities of a section described
+    by the `source_cdf` onto the intensity distribution given by the
+    `target_cdf`. Each level is mapped to the lowest target level with the
+    same (or higher) cumulative frequency.
+
+    :param source_cdf: Cumulative histograms of the section to match.
+    :type source_cdf: `numpy.ndarray` of shape (channels, 256)
+
+    :param target_cdf: Cumulative histograms of the reference section.
+    :type target_cdf: `numpy.ndarray` of shape (channels, 256)
+
+    :return: Lookup tables, one row per channel.
+    :rtype: `numpy.ndarray` of shape (channels, 256)
+
+    >>> source = section_cdf(np.array([[10, 10], [20, 30]], dtype=np.uint8))
+    >>> target = section_cdf(np.array([[50, 50], [60, 90]], dtype=np.uint8))
+    >>> lut = matching_lut(source, target)
+    >>> map(int, lut[0, [10, 20, 30]])
+    [50, 60, 90]
+
+    Matching a section to itself does not change any of its intensities:
+
+    >>> np.all(matching_lut(source, source)[0, [10, 20, 30]] == [10, 20, 30])
+    True
+    """
+
+    # A tiny tolerance is used so the rounding errors do not push the
+    # matched level one step too high.
+    return np.array([np.searchsorted(target, source - 1e-12)
+                     for source, target in zip(source_cdf, target_cdf)],
+                    dtype=np.float64).clip(0, LEVELS - 1)
+
+
+def weighted_matching_lut(source_cdf, references):
+    """
+    Builds the lookup tables matching a section to a weighted set of
+    reference sections. The section is matched to each of the references
+    separately and the matched intensities are averaged using the provided
+    weights (this is the weighted histogram matching by Li et al., 2009).
+
+    :param source_cdf: Cumulative histograms of the section to match.
+    :type source_cdf: `numpy.ndarray` of shape (channels, 256)
+
+    :param references: Pairs of (weight, cumulative histograms) of the
+        reference sections.
+    :type references: list of (float, `numpy.ndarray`)
+
+    :return: 8-bit lookup tables, one row per channel.
+    :rtype: `numpy.ndarray` of shape (channels, 256)
+
+    >>> source = section_cdf(np.array([[10, 10], [20, 30]], dtype=np.uint8))
+    >>> first = section_cdf(np.array([[50, 50], [60, 90]], dtype=np.uint8))
+    >>> second = section_cdf(np.array([[0, 0], [10, 30]], dtype=np.uint8))
+    >>> lut = weighted_matching_lut(source, [(0.75, first), (0.25, second)])
+    >>> lut.dtype, map(int, lut[0, [10, 20, 30]])
+    (dtype('uint8'), [38, 48, 75])
+    """
+
+    lut = sum(weight * matching_lut(source_cdf, cdf)
+              for weight, cdf in references)
+    return np.round(lut).clip(0, LEVELS - 1).astype(np.uint8)
+
+
+def apply_lut(array, lut):
+    """
+    Applies the per-channel lookup tables to the section.
+
+    :param array: Section as an array (see :func:`section_cdf`).
+    :type array: `numpy.ndarray`
+
+    :param lut: Lookup tables, one row per channel.
+    :type lut: `numpy.ndarray` of shape (channels, 256)
+
+    :return: The section with the lookup tables applied.
+    :rtype: `numpy.ndarray`
+
+    >>> lut = np.array([255 - np.arange(256), np.arange(256) // 2],
+    ...                dtype=np.uint8)
+    >>> apply_lut(np.array([[[10, 10], [200, 200]]], dtype=np.uint8), lut)
+    array([[[245,   5],
+            [ 55, 100]]], dtype=uint8)
+    """
+
+    array = np.asarray(array, dtype=np.uint8)
+    if array.ndim == 3:
+        # Advanced indexing with the channel index broadcast against the
+        # intensities picks the table of each channel at once.
+        return lut[np.arange(array.shape[2]), array]
+    return lut[0][array]
+
+
+class reference_histograms(object):
+    """
+    A cache of the cumulative histograms of the reference sections. The
+    histogram of each reference section is calculated only once, no matter
+    how many sections are matched to it.
+
+    >>> image = itk.GetImageFromArray(np.array([[0, 2], [2, 4]], np.uint8))
+    >>> possum.pos_itk_transforms.write_itk_image(image,
+    ...     '/tmp/pos_histogram_matching_0001.nii.gz')
+    >>> cache = reference_histograms(
+    ...     '/tmp/pos_histogram_matching_%04d.nii.gz')
+    >>> cdf = cache[1]
+    >>> map(float, cdf[0, :5])
+    [0.25, 0.25, 0.75, 0.75, 1.0]
+    >>> cache[1] is cdf, len(cache)
+    (True, 1)
+
+    >>> import os
+    >>> os.remove('/tmp/pos_histogram_matching_0001.nii.gz')
+    """
+
+    def __init__(self, filename_template):
+        """
+        :param filename_template: Template of the sections' filenames, e.g.
+            `/some/dir/%04d.nii.gz`.
+        :type filename_template: str
+        """
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.filename_template = filename_template
+        self._cdfs = {}
+
+    def __len__(self):
+        return len(self._cdfs)
+
+    def __contains__(self, index):
+        return index in self._cdfs
+
+    def __getitem__(self, index):
+        if index not in self._cdfs:
+            self._cdfs[index] = read_section_cdf(
+                self.filename_template % index)
+        return self._cdfs[index]
+
+    def update(self, cdfs):
+        """
+        Put the already calculated histograms into the cache.
+
+        :param cdfs: Mapping between the sections' indexes and their
+            cumulative histograms.
+        :type cdfs: dict
+        """
+        self._cdfs.update(cdfs)
+
+
+def read_section_cdf(filename):
+    """
+    Reads the section and calculates its cumulative histograms.
+
+    :param filename: Section filename.
+    :type filename: str
+
+    :return: Cumulative histograms, one row per channel.
+    :rtype: `numpy.ndarray` of shape (channels, 256)
+    """
+
+    logging.getLogger('read_section_cdf').debug(
+        "Calculating the histogram of %s.", filename)
+    image = possum.pos_itk_transforms.read_itk_image(filename)
+    return section_cdf(itk.GetArrayViewFromImage(image))
+
+
+def match_section_file(input_filename, output_filename, references):
+    """
+    Matches the histogram of the section to a weighted set of references and
+    writes the matched section as an 8-bit image.
+
+    :param input_filename: Section to match.
+    :type input_filename: str
+
+    :param output_filename: Output filename.
+    :type output_filename: str
+
+    :param references: Pairs of (weight, cumulative histograms) of the
+        reference sections.
+    :type references: list of (float, `numpy.ndarray`)
+
+    >>> array = np.array([[10, 10], [20, 30]], dtype=np.uint8)
+    >>> image = itk.GetImageFromArray(array)
+    >>> image.SetSpacing([0.5, 0.5])
+    >>> possum.pos_itk_transforms.write_itk_image(image,
+    ...     '/tmp/pos_histogram_matching_in.nii.gz')
+    >>> target = section_cdf(array + 40)
+    >>> match_section_file('/tmp/pos_histogram_matching_in.nii.gz',
+    ...     '/tmp/pos_histogram_matching_out.nii.gz', [(1.0, target)])
+    >>> output = possum.pos_itk_transforms.read_itk_image(
+    ...     '/tmp/pos_histogram_matching_out.nii.gz')
+    >>> itk.GetArrayFromImage(output), list(output.GetSpacing())
+    (array([[50, 50],
+           [60, 70]], dtype=uint8), [0.5, 0.5])
+
+    >>> import os
+    >>> os.remove('/tmp/pos_histogram_matching_in.nii.gz')
+    >>> os.remove('/tmp/pos_histogram_matching_out.nii.gz')
+    """
+
+    image = possum.pos_itk_transforms.read_itk_image(input_filename)
+    array = itk.GetArrayViewFromImage(image)
+
+    lut = weighted_matching_lut(section_cdf(array), references)
+    matched = apply_lut(array, lut)
+
+    output = itk.GetImageFromArray(matched, is_vector=matched.ndim == 3)
+    output.CopyInformation(image)
+    possum.pos_itk_transforms.write_itk_image(output, output_filename)
+
+
+if __name__ == '__main__':
+    import doctest
+    print doctest.testmod(verbose=True)
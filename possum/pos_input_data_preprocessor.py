@@ -3,6 +3,8 @@
 
 import os
 import pickle
+import threading
+from multiprocessing.pool import ThreadPool
 
 import xlrd
 import xlutils.copy
@@ -46,6 +48,20 @@ _FILE_HASH_COLUMN = 18  # column S
 _PADDING_COLUMN = 19  # column T
 _OFFSET_COLLUMN = 20  # column U
 
+
+def _dimensions(converter):
+    """
+    Creates a function parsing the dimensions stored in the workbook as
+    "x"-joined values.
+
+    >>> _dimensions(int)('1200x800')
+    [1200, 800]
+    >>> _dimensions(float)(u'12.5x8.0')
+    [12.5, 8.0]
+    """
+    return lambda value: map(converter, str(value).split("x"))
+
+
 COLUMN_MAPPING = {
     'image_index': (_SLICE_INDEX_COLUMN, int),
     'image_name': (_IMAGE_NAME_COLUMN, str),
@@ -59,11 +75,11 @@ COLUMN_MAPPING = {
     'rotation': (_ROTATION_COLUMN, int),
     'horizontal_flip': (_HORIZONTAL_FLIP_COLLUMN, bool),
     'vertical_flip': (_VERTICAL_FLIP_COLUMN, bool),
-    'image_size': (_IMAGE_SIZE_COLUMN, list),
+    'image_size': (_IMAGE_SIZE_COLUMN, _dimensions(int)),
     'file_size': (_FILE_SIZE_COLUMN, int),
     'image_hash': (_FILE_HASH_COLUMN, str),
-    'padded_size': (_PADDING_COLUMN, list),
-    'offset': (_OFFSET_COLLUMN, list)}
+    'padded_size': (_PADDING_COLUMN, _dimensions(int)),
+    'offset': (_OFFSET_COLLUMN, _dimensions(float))}
 
 
 def round_custom(value, level=_DEFAULT_PADDING_ROUNDING):
@@ -167,11 +183,117 @@ def read_image_size(filename):
     :rtype: (int, int)
     """
 
-    image = Image.open(filename)
-    width, height = image.size
+    # Opening the image reads only its header, the image data is not decoded.
+    with open(filename, 'rb') as image_file:
+        width, height = Image.open(image_file).size
     return width, height
 
 
+class metadata_cache(object):
+    """
+    A persistent cache of the image metadata which are expensive to establish
+    (e.g. the md5 checksums of large image files). The metadata are keyed by
+    the file's path, size and modification time, so the metadata of an
+    unchanged file are never calculated again while any change to the file
+    invalidates them. The cache is shared by many threads and it is stored
+    as a pickle file.
+
+    >>> open('/tmp/pos_metadata_cache_image.txt', 'w').write('image data')
+    >>> cache = metadata_cache('/tmp/pos_metadata_cache.pickle')
+    >>> calls = []
+    >>> def checksum(filename):
+    ...     calls.append(filename)
+    ...     return md5sum(filename)
+    >>> cache.get('/tmp/pos_metadata_cache_image.txt', 'image_hash', checksum)
+    'e09a574ca3760a3e28a3e5920fe4627e'
+    >>> cache.save()
+
+    The checksum of the unchanged file is read from the cache:
+
+    >>> cache = metadata_cache('/tmp/pos_metadata_cache.pickle')
+    >>> cache.get('/tmp/pos_metadata_cache_image.txt', 'image_hash', checksum)
+    'e09a574ca3760a3e28a3e5920fe4627e'
+    >>> len(calls)
+    1
+
+    While the changed file is hashed again:
+
+    >>> open('/tmp/pos_metadata_cache_image.txt', 'w').write('new image data')
+    >>> cache.get('/tmp/pos_metadata_cache_image.txt', 'image_hash', checksum)
+    '439c0e4c14d0b71a90419c84f9cf9039'
+    >>> len(calls)
+    2
+
+    >>> os.remove('/tmp/pos_metadata_cache_image.txt')
+    >>> os.remove('/tmp/pos_metadata_cache.pickle')
+    """
+
+    def __init__(self, filename=None):
+        """
+        :param filename: The cache file. When no filename is provided, the
+            cache is not persistent.
+        :type filename: str
+        """
+
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        # A missing or a broken cache file simply means an empty cache.
+        if filename is not None and os.path.isfile(filename):
+            try:
+                self._entries = pickle.load(open(filename))
+            except Exception:
+                self._entries = {}
+
+    @staticmethod
+    def _key(filename):
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+    def get(self, filename, attribute, function):
+        """
+        Get the given metadata `attribute` of the file. If the attribute is
+        not cached, it is calculated by calling the `function` with the
+        `filename` as the only argument.
+        """
+
+        key = self._key(filename)
+
+        with self._lock:
+            entry = self._entries.get(key, {})
+            if attribute in entry:
+                return entry[attribute]
+
+        # The calculation itself is done without holding the lock, so many
+        # files are processed at the same time.
+        value = function(filename)
+
+        with self._lock:
+            self._entries.setdefault(key, {})[attribute] = value
+        return value
+
+    def save(self):
+        """
+        Store the cache. The entries of the files which were modified or
+        removed are discarded.
+        """
+
+        if self._filename is None:
+            return
+
+        def is_current(key):
+            try:
+                return self._key(key[0]) == key
+            except OSError:
+                return False
+
+        with self._lock:
+            entries = dict((key, value) for key, value
+                           in self._entries.iteritems() if is_current(key))
+        pickle.dump(entries, open(self._filename, 'w'))
+
+
 class input_image(object):
     """
     An instance of the input image along with its metadata. Carries the cruical
@@ -233,7 +355,8 @@ class worksheet_manager(object):
 
     _metadata_to_establish = ['file_size', 'image_hash', 'image_size']
 
-    def __init__(self, workbook_in, workbook_out=None, images_dir=None):
+    def __init__(self, workbook_in, workbook_out=None, images_dir=None,
+                 workers=1, cache_filename=None):
         """
         :param workbook_in: path to the workflow to read the data from
         :type workbook_in: str
@@ -246,6 +369,14 @@ class worksheet_manager(object):
         :param images_dir: directory containing the source images described by
         the workbook.
         :type image_dir: str
+
+        :param workers: number of images which metadata are established
+        concurrently.
+        :type workers: int
+
+        :param cache_filename: the file caching the images' metadata between
+        the runs. By default the cache is stored next to the `workbook_out`.
+        :type cache_filename: str
         """
 
         # When no output workbook is provided, use the input workbook as the
@@ -257,6 +388,14 @@ class worksheet_manager(object):
         self._workbook_in = workbook_in
         self._workbook_out = workbook_out
         self._images_dir = images_dir
+        self._workers = workers
+
+        # The metadata which are expensive to calculate (such as the files'
+        # checksums) are cached between the runs.
+        if cache_filename is None:
+            pth, ext = os.path.splitext(self._workbook_out)
+            cache_filename = pth + "_metadata_cache.pickle"
+        self._metadata_cache = metadata_cache(cache_filename)
 
         # Open the workbook and immediately assign the workbook writer to be
         # able to edit the opened workbook.
@@ -317,6 +456,7 @@ class worksheet_manager(object):
         # form the workbook cells. The metadata will be saved into the
         # `input_image` data structures ultimately passed for further
         # manipulation in next steps of the workflow.
+        slices = []
         for slice_index in range(self._stack_size):
             new_slice = input_image()
 
@@ -327,18 +467,46 @@ class worksheet_manager(object):
                 value = self._read_from_workbook(metadata, slice_index)
                 setattr(new_slice, metadata, value)
 
-            # The other kind of metadata are the attributes which require
-            # additional calculations or processing. They are dealt with in the
-            # code below.
-            for metadata in self._metadata_to_establish:
-                attribute_name = 'determine_and_set_' + metadata
-                value = getattr(self, attribute_name)(new_slice)
+            slices.append(new_slice)
+
+        # The other kind of metadata are the attributes which require
+        # additional calculations or processing. As calculating them is
+        # mostly reading the files (which releases the GIL), the images are
+        # processed concurrently.
+        def establish_metadata(new_slice):
+            return [getattr(self, 'determine_and_set_' + metadata)(new_slice)
+                    for metadata in self._metadata_to_establish]
+
+        pool = ThreadPool(self._workers)
+        established = pool.map(establish_metadata, slices)
+        pool.close()
+        pool.join()
+
+        for slice_index, (new_slice, values) in \
+                enumerate(zip(slices, established)):
+            for metadata, value in zip(self._metadata_to_establish, values):
                 setattr(new_slice, metadata, value)
                 self._write_to_workbook(metadata, slice_index, value)
 
             # Finally the given image is appended to the global image stack.
             self._images[new_slice.image_index] = new_slice
 
+        self._metadata_cache.save()
+
+    def read_images_from_workbook(self):
+        """
+        Read all the metadata of the individual images, including the
+        established ones (file sizes, checksums, padding, etc.), from an
+        already processed workbook. Nothing is calculated.
+        """
+
+        for slice_index in range(self._stack_size):
+            new_slice = input_image()
+            for metadata in COLUMN_MAPPING:
+                value = self._read_from_workbook(metadata, slice_index)
+                setattr(new_slice, metadata, value)
+            self._images[new_slice.image_index] = new_slice
+
     def save_workbook(self):
         """
         Save the the updated workflow under the provided filename. See the
@@ -480,7 +648,7 @@ class worksheet_manager(object):
         :rtype: str
         """
         filename = os.path.join(self._images_dir, new_slice.image_name)
-        return md5sum(filename)
+        return self._metadata_cache.get(filename, 'image_hash', md5sum)
 
     def determine_and_set_image_size(self, new_slice):
         """
@@ -493,7 +661,8 @@ class worksheet_manager(object):
         :rtype: (int, int)
         """
         filename = os.path.join(self._images_dir, new_slice.image_name)
-        return read_image_size(filename)
+        return self._metadata_cache.get(filename, 'image_size',
+                                        read_image_size)
 
     def _get_padding(self, new_slice=None):
         """
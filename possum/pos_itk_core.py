@@ -1,9 +1,17 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*
 
-import itk
+import os
+import copy
+import multiprocessing
+import threading
 import logging
 
+import numpy as np
+import itk
+
+import possum.pos_common
+
 """
 # http://sphinx-doc.org/domains.html#the-python-domain
 """
@@ -108,6 +116,125 @@ def get_image_region(image_dim, crop_index, crop_size):
     return bounding_box
 
 
+# The process-wide header cache used by all the in-process image readers.
+_image_header_cache = possum.pos_common.lru_cache(maxsize=1024)
+
+# The image header properties which do not depend on the image dimension...
+_HEADER_DIMENSION_INDEPENDENT_ATTRS = [
+    "ByteOrder", "ByteOrderAsString",
+    "ComponentSize", "ComponentTypeAsString", "FileName",
+    "FileType", "FileTypeAsString", "ImageSizeInBytes",
+    "ImageSizeInComponents", "ImageSizeInPixels", "NameOfClass",
+    "NumberOfComponents", "NumberOfDimensions", "PixelStride",
+    "PixelType", "PixelTypeAsString",
+    "SupportedReadExtensions", "SupportedWriteExtensions"]
+
+# ... and the ones which have to be read for each dimension separately.
+_HEADER_DIMENSION_DEPENDENT_ATTRS = [
+    "DefaultDirection", "Dimensions", "Direction", "Origin", "Spacing"]
+_HEADER_DIMENSION_DEPENDENT_TYPES = {
+    "Dimensions": int, "Origin": float, "Spacing": float}
+
+
+def _read_image_header_from_file(image_path):
+    """
+    Reads the header of the provided image file using the ITK ImageIO and
+    returns the header properties as a dictionary. The names of the
+    properties are the names of the ImageIO getters without the `Get` prefix.
+    """
+
+    logger = logging.getLogger('read_image_header')
+    logger.debug("Reading %s file header details.", image_path)
+
+    image_io = itk.ImageIOFactory.CreateImageIO(image_path,
+                                                itk.ImageIOFactory.ReadMode)
+    image_io.SetFileName(image_path)
+    image_io.ReadImageInformation()
+
+    header = {}
+    for prop in _HEADER_DIMENSION_INDEPENDENT_ATTRS:
+        # Some attributes express some properties of the image using string.
+        # But the string representation requires first a int number to be
+        # read from the image IO.
+        if prop.endswith("AsString"):
+            value = getattr(image_io, "Get" + prop[0:-8])()
+            header[prop] = getattr(image_io, "Get" + prop)(value)
+        else:
+            header[prop] = getattr(image_io, "Get" + prop)()
+
+    n_dims = header["NumberOfDimensions"]
+    for prop in _HEADER_DIMENSION_DEPENDENT_ATTRS:
+        value = map(getattr(image_io, "Get" + prop), range(n_dims))
+        type_ = _HEADER_DIMENSION_DEPENDENT_TYPES.get(prop, None)
+        if type_:
+            value = map(type_, value)
+        header[prop] = value
+
+    return header
+
+
+def read_image_header(image_path):
+    """
+    Returns the header of the provided image as a dictionary (dimensions,
+    component and pixel types, spacing, origin, direction and other
+    properties exposed by the ITK ImageIO). The headers are memoized in a
+    process-wide cache, so reading the header of the same, unmodified file
+    again does not touch the file.
+
+    :param image_path: Image filename.
+    :type image_path: str
+
+    :return: The image header properties.
+    :rtype: dict
+
+    >>> import numpy as np
+    >>> image = itk.GetImageFromArray(np.zeros((3, 5), dtype=np.uint8))
+    >>> image.SetSpacing([0.5, 2.0])
+    >>> itk.imwrite(image, '/tmp/pos_itk_core_header.nii.gz')
+    >>> header = read_image_header('/tmp/pos_itk_core_header.nii.gz')
+    >>> header['Dimensions'], header['Spacing'], header['ComponentTypeAsString']
+    ([5, 3], [0.5, 2.0], 'unsigned_char')
+
+    Subsequent reads are served from the cache:
+
+    >>> key = _image_header_cache_key('/tmp/pos_itk_core_header.nii.gz')
+    >>> _image_header_cache.get(key)['Dimensions']
+    [5, 3]
+
+    >>> import os
+    >>> os.remove('/tmp/pos_itk_core_header.nii.gz')
+    """
+
+    key = _image_header_cache_key(image_path)
+
+    # Files which cannot be examined (e.g. missing files) are not cached.
+    # Let the ImageIO deal with them.
+    if key is None:
+        return _read_image_header_from_file(image_path)
+
+    header = _image_header_cache.get(key)
+    if header is None:
+        header = _read_image_header_from_file(image_path)
+        _image_header_cache.put(key, header)
+
+    return copy.deepcopy(header)
+
+
+def _image_header_cache_key(image_path):
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    return (os.path.abspath(image_path), stat.st_mtime, stat.st_size)
+
+
+def clear_image_header_cache():
+    """
+    Remove all the memoized image headers.
+    """
+    _image_header_cache.clear()
+
+
 def autodetect_file_type(image_path, ret_itk=True):
     """
     Autodetects image dimensions and size as well as pixel type and component
@@ -128,22 +255,17 @@ def autodetect_file_type(image_path, ret_itk=True):
     logger = logging.getLogger('autodetect_file_type')
     logger.info("Autodetecting file type: %s",  image_path)
 
-    # Initialize itk imageIO factory which allows to do some strange things
-    # (this function a pythonized code of an itk example from
+    # The header is read with the itk imageIO (this is a pythonized code of
+    # an itk example from
     # http://www.itk.org/Wiki/ITK/Examples/IO/ReadUnknownImageType
-    # Cheers!
-    image_io = itk.ImageIOFactory.CreateImageIO(image_path,\
-                                itk.ImageIOFactory.ReadMode)
-    image_io.SetFileName(image_path)
-    image_io.ReadImageInformation()
+    # Cheers!) and memoized, see `read_image_header`.
+    header = read_image_header(image_path)
 
     # Extracting information for determining image type
-    image_size = map(image_io.GetDimensions,
-                     range(image_io.GetNumberOfDimensions()))
-    component_type = \
-        image_io.GetComponentTypeAsString(image_io.GetComponentType())
-    pixel_type = image_io.GetPixelTypeAsString(image_io.GetPixelType())
-    number_of_dimensions = image_io.GetNumberOfDimensions()
+    image_size = header['Dimensions']
+    component_type = header['ComponentTypeAsString']
+    pixel_type = header['PixelTypeAsString']
+    number_of_dimensions = header['NumberOfDimensions']
 
     logger.debug("Finished extracting header information.")
 
@@ -151,7 +273,6 @@ def autodetect_file_type(image_path, ret_itk=True):
     logger.info("   Image size: %s", str(image_size))
     logger.info("   Component type: %s", component_type)
     logger.info("   Pixel type: %s", pixel_type)
-    logger.debug(image_io)
     logger.info("Matching image type...")
 
     # If we do not intent to return itk image type then just return
@@ -324,21 +445,9 @@ class pos_itk_image_info(object):
     >>> os.remove("/tmp/pos_itk_image_info.png")
     """
 
-    _DIMENSION_INDEPENDENT_ATTRS = [
-        "ByteOrder", "ByteOrderAsString",
-        "ComponentSize", "ComponentTypeAsString", "FileName",
-        "FileType", "FileTypeAsString", "ImageSizeInBytes",
-        "ImageSizeInComponents", "ImageSizeInPixels", "NameOfClass",
-        "NumberOfComponents", "NumberOfDimensions", "PixelStride",
-        "PixelType", "PixelTypeAsString",
-        "SupportedReadExtensions", "SupportedWriteExtensions"]
-
-    _DIMENSION_DEPENDENT_ATTRS = [
-        "DefaultDirection", "Dimensions", "Direction", "Origin",
-        "Spacing"]
-    _DIMENSION_DEPENDENT_TYPES = {
-        "Dimensions": int, "Origin": float, "Spacing": float}
-
+    _DIMENSION_INDEPENDENT_ATTRS = _HEADER_DIMENSION_INDEPENDENT_ATTRS
+    _DIMENSION_DEPENDENT_ATTRS = _HEADER_DIMENSION_DEPENDENT_ATTRS
+    _DIMENSION_DEPENDENT_TYPES = _HEADER_DIMENSION_DEPENDENT_TYPES
 
     def __init__(self, image_path):
         """
@@ -348,93 +457,86 @@ class pos_itk_image_info(object):
 
         self._logger = logging.getLogger('pos_itk_image_info')
         self._logger.debug("Reading %s file header details." % image_path)
-        self._logger.debug("Setting up the ITK ImageIO object...")
-
-        self._image_io = itk.ImageIOFactory.CreateImageIO(image_path, \
-                                    itk.ImageIOFactory.ReadMode)
-        self._image_io.SetFileName(image_path)
 
-        self._logger.debug("Reading image information.")
-        self._image_io.ReadImageInformation()
+        # The header is read by the ITK ImageIO object (or taken from the
+        # header cache if the file has been examined before). Then the
+        # interesting values are passed from the header to the python object.
+        header = read_image_header(image_path)
 
-        # Once we read the IO details from the file,
-        # it is time to pass the interesting IO values
-        # from the itk IO object to the python object.
-        self._logger.debug("Copying stuff from the ImageIO to self.")
-        self._get_dimension_independent_properties()
-        self._get_diemsion_dependent_properties()
+        for prop in self._DIMENSION_INDEPENDENT_ATTRS + \
+                self._DIMENSION_DEPENDENT_ATTRS:
+            setattr(self, prop, header[prop])
+            self._logger.debug("Setting %s to %s .", prop, str(header[prop]))
 
-        # Then, just in case (to be sure that we do not
-        # have unncecessary references) remove the
-        # ImageIO object:
-        self._logger.debug("Removing the ITK ImageIO object reference.")
-        del self._image_io
 
-    def _get_dimension_independent_properties(self):
-        """
-        """
+def resampled_image_geometry(input_image, scaling_factor):
+    """
+    Calculates the size, spacing and origin of the image resampled by
+    :func:`resample_image_filter`. The physical extent of the image is
+    preserved, so the origin moves by half of the difference between the
+    input and the output voxel size.
 
-        for prop in self._DIMENSION_INDEPENDENT_ATTRS:
+    The size of the buffered region of the input image is used. If the image
+    has not been computed yet (e.g. it is an output of a pipeline which will
+    be streamed), the largest possible region is used instead.
 
-            self._logger.debug("Processing the %s property.", prop)
+    :param input_image: Input image to resample
+    :type input_image: itk image
 
-            # I love the itk Get/Set convention so much!
-            attr_name = "Get" + prop
+    :param scaling_factor: Scaling factor (or one factor per axis).
+    :type scaling_factor: float or iterable of floats.
 
-            # Some attributes express some properties of the
-            # image using string. But the string representation
-            # requires first a int number to be read from the
-            # image IO. Therefore all the code below!
-            if attr_name.endswith("AsString"):
-                mod_attr_name = attr_name[0:-8]
-                prop_val = getattr(self._image_io, mod_attr_name)()
+    :return: The size, spacing and origin of the resampled image.
+    :rtype: (list, `itk.Vector`, `itk.Point`)
 
-                self._logger.debug("%s method found.", mod_attr_name)
-                attr_value = getattr(self._image_io, attr_name)(prop_val)
+    >>> image = itk.Image[itk.F, 2].New()
+    >>> image.SetRegions([10, 6])
+    >>> image.SetSpacing([1.0, 2.0])
+    >>> size, spacing, origin = resampled_image_geometry(image, 0.5)
+    >>> size, list(spacing), list(origin)
+    ([5, 3], [2.0, 4.0], [0.5, 1.0])
+    """
 
-                self._logger.debug("%s method found.", attr_name)
-                setattr(self, prop, attr_value)
-            else:
-                attr_value = getattr(self._image_io, attr_name)()
-                self._logger.debug("%s method found.", attr_name)
-                setattr(self, prop, attr_value)
+    image_dim = len(input_image.GetSpacing())
 
-            self._logger.debug("Setting %s to %s .", prop, str(attr_value))
+    # Get original spacing of the input image:
+    pre_spacing = input_image.GetSpacing()
 
-    def _get_diemsion_dependent_properties(self):
-        """
-        """
+    region = input_image.GetBufferedRegion()
+    if region.GetNumberOfPixels() == 0:
+        region = input_image.GetLargestPossibleRegion()
 
-        # Just make a quick alias, so the code
-        # will remain clean
-        n_dims = self.NumberOfDimensions
+    # Initialize recomputed size vector. Note that the vector is initialized
+    # with zeroes:
+    post_size = itk.Vector[itk.US, image_dim]([0] * image_dim)
 
-        for prop in self._DIMENSION_DEPENDENT_ATTRS:
+    # Initialize scaling vector based on provided scaling factor
+    if hasattr(scaling_factor, '__iter__'):
+        scaling = itk.Vector[itk.F, image_dim](scaling_factor)
+    else:
+        scaling = itk.Vector[itk.F, image_dim]([scaling_factor] * image_dim)
 
-            self._logger.debug("Processing the %s property.", prop)
+    # Initialize vector holding spacing of the output image. Note that the
+    # vector is initalized with zeroes.
+    post_spacing = itk.Vector[itk.F, image_dim]([0] * image_dim)
 
-            # I love the itk Get/Set convention so much!
-            attr_name = "Get" + prop
+    for i in range(image_dim):
+        post_spacing[i] = pre_spacing[i] * 1.0 / scaling[i]
+        post_size[i] = int(region.GetSize()[i] * 1.0 * scaling[i])
 
-            # Get a reference to the actual itk ImageIO
-            # function based on the name of the attribute
-            io_function = getattr(self._image_io, attr_name)
-            attr_value = map(io_function, range(n_dims))
-            self._logger.debug("%s method found.", attr_name)
+    # Get the bounding box of the input image
+    pre_origin = input_image.GetOrigin()
 
-            # Sometimes, the value of the arribute obtained
-            # directly ftom the itk function has to be casted
-            # to a different type to maintain compatibility with
-            # native python (e.g. long_int -> int).
-            # This is where this is done:
-            type_ = self._DIMENSION_DEPENDENT_TYPES.get(prop, None)
-            if type_:
-                self._logger.debug("Mapping %s to %s.",
-                                    attr_name, str(type_))
-                attr_value = map(type_, attr_value)
+    # Recalculate the origin. The origin describes the center of voxel 0,0,0
+    # so that as the voxel size changes, the origin will change as well.
+    pre_offset = input_image.GetDirection() * pre_spacing
+    post_offset = input_image.GetDirection() * post_spacing
+    for i in range(pre_offset.Size()):
+        pre_offset[i] *= 0.5
+        post_offset[i] *= 0.5
+    origin_post = pre_origin - pre_offset + post_offset
 
-            setattr(self, prop, attr_value)
-            self._logger.debug("Setting %s to %s .", prop, str(attr_value))
+    return map(int, post_size), post_spacing, origin_post
 
 
 def resample_image_filter(input_image, scaling_factor, default_value=0,
@@ -493,43 +595,10 @@ def resample_image_filter(input_image, scaling_factor, default_value=0,
     resample_filter.SetTransform(itk.IdentityTransform[itk.D, image_dim].New())
     resample_filter.SetInterpolator(interpolator)
 
-    # Get original spacing of the input image:
-    pre_spacing = input_image.GetSpacing()
-
-    # Initialize recomputed size vector. Note that the vector is initialized
-    # with zeroes:
-    post_size = itk.Vector[itk.US, image_dim]([0] * image_dim)
-
-    # Initialize scaling vector based on provided scaling factor
-    if hasattr(scaling_factor, '__iter__'):
-        logger.debug("   + Multiple scaling factors provided.")
-        scaling = itk.Vector[itk.F, image_dim](scaling_factor)
-    else:
-        logger.debug("   + A single scaling factor was provided.")
-        scaling = itk.Vector[itk.F, image_dim]([scaling_factor] * image_dim)
-
-    # Initialize vector holding spacing of the output image. Note that the
-    # vector is initalized with zeroes.
-    post_spacing = itk.Vector[itk.F, image_dim]([0] * image_dim)
-
-    for i in range(image_dim):
-        post_spacing[i] = pre_spacing[i] * 1.0 / scaling[i]
-        post_size[i] = int(input_image.GetBufferedRegion().GetSize()[i] *
-                           1.0 * scaling[i])
+    post_size, post_spacing, origin_post = \
+        resampled_image_geometry(input_image, scaling_factor)
     logger.info("   + Computed final size: %s", str(post_size))
     logger.info("   + Computed final spacing: %s", str(post_spacing))
-
-    # Get the bounding box of the input image
-    pre_origin = input_image.GetOrigin()
-
-    # Recalculate the origin. The origin describes the center of voxel 0,0,0
-    # so that as the voxel size changes, the origin will change as well.
-    pre_offset = input_image.GetDirection() * pre_spacing
-    post_offset = input_image.GetDirection() * post_spacing
-    for i in range(pre_offset.Size()):
-        pre_offset[i] *= 0.5
-        post_offset[i] *= 0.5
-    origin_post = pre_origin - pre_offset + post_offset
     logger.info("   + Computed final origin: %s", str(origin_post))
 
     # Set the image sizes, spacing, origins and image direction matrix:
@@ -676,16 +745,99 @@ def print_vnl_matrix(matrix):
         print "[ " + " ".map(str, row) + " ]"
 
 
-def reorder_volume(input_image, reorder_mapping, slicing_plane):
+def reorder_array(array, order, axis, out=None, chunk_size=None):
     """
-    Funtion for reordering the slices along the `slicing_plane` in the provided
-    `input_image` according to the `reorder_mapping`.
+    Reorders the slices of the `array` along the `axis` so that
+    `out[..., i, ...] = array[..., order[i], ...]`. Works with any numpy
+    array, including memory mapped ones.
 
-    .. note::
-        Only grayscale images are supported. Poor python `itk` bindings...
+    :param array: The array to reorder.
+    :type array: `numpy.ndarray`
+
+    :param order: Index of the input slice for each of the output slices.
+    :type order: `iterable`
+
+    :param axis: The axis along which the slices are reordered.
+    :type axis: int
+
+    :param out: The output array. If not provided, a new array is created. If
+        the output array is the input array, the slices are reordered in
+        place, using a buffer of a single slice. This requires the order to
+        be a permutation.
+    :type out: `numpy.ndarray`
+
+    :param chunk_size: Number of the output slices gathered at once. By
+        default all the slices are gathered in a single step.
+    :type chunk_size: int
+
+    :returns: The reordered array.
+    :rtype: `numpy.ndarray`
+
+    >>> array = np.arange(12).reshape(3, 4)
+    >>> reorder_array(array, [3, 0, 0, 1], axis=1, chunk_size=3).tolist()
+    [[3, 0, 0, 1], [7, 4, 4, 5], [11, 8, 8, 9]]
+
+    >>> reorder_array(array, [2, 0, 1], axis=0, out=array).tolist()
+    [[8, 9, 10, 11], [0, 1, 2, 3], [4, 5, 6, 7]]
+
+    >>> reorder_array(array, [0, 0, 1], axis=0, out=array)
+    Traceback (most recent call last):
+    ValueError: In place reordering requires the order to be a permutation.
+    """
+
+    order = np.asarray(order, dtype=np.intp)
+    extent = array.shape[axis]
+
+    def slab(start, stop):
+        index = [slice(None)] * array.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    if out is array:
+        if not np.array_equal(np.sort(order), np.arange(extent)):
+            raise ValueError(
+                "In place reordering requires the order to be a permutation.")
+
+        # Follow each cycle of the permutation. Only the first slice of the
+        # cycle has to be buffered as it is overwritten before being read.
+        visited = np.zeros(extent, dtype=np.bool)
+        for first in range(extent):
+            if visited[first]:
+                continue
+            buffer = array[slab(first, first + 1)].copy()
+            current = first
+            while True:
+                visited[current] = True
+                source = order[current]
+                if source == first:
+                    array[slab(current, current + 1)] = buffer
+                    break
+                array[slab(current, current + 1)] = \
+                    array[slab(source, source + 1)]
+                current = source
+        return array
+
+    if out is None:
+        out = np.empty_like(array)
+
+    chunk_size = chunk_size or extent
+    for start in range(0, extent, chunk_size):
+        stop = min(start + chunk_size, extent)
+        out[slab(start, stop)] = np.take(array, order[start:stop], axis=axis)
+
+    return out
+
+
+def reorder_volume(input_image, reorder_mapping, slicing_plane,
+                   in_place=False, chunk_size=None):
+    """
+    Funtion for reordering the slices along the `slicing_plane` in the provided
+    `input_image` according to the `reorder_mapping`. The slices are gathered
+    directly in the images' buffers so images of any pixel type (including
+    the multichannel ones) are supported.
 
     :param input_image: Input image which serves as a source for the reordering
-                        routine. Only grayscale images are supported.
+                        routine.
     :type input_image: `itk.Image`
 
     :param reorder_mapping: Mapping from the input image slice order to the
@@ -701,7 +853,30 @@ def reorder_volume(input_image, reorder_mapping, slicing_plane):
         Allowed values are: 0,1,2.
     :type slicing_plane: int
 
+    :param in_place: Reorder the slices of the input image instead of
+        creating a new image. Requires the mapping to be a permutation.
+    :type in_place: bool
+
+    :param chunk_size: Number of slices copied at once, see
+        :func:`reorder_array`.
+    :type chunk_size: int
+
     :returns: `itk.image` with reordered slices.
+
+    >>> array = np.arange(2 * 3 * 4 * 3, dtype=np.uint8).reshape(2, 3, 4, 3)
+    >>> image = itk.GetImageFromArray(array, is_vector=True)
+    >>> image.SetSpacing([0.5, 1.0, 2.0])
+    >>> output = reorder_volume(image, {0: 2, 1: 0, 2: 1}, 1)
+    >>> output.GetNameOfClass(), output.GetNumberOfComponentsPerPixel()
+    ('Image', 3)
+    >>> list(output.GetSpacing())
+    [0.5, 1.0, 2.0]
+    >>> list(output.GetPixel([3, 0, 1])) == list(image.GetPixel([3, 2, 1]))
+    True
+
+    >>> output = reorder_volume(image, [1, 0, 3, 2], 0, in_place=True)
+    >>> output is image, map(int, image.GetPixel([0, 0, 0]))
+    (True, [3, 4, 5])
     """
     logger = logging.getLogger('reorder_volume')
 
@@ -710,79 +885,541 @@ def reorder_volume(input_image, reorder_mapping, slicing_plane):
     logger.info("Provided image has a shape of : %s", map(str, image_shape))
     logger.info("Selected slicing plane: %d", slicing_plane)
 
-    logger.debug("Duplicating the input image.")
-    image_duplicator = itk.ImageDuplicator[input_image].New()
-    image_duplicator.SetInputImage(input_image)
-    image_duplicator.Update()
-    duplicate = image_duplicator.GetOutput()
-
-    # This is a filter that will erase (make all voxel values to zero)
-    # it is not necessary step, but will help to catch any errors.
-    logger.debug("Zeroing the duplicated image.")
-    zeroer = itk.ShiftScaleImageFilter[duplicate, duplicate].New()
-    zeroer.SetScale(0)
-    zeroer.SetInput(image_duplicator.GetOutput())
-
-    # This is a filter that will copy consecutive slices from one volume
-    # to the other
-    paste_filter = itk.PasteImageFilter[duplicate].New()
-
     # Now we extract the number of slices in a given slicng plane
     slicing_plane_extent = image_shape[slicing_plane]
     logger.debug("Defining the number of slices along the slicing plane: %d",
                  slicing_plane_extent)
 
-    # This is the empty image of the same size and shape as the original
-    # image. This image fill be filled with consecutive slices from the
-    # original image.
-    output_image = zeroer.GetOutput()
-
-    # The next step is to loop over all slices' indexes in the slicing
-    # plane, and copy each slice to its new location in the output image.
-    for slice_idx in range(slicing_plane_extent):
-
-        logger.info("Copying: (intput) %d --> %d (output)",
-                    reorder_mapping[slice_idx], slice_idx)
-
-        # Input region changes with each iteration (obviously)
-        input_region_origin = [0, 0, 0]
-        input_region_origin[slicing_plane] = reorder_mapping[slice_idx]
-
-        # Define the input region size, the input region size it, actually,
-        # the same in each iteration. Technically this could easily go outside
-        # the loop but to keep the region definition close togeather, it is
-        # inside the loop.
-        input_region_size = list(image_shape)
-        input_region_size[slicing_plane] = 1
-
-        # Compose input region origin and size into itk region.
-        input_region = get_image_region(ndim,
-                input_region_origin, input_region_size)
-
-        # The output region index is the place where the given slice will be
-        # located. To define the output region we use the provided lookup
-        # table.
-        output_region_origin = [0, 0, 0]
-        output_region_origin[slicing_plane] = slice_idx
-
-        # Configure the image pasting filter.
-        logger.debug("Input image origin: %s", input_region_origin)
-        logger.debug("Input image size: %s", input_region_size)
-        logger.debug("Output image origin: %s", output_region_origin)
-        paste_filter.SetSourceImage(input_image)
-        paste_filter.SetDestinationImage(output_image)
-        paste_filter.SetSourceRegion(input_region)
-        paste_filter.SetDestinationIndex(output_region_origin)
-
-        # Latch the filter and capture the output.
-        paste_filter.Update()
-        output_image = paste_filter.GetOutput()
+    order = [reorder_mapping[slice_idx]
+             for slice_idx in range(slicing_plane_extent)]
+    for slice_idx, source_idx in enumerate(order):
+        logger.debug("Copying: (intput) %d --> %d (output)",
+                     source_idx, slice_idx)
+
+    # Note that the numpy arrays have the axes in the reversed order.
+    input_array = itk.GetArrayViewFromImage(input_image)
+    axis = ndim - 1 - slicing_plane
+
+    if in_place:
+        output_image = input_image
+        output_array = input_array
+    else:
+        logger.debug("Allocating the output image.")
+        output_image = input_image.New()
+        output_image.SetRegions(input_image.GetLargestPossibleRegion())
+        output_image.CopyInformation(input_image)
+        output_image.Allocate()
+        output_array = itk.GetArrayViewFromImage(output_image)
+
+    reorder_array(input_array, order, axis, out=output_array,
+                  chunk_size=chunk_size)
 
     logger.info("Done.")
-    # After conducting all iterations return the output image.
     return output_image
 
 
+def _buffered_array_view(image):
+    """
+    :return: Array view of the buffered region of the image, which, unlike
+        `itk.GetArrayViewFromImage`, does not have to be the largest
+        possible region of the image.
+    :rtype: `numpy.ndarray`
+    """
+    buffered_image = type(image).New()
+    buffered_image.SetRegions(image.GetBufferedRegion())
+    buffered_image.SetNumberOfComponentsPerPixel(
+        image.GetNumberOfComponentsPerPixel())
+    buffered_image.SetPixelContainer(image.GetPixelContainer())
+    return itk.GetArrayViewFromImage(buffered_image)
+
+
+def reorder_volume_file(input_filename, output_filename, reorder_mapping,
+                        slicing_plane, chunk_size=None, image_type=None):
+    """
+    Reorders the slices of the image file without loading the whole image
+    into the memory. The output image is written slab by slab, `chunk_size`
+    slices at a time, and each slab is gathered from the input slices read
+    from the input file on demand. Therefore only a single slab of the output
+    and a single input slice are kept in the memory, provided that the input
+    file can be read piece by piece (e.g. MetaImage or NIfTI files).
+
+    The output has to be an uncompressed MetaImage file (`.mha` or `.mhd`)
+    as ITK cannot paste the slabs into the files of the other formats.
+
+    :param input_filename: Input image filename.
+    :type input_filename: str
+
+    :param output_filename: Output image filename.
+    :type output_filename: str
+
+    :param reorder_mapping: Mapping from the output slices to the input
+        slices, `mapping[output_slice] = input_slice`, see
+        :func:`reorder_volume`.
+    :type reorder_mapping: `iterable`
+
+    :param slicing_plane: Image plane along with the slices will be reordered.
+        Allowed values are: 0,1,2.
+    :type slicing_plane: int
+
+    :param chunk_size: Number of the output slices written at once. One by
+        default.
+    :type chunk_size: int
+
+    :param image_type: Type of the input image. Autodetected when not
+        provided.
+    :type image_type: `itk.Image`
+
+    >>> array = np.arange(5 * 3 * 4 * 3, dtype=np.uint8).reshape(5, 3, 4, 3)
+    >>> image = itk.GetImageFromArray(array, is_vector=True)
+    >>> image.SetSpacing([0.5, 1.0, 2.0])
+    >>> itk.imwrite(image, '/tmp/pos_itk_core_reorder.nii.gz')
+    >>> mapping = {0: 4, 1: 0, 2: 0, 3: 2, 4: 1}
+    >>> reorder_volume_file('/tmp/pos_itk_core_reorder.nii.gz',
+    ...     '/tmp/pos_itk_core_reordered.mha', mapping, 2, chunk_size=2)
+
+    >>> image_type = autodetect_file_type('/tmp/pos_itk_core_reorder.nii.gz')
+    >>> reader = itk.ImageFileReader[image_type].New(
+    ...     FileName='/tmp/pos_itk_core_reordered.mha')
+    >>> reader.Update()
+    >>> expected = reorder_volume(image, mapping, 2)
+    >>> np.array_equal(itk.GetArrayViewFromImage(reader.GetOutput()),
+    ...                itk.GetArrayViewFromImage(expected))
+    True
+    >>> list(reader.GetOutput().GetSpacing())
+    [0.5, 1.0, 2.0]
+
+    >>> reorder_volume_file('/tmp/pos_itk_core_reorder.nii.gz',
+    ...     '/tmp/pos_itk_core_reordered.nii.gz', mapping, 2)
+    Traceback (most recent call last):
+    ValueError: The streamed output has to be a MetaImage file (.mha or .mhd).
+
+    >>> for filename in ['/tmp/pos_itk_core_reorder.nii.gz',
+    ...                  '/tmp/pos_itk_core_reordered.mha']:
+    ...     os.remove(filename)
+    """
+    logger = logging.getLogger('reorder_volume_file')
+
+    if not output_filename.lower().endswith(('.mha', '.mhd')):
+        raise ValueError(
+            "The streamed output has to be a MetaImage file (.mha or .mhd).")
+
+    if image_type is None:
+        image_type = autodetect_file_type(input_filename)
+
+    reader = itk.ImageFileReader[image_type].New(FileName=input_filename)
+    reader.UpdateOutputInformation()
+    input_image = reader.GetOutput()
+
+    image_shape = list(input_image.GetLargestPossibleRegion().GetSize())
+    ndim = len(image_shape)
+    slicing_plane_extent = image_shape[slicing_plane]
+    order = [reorder_mapping[slice_idx]
+             for slice_idx in range(slicing_plane_extent)]
+
+    # Note that the numpy arrays have the axes in the reversed order.
+    axis = ndim - 1 - slicing_plane
+
+    def slab_region(start, stop):
+        index = [0] * ndim
+        index[slicing_plane] = start
+        size = list(image_shape)
+        size[slicing_plane] = stop - start
+        region = itk.ImageRegion[ndim]()
+        region.SetIndex(index)
+        region.SetSize(size)
+        return region
+
+    # The slabs are pasted into the output file, which has to be created
+    # from scratch.
+    if os.path.exists(output_filename):
+        os.remove(output_filename)
+
+    chunk_size = chunk_size or 1
+    for start in range(0, slicing_plane_extent, chunk_size):
+        stop = min(start + chunk_size, slicing_plane_extent)
+        logger.debug("Writing the output slices %d-%d.", start, stop - 1)
+
+        output_slab = image_type.New()
+        output_slab.SetRegions(slab_region(start, stop))
+        output_slab.SetNumberOfComponentsPerPixel(
+            input_image.GetNumberOfComponentsPerPixel())
+        output_slab.Allocate()
+        output_array = _buffered_array_view(output_slab)
+
+        for slice_idx in range(start, stop):
+            source_idx = order[slice_idx]
+            input_image.SetRequestedRegion(
+                slab_region(source_idx, source_idx + 1))
+            reader.Update()
+
+            offset = source_idx - \
+                input_image.GetBufferedRegion().GetIndex()[slicing_plane]
+            index = [slice(None)] * output_array.ndim
+            index[axis] = slice_idx - start
+            output_array[tuple(index)] = np.take(
+                _buffered_array_view(input_image), offset, axis)
+
+        # The slab is a part of the output image of the input's geometry.
+        output_slab.CopyInformation(input_image)
+
+        io_region = itk.ImageIORegion(ndim)
+        for dimension, (index, size) in enumerate(zip(
+                slab_region(start, stop).GetIndex(),
+                slab_region(start, stop).GetSize())):
+            io_region.SetIndex(dimension, index)
+            io_region.SetSize(dimension, size)
+
+        # Pasting the slabs of the RGB images issues a (harmless) warning
+        # about the pixel type stored in the file (a vector) for each slab.
+        warnings = itk.Object.GetGlobalWarningDisplay()
+        itk.Object.SetGlobalWarningDisplay(False)
+        try:
+            writer = itk.ImageFileWriter[image_type].New(
+                Input=output_slab, FileName=output_filename)
+            writer.SetIORegion(io_region)
+            writer.Update()
+        finally:
+            itk.Object.SetGlobalWarningDisplay(warnings)
+
+    logger.info("Done.")
+
+
+def worker_processes_allowed():
+    """
+    Tells if the pool of worker processes can be started from the current
+    context. The daemonic processes (e.g. the workers of another pool) cannot
+    have children and forking from a thread other than the main one could
+    copy the locks held by the other threads into the worker processes.
+
+    :rtype: bool
+    """
+
+    return not multiprocessing.current_process().daemon and \
+        isinstance(threading.current_thread(), threading._MainThread)
+
+
+def _init_worker_process():
+    """
+    Initialize the freshly forked worker process. The threads of the ITK's
+    thread pool (the default threader of ITK 5) are not copied by the fork,
+    and ITK does not restart them, so the filters created in the worker use
+    the threader which starts its own threads instead.
+    """
+    itk.MultiThreaderBase.SetGlobalDefaultThreader(
+        itk.MultiThreaderBase.ThreaderTypeFromString('Platform'))
+
+
+def process_pool(workers):
+    """
+    Start a pool of worker processes running ITK filters. The processes are
+    forked, so all the data prepared before the pool is started (e.g.
+    images stored in module level variables) is shared with the workers
+    instead of being sent to them.
+
+    Processes are used rather than threads as the ITK Python wrappers do not
+    release the GIL while the filters are executed.
+
+    :param workers: Number of the processes.
+    :type workers: int
+
+    :rtype: `multiprocessing.Pool`
+    """
+    return multiprocessing.Pool(workers, initializer=_init_worker_process)
+
+
+def image_to_buffer(image):
+    """
+    Convert the single component image into a picklable tuple, e.g. to return
+    the image from a worker process (see :func:`process_pool`).
+
+    :param image: Image to convert.
+    :type image: `itk.Image`
+
+    :return: The image's data, pixel type, dimension and geometry.
+    :rtype: tuple
+
+    >>> image = itk.GetImageFromArray(np.arange(6, dtype=np.uint8).reshape(2, 3))
+    >>> image.SetSpacing([0.5, 2.0])
+    >>> copied = image_from_buffer(image_to_buffer(image))
+    >>> type(copied) == type(image), list(copied.GetSpacing())
+    (True, [0.5, 2.0])
+    >>> itk.GetArrayViewFromImage(copied)
+    array([[0, 1, 2],
+           [3, 4, 5]], dtype=uint8)
+    """
+    pixel_type, dimension = itk.template(type(image))[1]
+
+    return (itk.GetArrayFromImage(image), pixel_type.short_name, dimension,
+            list(image.GetOrigin()), list(image.GetSpacing()),
+            itk.GetArrayFromMatrix(image.GetDirection()))
+
+
+def image_from_buffer(buffer):
+    """
+    Convert the tuple created by :func:`image_to_buffer` back into an image.
+
+    :rtype: `itk.Image`
+    """
+    array, pixel_type, dimension, origin, spacing, direction = buffer
+
+    image_type = itk.Image[getattr(itk, pixel_type), dimension]
+    image = itk.PyBuffer[image_type].GetImageFromArray(array)
+    image.SetOrigin(origin)
+    image.SetSpacing(spacing)
+    image.SetDirection(itk.GetMatrixFromArray(direction))
+
+    return image
+
+
+# The image processed by the `process_multichannel_image` and the processing
+# routine. The state is set before the worker processes are forked, so the
+# workers share the image with the parent process.
+_multichannel_state = {}
+
+
+def _extract_component(input_image, component_type, index):
+    extract_filter = itk.VectorIndexSelectionCastImageFilter[
+        type(input_image), component_type].New(Input=input_image, Index=index)
+    extract_filter.Update()
+    return extract_filter.GetOutput()
+
+
+def _process_component_job(index):
+    """
+    Extract and process a single component of the image described by the
+    `_multichannel_state`. The function is executed by the worker processes.
+    """
+    state = _multichannel_state
+
+    component = _extract_component(
+        state['image'], state['component_type'], index)
+    processed_component = state['function'](component)
+    processed_component.Update()
+
+    return image_to_buffer(processed_component)
+
+
+def process_multichannel_image(input_image, process_function,
+                               component_type=None, output_type=None,
+                               workers=None):
+    """
+    Apply a single channel processing routine to every component of the
+    provided image and compose the processed components back into
+    a multichannel image. The components are processed concurrently by
+    a pool of worker processes (see :func:`process_pool`) so, given enough
+    processors, processing an RGB image takes roughly as long as processing
+    a single grayscale image. Single channel images are simply passed to the
+    `process_function`.
+
+    :param input_image: Image to process.
+    :type input_image: `itk.Image`
+
+    :param process_function: Routine processing a single component. It is
+        called with a single channel image and it has to return the processed
+        single channel image. When more than one worker is used, the routine
+        is executed in the worker processes, so any changes of the state it
+        makes are not visible in the calling process.
+    :type process_function: callable
+
+    :param component_type: Type of the extracted components. If not provided,
+        the scalar type matching the pixel type of the input image is used.
+    :type component_type: `itk.Image` type
+
+    :param output_type: Type of the composed image. If not provided, the
+        type of the input image is used, unless the processing changes the
+        pixel type. In such case an `itk.VectorImage` is composed.
+    :type output_type: `itk.Image` type
+
+    :param workers: Number of worker processes. By default, as many as there
+        are components (but no more than the number of processors). The
+        components are processed one by one when worker processes cannot be
+        started (see :func:`worker_processes_allowed`).
+    :type workers: int
+
+    :return: The processed multichannel image.
+    :rtype: `itk.Image`
+
+    >>> array = np.arange(4 * 5 * 3, dtype=np.uint8).reshape(4, 5, 3)
+    >>> image = itk.GetImageFromArray(array, is_vector=True)
+    >>> def invert(channel):
+    ...     invert_filter = itk.InvertIntensityImageFilter[
+    ...         (channel, channel)].New(channel, Maximum=255)
+    ...     invert_filter.Update()
+    ...     return invert_filter.GetOutput()
+    >>> output = process_multichannel_image(image, invert)
+    >>> output.GetNumberOfComponentsPerPixel()
+    3
+    >>> np.array_equal(itk.GetArrayViewFromImage(output), 255 - array)
+    True
+
+    The same result is obtained when the components are processed by
+    a number of worker processes:
+
+    >>> output = process_multichannel_image(image, invert, workers=3)
+    >>> np.array_equal(itk.GetArrayViewFromImage(output), 255 - array)
+    True
+
+    >>> grayscale = itk.GetImageFromArray(array[..., 0].copy())
+    >>> output = process_multichannel_image(grayscale, invert)
+    >>> int(output.GetPixel([1, 2])), int(grayscale.GetPixel([1, 2]))
+    (222, 33)
+    """
+    logger = logging.getLogger('process_multichannel_image')
+
+    number_of_components = input_image.GetNumberOfComponentsPerPixel()
+    if number_of_components == 1:
+        return process_function(input_image)
+
+    dimension = input_image.GetImageDimension()
+    if component_type is None:
+        pixel_type = itk.template(input_image)[1][0]
+        component_type = \
+            itk.Image[itk.template(pixel_type)[1][0], dimension]
+
+    workers = min(workers or multiprocessing.cpu_count(),
+                  number_of_components)
+    if not worker_processes_allowed():
+        workers = 1
+
+    logger.debug("Processing %d components using %d processes.",
+                 number_of_components, workers)
+    if workers > 1:
+        _multichannel_state.clear()
+        _multichannel_state.update({
+            'image': input_image,
+            'component_type': component_type,
+            'function': process_function})
+
+        pool = process_pool(workers)
+        processed_components = map(image_from_buffer, pool.map(
+            _process_component_job, range(number_of_components)))
+        pool.close()
+        pool.join()
+        _multichannel_state.clear()
+    else:
+        processed_components = [
+            process_function(_extract_component(
+                input_image, component_type, i))
+            for i in range(number_of_components)]
+
+    if output_type is None:
+        processed_type = type(processed_components[0])
+        if processed_type == component_type:
+            output_type = type(input_image)
+        else:
+            output_type = itk.VectorImage[
+                itk.template(processed_type)[1][0], dimension]
+
+    logger.debug("Composing the processed components.")
+    compose = itk.ComposeImageFilter[
+        type(processed_components[0]), output_type].New()
+    for i, processed_component in enumerate(processed_components):
+        compose.SetInput(i, processed_component)
+    compose.Update()
+
+    return compose.GetOutput()
+
+
+# Sizes (in bytes) of the image components. Used to estimate the memory
+# required to process an image.
+_COMPONENT_SIZES = {
+    itk.UC: 1, itk.SC: 1, itk.US: 2, itk.SS: 2,
+    itk.UI: 4, itk.SI: 4, itk.F: 4, itk.D: 8}
+
+
+def number_of_stream_divisions(image, max_memory, buffers=1):
+    """
+    Determines into how many pieces the image has to be divided so that
+    processing a single piece takes no more than `max_memory` megabytes.
+    The memory required to process the whole image is estimated as the size
+    of the image times the number of the image buffers allocated by the
+    pipeline (i.e. the number of the filters).
+
+    :param image: Image to be processed piece by piece. The image may be
+        not computed yet, only its information is required.
+    :type image: `itk.Image`
+
+    :param max_memory: Memory available for processing a single piece, in
+        megabytes.
+    :type max_memory: float
+
+    :param buffers: Number of the full sized image buffers allocated by the
+        pipeline.
+    :type buffers: int
+
+    :return: Number of pieces.
+    :rtype: int
+
+    >>> image = itk.Image[itk.F, 2].New()
+    >>> image.SetRegions([1024, 512])
+    >>> number_of_stream_divisions(image, 1)
+    2
+    >>> number_of_stream_divisions(image, 1, buffers=3)
+    6
+    >>> number_of_stream_divisions(image, 100)
+    1
+    """
+
+    image.UpdateOutputInformation()
+    region = image.GetLargestPossibleRegion()
+
+    component = itk.template(image)[1][0]
+    if component not in _COMPONENT_SIZES:
+        component = itk.template(component)[1][0]
+    image_bytes = region.GetNumberOfPixels() * \
+        image.GetNumberOfComponentsPerPixel() * \
+        _COMPONENT_SIZES.get(component, 8)
+
+    divisions = int(np.ceil(
+        float(image_bytes) * buffers / (max_memory * 1024 * 1024)))
+
+    # The image is divided along its last axis, there cannot be more pieces
+    # than there are image rows (or slices).
+    return max(1, min(divisions, region.GetSize()[region.GetImageDimension() - 1]))
+
+
+def stream_image(image, divisions):
+    """
+    Computes the image piece by piece. The pipeline producing the image is
+    executed for each piece separately, so only the buffers of a single
+    piece are allocated by the filters of the pipeline at any time. The
+    filters request the neighbourhood they require (e.g. the halo of the
+    median filter) on their own. Only the output image is allocated as
+    a whole.
+
+    :param image: Output of the pipeline to execute. Note that the filters
+        of the pipeline have to be kept referenced until this function
+        returns.
+    :type image: `itk.Image`
+
+    :param divisions: Number of pieces.
+    :type divisions: int
+
+    :return: The computed image.
+    :rtype: `itk.Image`
+
+    >>> array = np.arange(12 * 10, dtype=np.float32).reshape(12, 10)
+    >>> image = itk.GetImageFromArray(array)
+    >>> median = itk.MedianImageFilter[image, image].New(image, Radius=1)
+    >>> output = stream_image(median.GetOutput(), 4)
+    >>> median.Update()
+    >>> np.array_equal(itk.GetArrayViewFromImage(output),
+    ...                itk.GetArrayViewFromImage(median.GetOutput()))
+    True
+    """
+
+    logger = logging.getLogger('stream_image')
+    logger.debug("Computing the image in %d pieces.", divisions)
+
+    streamer = itk.StreamingImageFilter[image, image].New(
+        Input=image, NumberOfStreamDivisions=int(divisions))
+    streamer.Update()
+
+    output = streamer.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
 def itk_is_point_inside_region(image, point, region=None):
     """
 
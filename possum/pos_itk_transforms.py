@@ -1,4 +1,8 @@
+import itertools
+
 import itk
+import numpy as np
+
 import possum.pos_itk_core
 
 """
@@ -9,6 +13,43 @@ http://www.itk.org/Doxygen/html/classitk_1_1CompositeTransform.html
 """
 
 
+def _parse_transformation_txt(lines, filename):
+    """
+    Parses the lines of an ITK text transformation file (a file holding
+    a single transformation). This is the parser shared by
+    :func:`read_transformation_txt_file` and
+    :func:`read_transformation_txt_files`.
+
+    :param lines: Lines of the transformation file.
+    :type lines: list of str
+
+    :param filename: Name of the file (used to report errors).
+    :type filename: str
+
+    :return: The transformation class, its parameters and fixed parameters.
+    :rtype: (str, list of str, list of str)
+
+    >>> _parse_transformation_txt(['#Insight Transform File V1.0',
+    ...     '#Transform 0', 'Transform: TranslationTransform_double_2_2',
+    ...     'Parameters: 1 2.5', 'FixedParameters: '], 'test.txt')
+    ('TranslationTransform_double_2_2', ['1', '2.5'], [])
+    """
+
+    # A brief validation: the 3rd, 4th and the 5th line have to contain the
+    # transformation class, the parameters and the fixed parameters.
+    if len(lines) < 5 or \
+       not lines[2].startswith('Transform:') or \
+       not lines[3].startswith('Parameters:') or \
+       not lines[4].startswith('FixedParameters:'):
+        raise ValueError("%s is not a valid transformation file." % filename)
+
+    transformation_class = lines[2].split(':', 1)[1].strip()
+    parameters = lines[3].split(':', 1)[1].split()
+    fixed_parameters = lines[4].split(':', 1)[1].split()
+
+    return transformation_class, parameters, fixed_parameters
+
+
 def read_transformation_txt_file(transformation_file):
     """
     Extracts transformation parameters from the transformation file
@@ -22,28 +63,464 @@ def read_transformation_txt_file(transformation_file):
     """
 
     # Well - open the file and read its contents:
-    transformation_string = open(transformation_file).readlines()
+    transformation_string = open(transformation_file).read().splitlines()
 
     # Then extract the transformation class name (it is very important which
-    # type of transformation given file carries :)
-    transformation_class = transformation_string[2].strip().split(':')[1].strip()
-
-    # Extract the actual parametres from the parameters string.
-    parameters = \
-        transformation_string[3].strip().split(':')[1].strip().split(' ')
-    parameters = map(float, parameters)
-
-    # And then the same for the fixed parameters. Make them floats afterwards,
-    fixed_parameters = \
-        transformation_string[4].strip().split(':')[1].strip().split(' ')
-    fixed_parameters =  map(float, fixed_parameters)
+    # type of transformation given file carries :) and the parameters. Make
+    # them floats afterwards.
+    transformation_class, parameters, fixed_parameters = \
+        _parse_transformation_txt(transformation_string, transformation_file)
 
     result = {'transformation_class': transformation_class,
-              'parameters': parameters,
-              'fixed_parameters': fixed_parameters}
+              'parameters': map(float, parameters),
+              'fixed_parameters': map(float, fixed_parameters)}
     return result
 
 
+def write_transformation_txt_file(filename, parameters, fixed_parameters,
+        transformation_class="MatrixOffsetTransformBase_double_2_2"):
+    """
+    Writes the transformation parameters into an ITK text transformation
+    file without instantiating any ITK object. This is a counterpart of
+    the :func:`read_transformation_txt_file` function.
+
+    :param filename: Name of the file to store the transformation in.
+    :type filename: str
+
+    :param parameters: Transformation parameters.
+    :type parameters: iterable of floats
+
+    :param fixed_parameters: Fixed parameters of the transformation.
+    :type fixed_parameters: iterable of floats
+
+    :param transformation_class: Name of the ITK transformation class.
+    :type transformation_class: str
+
+    >>> write_transformation_txt_file('/tmp/pos_itk_transforms_test.txt',
+    ...     [1, 0, 0, 1, 2.5, -3], [0, 0])
+    >>> print open('/tmp/pos_itk_transforms_test.txt').read().strip()
+    #Insight Transform File V1.0
+    #Transform 0
+    Transform: MatrixOffsetTransformBase_double_2_2
+    Parameters: 1.0 0.0 0.0 1.0 2.5 -3.0
+    FixedParameters: 0.0 0.0
+    >>> read_transformation_txt_file('/tmp/pos_itk_transforms_test.txt')['parameters']
+    [1.0, 0.0, 0.0, 1.0, 2.5, -3.0]
+    """
+
+    transformation_string = \
+        "#Insight Transform File V1.0\n" + \
+        "#Transform 0\n" + \
+        "Transform: %s\n" % transformation_class + \
+        "Parameters: %s\n" % " ".join(map(repr, map(float, parameters))) + \
+        "FixedParameters: %s\n" % " ".join(map(repr, map(float, fixed_parameters)))
+
+    open(filename, 'w').write(transformation_string)
+
+
+def read_transformation_txt_files(filenames):
+    """
+    Reads a series of ITK text transformation files of the same kind and
+    returns their parameters as a single array. Each row of the array holds
+    the parameters of a single transformation followed by its fixed
+    parameters.
+
+    :param filenames: Transformation files to read.
+    :type filenames: list of str
+
+    :return: Array of the transformations' parameters.
+    :rtype: `numpy.ndarray`
+
+    >>> for i in range(3):
+    ...     write_transformation_txt_file(
+    ...         '/tmp/pos_itk_transforms_test_%d.txt' % i,
+    ...         [1, 0, 0, 1, i, 2 * i], [5, 5])
+    >>> read_transformation_txt_files(
+    ...     ['/tmp/pos_itk_transforms_test_%d.txt' % i for i in range(3)])
+    array([[1., 0., 0., 1., 0., 0., 5., 5.],
+           [1., 0., 0., 1., 1., 2., 5., 5.],
+           [1., 0., 0., 1., 2., 4., 5., 5.]])
+
+    >>> open('/tmp/pos_itk_transforms_test_1.txt', 'w').write('Corrupted')
+    >>> read_transformation_txt_files(
+    ...     ['/tmp/pos_itk_transforms_test_%d.txt' % i for i in range(3)])
+    Traceback (most recent call last):
+    ValueError: /tmp/pos_itk_transforms_test_1.txt is not a valid transformation file.
+    """
+
+    parameters = []
+    for filename in filenames:
+        transformation_class, transformation_parameters, fixed_parameters = \
+            _parse_transformation_txt(open(filename).read().splitlines(),
+                                      filename)
+        parameters.append(transformation_parameters + fixed_parameters)
+
+    return np.array(parameters, dtype=np.float64)
+
+
+def write_transformation_txt_files(filenames, parameters, dimension=2,
+        transformation_class="MatrixOffsetTransformBase_double_2_2"):
+    """
+    Writes a series of transformations given as a single parameters array
+    (see :func:`read_transformation_txt_files`) into ITK text files.
+
+    :param filenames: Output filenames, one for each row of the array.
+    :type filenames: list of str
+
+    :param parameters: The transformations' parameters followed by the fixed
+        parameters (the center of the transformation), one row per
+        transformation.
+    :type parameters: `numpy.ndarray`
+
+    :param dimension: Dimension of the transformations.
+    :type dimension: int
+
+    :param transformation_class: Name of the ITK transformation class.
+    :type transformation_class: str
+    """
+
+    for filename, row in zip(filenames, parameters):
+        split = len(row) - dimension
+        write_transformation_txt_file(filename, row[:split], row[split:],
+            transformation_class)
+
+
+def affine_parameters_to_matrices(parameters, dimension=2):
+    """
+    Converts the parameters of a series of ITK affine (matrix + offset)
+    transformations into homogeneous matrices.
+
+    :param parameters: The transformations' parameters followed by the fixed
+        parameters, one row per transformation (see
+        :func:`read_transformation_txt_files`).
+    :type parameters: `numpy.ndarray`
+
+    :param dimension: Dimension of the transformations.
+    :type dimension: int
+
+    :return: Array of homogeneous transformation matrices.
+    :rtype: `numpy.ndarray`
+
+    >>> affine_parameters_to_matrices(np.array([[0, -1, 1, 0, 1, 2, 10, 0]]))
+    array([[[ 0., -1., 11.],
+            [ 1.,  0., -8.],
+            [ 0.,  0.,  1.]]])
+    """
+
+    parameters = np.asarray(parameters, dtype=np.float64)
+    count = parameters.shape[0]
+    d = dimension
+
+    linear = parameters[:, :d * d].reshape(count, d, d)
+    translation = parameters[:, d * d:d * d + d]
+    center = parameters[:, -d:]
+
+    # Offset as calculated by the itk.MatrixOffsetTransformBase.
+    offset = translation + center - np.einsum('skl,sl->sk', linear, center)
+
+    matrices = np.tile(np.eye(d + 1), (count, 1, 1))
+    matrices[:, :d, :d] = linear
+    matrices[:, :d, d] = offset
+
+    return matrices
+
+
+def matrices_to_affine_parameters(matrices, centers):
+    """
+    Converts homogeneous matrices into the parameters of ITK affine
+    transformations with the provided centers. This is the inverse of the
+    :func:`affine_parameters_to_matrices` function.
+
+    :param matrices: Homogeneous transformation matrices.
+    :type matrices: `numpy.ndarray`
+
+    :param centers: Centers of the transformations (the fixed parameters),
+        one row per transformation.
+    :type centers: `numpy.ndarray`
+
+    :return: The transformations' parameters followed by the fixed
+        parameters, one row per transformation.
+    :rtype: `numpy.ndarray`
+
+    >>> parameters = np.array([[0.9, -0.1, 0.2, 1.1, 3., 4., 10., -5.],
+    ...                        [1., 0., 0., 1., 0., 0., 0., 0.]])
+    >>> matrices = affine_parameters_to_matrices(parameters)
+    >>> np.allclose(matrices_to_affine_parameters(
+    ...     matrices, parameters[:, -2:]), parameters)
+    True
+
+    Inverting a series of transformations is as simple as:
+
+    >>> inverse = matrices_to_affine_parameters(
+    ...     np.linalg.inv(matrices), parameters[:, -2:])
+    >>> np.allclose(np.einsum('skl,slm->skm', matrices,
+    ...     affine_parameters_to_matrices(inverse)), np.eye(3))
+    True
+    """
+
+    matrices = np.asarray(matrices, dtype=np.float64)
+    centers = np.asarray(centers, dtype=np.float64)
+    count, d = matrices.shape[0], matrices.shape[1] - 1
+
+    linear = matrices[:, :d, :d]
+    offset = matrices[:, :d, d]
+    translation = offset - centers + np.einsum('skl,sl->sk', linear, centers)
+
+    return np.hstack([linear.reshape(count, d * d), translation, centers])
+
+
+class transform_bundle(object):
+    """
+    A container holding the transformations of a whole stack of sections in
+    a single `.npz` file instead of thousands of tiny ITK text files. The
+    transformations are grouped by their type (e.g. 'partial', 'composite',
+    'smooth') and, within each type, they are identified by the section
+    index. All the transformations of a given type share the same ITK class,
+    so their parameters are kept as a single two dimensional array.
+
+    >>> bundle = transform_bundle()
+    >>> bundle.add('smooth', [3, 4, 5],
+    ...     [[1, 0, 0, 1, 0, 0], [1, 0, 0, 1, 1, 1], [1, 0, 0, 1, 2, 2]],
+    ...     [[10, 10]] * 3)
+    >>> bundle.types
+    ['smooth']
+    >>> bundle.indexes('smooth')
+    [3, 4, 5]
+    >>> transformation = bundle['smooth', 4]
+    >>> transformation['transformation_class']
+    'MatrixOffsetTransformBase_double_2_2'
+    >>> transformation['parameters'], transformation['fixed_parameters']
+    ([1.0, 0.0, 0.0, 1.0, 1.0, 1.0], [10.0, 10.0])
+    >>> bundle['smooth', 7]
+    Traceback (most recent call last):
+    KeyError: 'There is no smooth transformation for section 7.'
+
+    The bundle can be saved and loaded back:
+
+    >>> bundle.save('/tmp/pos_itk_transforms_bundle.npz')
+    '/tmp/pos_itk_transforms_bundle.npz'
+    >>> other = transform_bundle.load('/tmp/pos_itk_transforms_bundle.npz')
+    >>> other.parameters('smooth')[2].tolist()
+    [1.0, 0.0, 0.0, 1.0, 2.0, 2.0, 10.0, 10.0]
+
+    For the tools which still require separate ITK text files, the
+    transformations can be exported:
+
+    >>> other.export_txt_files('smooth', '/tmp/pos_itk_transforms_bundle_%04d.txt')
+    ['/tmp/pos_itk_transforms_bundle_0003.txt', '/tmp/pos_itk_transforms_bundle_0004.txt', '/tmp/pos_itk_transforms_bundle_0005.txt']
+    >>> read_transformation_txt_file('/tmp/pos_itk_transforms_bundle_0005.txt')['parameters']
+    [1.0, 0.0, 0.0, 1.0, 2.0, 2.0]
+
+    And a bundle can be created from the existing text files as well:
+
+    >>> third = transform_bundle()
+    >>> third.add_txt_files('fine', range(3, 6),
+    ...     '/tmp/pos_itk_transforms_bundle_%04d.txt')
+    >>> np.array_equal(third.parameters('fine'), bundle.parameters('smooth'))
+    True
+    >>> third.matrices('fine')[1].tolist()
+    [[1.0, 0.0, 1.0], [0.0, 1.0, 1.0], [0.0, 0.0, 1.0]]
+
+    Some transformations (e.g. translations) have no fixed parameters at all:
+
+    >>> third.add('shift', [1, 2], [[1, 2], [3, 4]], np.zeros((2, 0)),
+    ...     'TranslationTransform_double_2_2')
+    >>> third['shift', 2]['parameters'], third['shift', 2]['fixed_parameters']
+    ([3.0, 4.0], [])
+    >>> third.save('/tmp/pos_itk_transforms_bundle.npz')
+    '/tmp/pos_itk_transforms_bundle.npz'
+    >>> fourth = transform_bundle.load('/tmp/pos_itk_transforms_bundle.npz')
+    >>> fourth['shift', 1]['parameters'], fourth['shift', 1]['fixed_parameters']
+    ([1.0, 2.0], [])
+    >>> fourth.export_txt_files('shift', '/tmp/pos_itk_transforms_shift_%04d.txt')
+    ['/tmp/pos_itk_transforms_shift_0001.txt', '/tmp/pos_itk_transforms_shift_0002.txt']
+    >>> fourth.add_txt_files('shift', [1, 2], '/tmp/pos_itk_transforms_shift_%04d.txt')
+    >>> fourth['shift', 2]['parameters'], fourth['shift', 2]['fixed_parameters']
+    ([3.0, 4.0], [])
+    """
+
+    def __init__(self):
+        self._transforms = {}
+
+    @property
+    def types(self):
+        return sorted(self._transforms.keys())
+
+    def add(self, transform_type, indexes, parameters, fixed_parameters,
+            transformation_class="MatrixOffsetTransformBase_double_2_2"):
+        """
+        Add (or replace) the transformations of the given type.
+
+        :param transform_type: Type of the transformations, e.g. 'smooth'.
+        :type transform_type: str
+
+        :param indexes: Section indexes, one for each transformation.
+        :type indexes: list of ints
+
+        :param parameters: Parameters of the transformations, one row per
+            transformation.
+        :type parameters: `numpy.ndarray`
+
+        :param fixed_parameters: Fixed parameters of the transformations, one
+            row per transformation.
+        :type fixed_parameters: `numpy.ndarray`
+
+        :param transformation_class: Name of the ITK transformation class.
+        :type transformation_class: str
+        """
+
+        indexes = np.asarray(indexes, dtype=np.int64)
+        parameters = np.asarray(parameters, dtype=np.float64)
+        fixed_parameters = np.asarray(fixed_parameters, dtype=np.float64)
+
+        assert len(indexes) == len(parameters) == len(fixed_parameters), \
+            "The number of indexes and transformations has to be the same."
+
+        self._transforms[transform_type] = {
+            'indexes': indexes,
+            'parameters': np.hstack([parameters, fixed_parameters]),
+            'fixed_count': fixed_parameters.shape[1],
+            'class': transformation_class,
+            'lookup': dict((int(idx), row) for row, idx in enumerate(indexes))}
+
+    def add_txt_files(self, transform_type, indexes, filename_template):
+        """
+        Read the ITK text transformation files and add them to the bundle.
+
+        :param transform_type: Type of the transformations.
+        :type transform_type: str
+
+        :param indexes: Section indexes.
+        :type indexes: list of ints
+
+        :param filename_template: Filename template of the transformation
+            files, e.g. `fine_%04d.txt`.
+        :type filename_template: str
+        """
+
+        filenames = [filename_template % idx for idx in indexes]
+        first = read_transformation_txt_file(filenames[0])
+        fixed_count = len(first['fixed_parameters'])
+        parameters = read_transformation_txt_files(filenames)
+
+        split = parameters.shape[1] - fixed_count
+        self.add(transform_type, indexes,
+                 parameters[:, :split], parameters[:, split:],
+                 first['transformation_class'])
+
+    def indexes(self, transform_type):
+        """
+        :return: Section indexes of the transformations of the given type.
+        :rtype: list of ints
+        """
+        return self._transforms[transform_type]['indexes'].tolist()
+
+    def parameters(self, transform_type):
+        """
+        :return: Parameters of all the transformations of the given type,
+            followed by their fixed parameters, one row per transformation.
+        :rtype: `numpy.ndarray`
+        """
+        return self._transforms[transform_type]['parameters']
+
+    def matrices(self, transform_type):
+        """
+        :return: Homogeneous matrices of the (affine) transformations of the
+            given type.
+        :rtype: `numpy.ndarray`
+        """
+        transforms = self._transforms[transform_type]
+        return affine_parameters_to_matrices(
+            transforms['parameters'], transforms['fixed_count'])
+
+    def __getitem__(self, key):
+        transform_type, index = key
+        transforms = self._transforms[transform_type]
+
+        try:
+            row = transforms['parameters'][transforms['lookup'][index]]
+        except KeyError:
+            raise KeyError("There is no %s transformation for section %d." %
+                           (transform_type, index))
+
+        split = len(row) - transforms['fixed_count']
+        return {'transformation_class': transforms['class'],
+                'parameters': row[:split].tolist(),
+                'fixed_parameters': row[split:].tolist()}
+
+    def save(self, filename):
+        """
+        Save all the transformations into a single `.npz` file.
+
+        :param filename: Output filename.
+        :type filename: str
+
+        :return: The output filename.
+        :rtype: str
+        """
+
+        arrays = {'types': np.array(self.types)}
+        for transform_type, transforms in self._transforms.items():
+            arrays[transform_type + '.indexes'] = transforms['indexes']
+            arrays[transform_type + '.parameters'] = transforms['parameters']
+            arrays[transform_type + '.fixed_count'] = transforms['fixed_count']
+            arrays[transform_type + '.class'] = np.array(transforms['class'])
+
+        # `numpy.savez` appends the extension when it is missing. Use a file
+        # object so the bundle is saved exactly under the provided name.
+        with open(filename, 'wb') as bundle_file:
+            np.savez(bundle_file, **arrays)
+
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the transformations saved with the :meth:`save` method.
+
+        :param filename: The bundle filename.
+        :type filename: str
+
+        :return: The bundle.
+        :rtype: :class:`transform_bundle`
+        """
+
+        bundle = cls()
+        with np.load(filename) as arrays:
+            for transform_type in map(str, arrays['types']):
+                parameters = arrays[transform_type + '.parameters']
+                fixed_count = int(arrays[transform_type + '.fixed_count'])
+                split = parameters.shape[1] - fixed_count
+                bundle.add(transform_type,
+                    arrays[transform_type + '.indexes'],
+                    parameters[:, :split], parameters[:, split:],
+                    str(arrays[transform_type + '.class']))
+        return bundle
+
+    def export_txt_files(self, transform_type, filename_template):
+        """
+        Write the transformations of the given type as separate ITK text
+        files.
+
+        :param transform_type: Type of the transformations to export.
+        :type transform_type: str
+
+        :param filename_template: Output filename template, e.g.
+            `smooth_%04d.txt`.
+        :type filename_template: str
+
+        :return: Names of the written files.
+        :rtype: list of str
+        """
+
+        transforms = self._transforms[transform_type]
+        filenames = [filename_template % idx
+                     for idx in self.indexes(transform_type)]
+        write_transformation_txt_files(filenames, transforms['parameters'],
+            transforms['fixed_count'], transforms['class'])
+        return filenames
+
+
 def load_itk_matrix_transform_from_file(filename):
     """
     :param filename: File to load the transformation from. The transformation
@@ -339,11 +816,385 @@ def apply_transformation_workflow(moving_file, output_file, reference_file, tran
     write_itk_image(resliced_image, output_file)
 
 
-def itk_coordinate_map(input_image, physical=True):
+def get_image_geometry(image):
+    """
+    Extracts the geometry of the provided image as numpy arrays so that the
+    physical coordinates of the image's voxels can be computed in a vectorized
+    manner.
+
+    :param image: Image to extract the geometry from.
+    :type image: `itk.Image`
+
+    :return: Origin, spacing and direction of the image.
+    :rtype: (`numpy.ndarray`, `numpy.ndarray`, `numpy.ndarray`)
+
+    >>> image = itk.Image[itk.F, 2].New()
+    >>> image.SetRegions([4, 3])
+    >>> image.SetOrigin([1., 2.])
+    >>> image.SetSpacing([0.5, 2.])
+    >>> origin, spacing, direction = get_image_geometry(image)
+    >>> origin, spacing, direction
+    (array([1., 2.]), array([0.5, 2. ]), array([[1., 0.],
+           [0., 1.]]))
+    """
+
+    dimension = image.GetImageDimension()
+    direction = itk.GetArrayFromVnlMatrix(
+        image.GetDirection().GetVnlMatrix().as_matrix())
+
+    return (np.array(map(float, image.GetOrigin())),
+            np.array(map(float, image.GetSpacing())),
+            np.array(direction, dtype=np.float64).reshape(dimension, dimension))
+
+
+def indexes_to_physical_points(indexes, origin, spacing, direction):
+    """
+    Vectorized equivalent of `itk.Image.TransformContinuousIndexToPhysicalPoint`.
+
+    :param indexes: Continuous indexes, one point per row, (x, y[, z]) order.
+    :type indexes: `numpy.ndarray`
+
+    :return: Physical coordinates of the provided indexes.
+    :rtype: `numpy.ndarray`
+
+    >>> origin, spacing = np.array([1., 2.]), np.array([0.5, 2.])
+    >>> direction = np.array([[0., -1.], [1., 0.]])
+    >>> points = indexes_to_physical_points(np.array([[0, 0], [2, 1]]),
+    ...     origin, spacing, direction)
+    >>> points
+    array([[ 1.,  2.],
+           [-1.,  3.]])
+    >>> physical_points_to_indexes(points, origin, spacing, direction)
+    array([[0., 0.],
+           [2., 1.]])
+    """
+
+    return origin + np.dot(np.asarray(indexes) * spacing, direction.T)
+
+
+def physical_points_to_indexes(points, origin, spacing, direction):
+    """
+    Vectorized equivalent of
+    `itk.Image.TransformPhysicalPointToContinuousIndex`. The direction matrix
+    is assumed to be orthonormal.
+
+    :param points: Physical coordinates, one point per row.
+    :type points: `numpy.ndarray`
+
+    :return: Continuous indexes of the points, (x, y[, z]) order.
+    :rtype: `numpy.ndarray`
+    """
+
+    return np.dot(np.asarray(points) - origin, direction) / spacing
+
+
+def interpolate_channels(array, indexes, order=1, chunk_size=2 ** 18):
+    """
+    Interpolates all the channels of the array at the provided continuous
+    indexes at once, using either the nearest neighbour (`order` 0) or the
+    linear (`order` 1) interpolation. The interpolation weights and the
+    neighbours of each point are computed only once and shared by all the
+    channels. Indexes outside of the array are clamped to its edge (like
+    `scipy.ndimage.map_coordinates` with the 'nearest' mode does).
+
+    :param array: Multichannel array shaped ([z,] y, x, channels).
+    :type array: `numpy.ndarray`
+
+    :param indexes: Continuous indexes (x, y[, z]), one point per row.
+    :type indexes: `numpy.ndarray`
+
+    :param order: Interpolation order, either 0 or 1.
+    :type order: int
+
+    :param chunk_size: Number of points interpolated at once. Limits the
+        size of the intermediate arrays.
+    :type chunk_size: int
+
+    :return: Interpolated values, one point per row, one channel per column.
+    :rtype: `numpy.ndarray`
+
+    >>> array = np.dstack([np.arange(12.).reshape(3, 4),
+    ...                    10 * np.arange(12.).reshape(3, 4)])
+    >>> interpolate_channels(array, np.array([[0.5, 0.], [1., 1.5], [5., 0.]]))
+    array([[ 0.5,  5. ],
+           [ 7. , 70. ],
+           [ 3. , 30. ]])
+    >>> interpolate_channels(array, np.array([[0.5, 0.], [1.4, 1.6]]), order=0)
+    array([[ 1., 10.],
+           [ 9., 90.]])
+    """
+
+    if order not in (0, 1):
+        raise ValueError("Unsupported interpolation order: %s." % order)
+
+    dimension = array.ndim - 1
+    size = np.array(array.shape[:dimension][::-1])
+    values = array.reshape(-1, array.shape[-1])
+
+    # Offsets of the consecutive voxels along each axis of the flat array.
+    strides = np.cumprod(np.concatenate([[1], size[:-1]]))
+
+    indexes = np.asarray(indexes, dtype=np.float64)
+    output = np.empty((len(indexes), values.shape[1]))
+
+    for start in range(0, len(indexes), chunk_size):
+        chunk = indexes[start:start + chunk_size]
+
+        # Nearest neighbour rounds the halves up, as ITK does.
+        if order == 0:
+            nearest = np.clip(np.floor(chunk + 0.5), 0, size - 1)
+            output[start:start + chunk_size] = np.take(
+                values, np.dot(nearest.astype(np.int64), strides), axis=0)
+            continue
+
+        # The lower and the upper neighbours along each axis (as offsets in
+        # the flat array) together with their weights.
+        base = np.floor(chunk)
+        fraction = chunk - base
+        lower = np.clip(base, 0, size - 1).astype(np.int64) * strides
+        upper = np.clip(base + 1, 0, size - 1).astype(np.int64) * strides
+        neighbours = [[(lower[:, i], 1 - fraction[:, i]),
+                       (upper[:, i], fraction[:, i])]
+                      for i in range(dimension)]
+
+        # `np.take` gathers the rows considerably faster than the fancy
+        # indexing does.
+        result = output[start:start + chunk_size]
+        result.fill(0)
+        for corner in itertools.product(*neighbours):
+            offsets, weights = zip(*corner)
+            result += reduce(np.multiply, weights)[:, np.newaxis] * \
+                np.take(values, reduce(np.add, offsets), axis=0)
+
+    return output
+
+
+def sample_displacement_field(field, geometry, points):
+    """
+    Samples the displacement field at the provided physical points using
+    linear interpolation. Points outside of the field's domain get zero
+    displacement which is how the `itk.DisplacementFieldTransform` behaves.
+
+    :param field: Displacement field array as returned by
+        `itk.GetArrayFromImage`, i.e. shaped ([z,] y, x, components).
+    :type field: `numpy.ndarray`
+
+    :param geometry: Origin, spacing and direction of the field as returned by
+        :func:`get_image_geometry`.
+    :type geometry: tuple
+
+    :param points: Physical coordinates, one point per row.
+    :type points: `numpy.ndarray`
+
+    :return: Displacement vectors, one per row.
+    :rtype: `numpy.ndarray`
+
+    >>> field = np.zeros((3, 4, 2))
+    >>> field[..., 0] = np.arange(4)
+    >>> geometry = (np.zeros(2), np.ones(2), np.eye(2))
+    >>> sample_displacement_field(field, geometry,
+    ...     np.array([[1.5, 1.], [3.2, 0.], [10., 1.]]))
+    array([[1.5, 0. ],
+           [3. , 0. ],
+           [0. , 0. ]])
+    """
+
+    ndim = field.shape[-1]
+    indexes = physical_points_to_indexes(points, *geometry)
+
+    # The image interpolators in ITK operate on a buffer extended by half of
+    # a voxel in each direction. Outside of this region the points are left
+    # unmodified.
+    size = np.array(field.shape[:ndim][::-1])
+    inside = np.all((indexes >= -0.5) & (indexes < size - 0.5), axis=1)
+
+    displacement = interpolate_channels(field, indexes)
+    displacement[~inside] = 0
+
+    return displacement
+
+
+def transform_points_with_displacement_fields(points, fields):
+    """
+    Transforms the physical points through a chain of displacement fields.
+    The fields are applied in the order in which they are provided (the
+    ANTS convention).
+
+    :param points: Physical coordinates, one point per row.
+    :type points: `numpy.ndarray`
+
+    :param fields: Displacement fields to apply.
+    :type fields: list of `itk.Image`
+
+    :return: Transformed points.
+    :rtype: `numpy.ndarray`
+
+    >>> field = array_to_displacement_field(np.ones((3, 3, 2)),
+    ...     [0, 0], [1, 1], np.eye(2))
+    >>> transform_points_with_displacement_fields(
+    ...     np.array([[0., 0.], [1.6, 1.6]]), [field, field])
+    array([[2. , 2. ],
+           [2.6, 2.6]])
+    """
+
+    points = np.array(points, dtype=np.float64)
+    for field in fields:
+        points += sample_displacement_field(
+            itk.GetArrayFromImage(field), get_image_geometry(field), points)
+
+    return points
+
+
+def array_to_displacement_field(array, origin, spacing, direction):
+    """
+    Builds a float vector image out of the displacement field array.
+
+    :param array: Displacement field array shaped ([z,] y, x, components).
+    :type array: `numpy.ndarray`
+
+    :return: The displacement field image.
+    :rtype: `itk.Image` of `itk.Vector[itk.F, dim]`
+    """
+
+    field = itk.GetImageFromArray(
+        np.ascontiguousarray(array, dtype=np.float32), is_vector=True)
+    field.SetOrigin(map(float, origin))
+    field.SetSpacing(map(float, spacing))
+    field.SetDirection(itk.GetMatrixFromArray(np.asarray(direction, dtype=np.float64)))
+
+    return field
+
+
+def compose_displacement_fields(fields, reference_image, scaling=1.0,
+                                spacing=None):
+    """
+    Composes the provided displacement fields into a single displacement
+    field defined over the grid of the `reference_image`. The fields are
+    applied to the points in the order in which they are provided - the same
+    convention as used by ANTS `ComposeMultiTransform`. Optionally, the
+    resulting displacement vectors are multiplied by `scaling` and the output
+    spacing is replaced by `spacing` in the same pass.
+
+    :param fields: Displacement fields to compose.
+    :type fields: list of `itk.Image`
+
+    :param reference_image: Image defining the grid of the composed field.
+    :type reference_image: `itk.Image`
+
+    :param scaling: Factor the displacement vectors are multiplied by.
+    :type scaling: float
+
+    :param spacing: Spacing of the output field. If not provided, the spacing
+        of the reference image is used.
+    :type spacing: list of floats
+
+    :return: The composed displacement field.
+    :rtype: `itk.Image` of `itk.Vector[itk.F, dim]`
+
+    The composition should be the same as the one calculated by ITK itself
+    (note that `itk.CompositeTransform` applies the transformations in the
+    reverse order):
+
+    >>> from itertools import product
+    >>> reference = itk.Image[itk.F, 2].New()
+    >>> reference.SetRegions([12, 10])
+    >>> reference.Allocate()
+    >>> rows, cols = np.mgrid[0:10, 0:12]
+    >>> first = np.dstack([np.sin(rows / 3.), 0.5 * np.cos(cols / 4.)])
+    >>> second = np.dstack([0.3 * cols / 12., np.full(rows.shape, -0.7)])
+    >>> fields = [array_to_displacement_field(a, [0, 0], [1, 1], np.eye(2))
+    ...           for a in (first, second)]
+
+    >>> composed = compose_displacement_fields(fields, reference)
+    >>> map(int, composed.GetLargestPossibleRegion().GetSize())
+    [12, 10]
+
+    >>> composite = itk.CompositeTransform[itk.D, 2].New()
+    >>> for array in (second, first):
+    ...     field = itk.Image[itk.Vector[itk.D, 2], 2].New()
+    ...     field.SetRegions([12, 10])
+    ...     field.Allocate()
+    ...     for x, y in product(range(12), range(10)):
+    ...         field.SetPixel([x, y], map(float, array[y, x]))
+    ...     transform = itk.DisplacementFieldTransform[itk.D, 2].New()
+    ...     transform.SetDisplacementField(field)
+    ...     composite.AddTransform(transform)
+    >>> composed_array = itk.GetArrayFromImage(composed)
+    >>> all(np.allclose(
+    ...     np.array(composite.TransformPoint([x, y])) - [x, y],
+    ...     composed_array[y, x], atol=1e-5)
+    ...     for x, y in product(range(12), range(10)))
+    True
+
+    Rescaling the field in the same pass:
+
+    >>> rescaled = compose_displacement_fields(fields, reference,
+    ...     scaling=0.25, spacing=[0.25, 0.25])
+    >>> map(float, rescaled.GetSpacing())
+    [0.25, 0.25]
+    >>> np.allclose(itk.GetArrayFromImage(rescaled), 0.25 * composed_array)
+    True
+    """
+
+    dimension = reference_image.GetImageDimension()
+    origin, reference_spacing, direction = get_image_geometry(reference_image)
+    shape = tuple(reference_image.GetLargestPossibleRegion().GetSize())[::-1]
+
+    # Physical coordinates of all the voxels of the reference image.
+    indexes = np.indices(shape).reshape(dimension, -1)[::-1].T
+    grid = indexes_to_physical_points(indexes, origin, reference_spacing, direction)
+
+    points = transform_points_with_displacement_fields(grid, fields)
+    displacement = ((points - grid) * scaling).reshape(shape + (dimension,))
+
+    if spacing is None:
+        spacing = reference_spacing
+
+    return array_to_displacement_field(displacement, origin, spacing, direction)
+
+
+def itk_coordinate_map(input_image, physical=True, chunk_size=None):
     """
     Generates coordinate map. Lousy attempt to emulate a way better
     implementation from Convert3D:
     https://sourceforge.net/p/c3d/git/ci/master/tree/adapters/CoordinateMap.cxx
+
+    The coordinates are calculated with numpy for whole blocks of voxels at
+    once and written directly into the buffer of the output image.
+
+    :param input_image: Image defining the geometry of the coordinate map.
+    :type input_image: `itk.Image`
+
+    :param physical: Fill the map with the physical coordinates of the
+        voxels (`True`) or with the voxels' indexes (`False`).
+    :type physical: bool
+
+    :param chunk_size: Number of slices (along the last image axis)
+        processed at once. By default the whole image is processed in a
+        single step. Use smaller chunks to bound the memory usage when
+        processing huge volumes.
+    :type chunk_size: int
+
+    :return: Vector image holding the coordinates of each voxel.
+    :rtype: `itk.Image`
+
+    >>> image = itk.Image[itk.UC, 3].New()
+    >>> image.SetRegions([4, 3, 5])
+    >>> image.SetSpacing([0.5, 2.0, 1.5])
+    >>> image.SetOrigin([1.0, -2.0, 3.0])
+    >>> image.SetDirection(itk.GetMatrixFromArray(
+    ...     np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 1.]])))
+    >>> image.Allocate()
+
+    >>> coordinates = itk_coordinate_map(image, chunk_size=2)
+    >>> list(coordinates.GetPixel([3, 1, 4]))
+    [-1.0, -0.5, 9.0]
+    >>> list(image.TransformIndexToPhysicalPoint([3, 1, 4]))
+    [-1.0, -0.5, 9.0]
+
+    >>> indexes = itk_coordinate_map(image, physical=False)
+    >>> list(indexes.GetPixel([3, 1, 4]))
+    [3.0, 1.0, 4.0]
     """
     logger = possum.pos_itk_core.logging.getLogger('itk_coordinate_map')
 
@@ -366,36 +1217,53 @@ def itk_coordinate_map(input_image, physical=True):
     coordinate_map.Allocate()
 
     logger.debug("Finished creating the canvas image.")
-    logger.info("Filling out the image buffer with zeros.")
-    coordinate_map.FillBuffer([0.] * ndim)
-
-    # Yeap, we need a proper iterator to handle the iteration over the image
-    # This is a bit fancy as we do not assume any image dimensionality here.
-    # We want this method to be support any number of dimensions (as long as
-    # any is either 2 or 3 :))
 
-    from itertools import product
-    image_ranges = map(lambda x: range(image_shape[x]), range(ndim))
-    voxel_iterator = product(*image_ranges)
+    # The view shares the memory with the canvas image. Note that the numpy
+    # array has the axes in the reversed order: (z,) y, x, component.
+    coordinates = itk.GetArrayViewFromImage(coordinate_map)
 
     # Ok, now: there are two ways how the method can fill out the canvas image:
     # one method is to fill individual voxels with the actual coordinates.
     # The other option is to fill the canvas image with the indices of the
-    # voxels instead of the actual physical coordinates.
+    # voxels instead of the actual physical coordinates. Both are affine
+    # functions of the index: offset + matrix . index
     if physical:
         logger.info("Filling out the canvas with physical coordinates.")
-        for voxel in voxel_iterator:
-            point = coordinate_map.TransformIndexToPhysicalPoint(voxel)
-            coordinate_map.SetPixel(voxel, point)
+        origin, spacing, direction = get_image_geometry(input_image)
+        offset, matrix = origin, direction * spacing
     else:
         logger.info("Filling out the canvas with voxel indices.")
-        for voxel in voxel_iterator:
-            coordinate_map.SetPixel(voxel, voxel)
+        offset, matrix = np.zeros(ndim), np.eye(ndim)
+
+    # The affine function is separable, so the contribution of each index
+    # axis is calculated along that axis only and the contributions are
+    # summed by broadcasting. Each contribution has the shape of the numpy
+    # array with all the axes but one collapsed.
+    def axis_contribution(axis, start, stop):
+        shape = [1] * ndim + [ndim]
+        shape[ndim - 1 - axis] = stop - start
+        steps = np.arange(start, stop, dtype=np.float64)
+        return np.outer(steps, matrix[:, axis]).reshape(shape)
+
+    # The image is processed in chunks of slices along its last axis (which
+    # is the first axis of the numpy array).
+    slices = coordinates.shape[0]
+    chunk_size = chunk_size or slices
+
+    in_plane = sum(axis_contribution(axis, 0, image_shape[axis])
+                   for axis in range(ndim - 1)) + offset
+
+    for start in range(0, slices, chunk_size):
+        stop = min(start + chunk_size, slices)
+        logger.debug("Processing slices %d - %d.", start, stop - 1)
+        coordinates[start:stop] = \
+            in_plane + axis_contribution(ndim - 1, start, stop)
 
     return coordinate_map
 
 
 if __name__ == "__main__":
-    pass
+    import doctest
+    print doctest.testmod(verbose=True)
     #apply_transformation_workflow("0070.png", "x.nii.gz", "0070.nii.gz",
     #    ["x.txt", "d.nii.gz"])
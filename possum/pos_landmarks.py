@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+import logging
+
+import numpy as np
+import itk
+
+import possum.pos_itk_transforms
+
+"""
+Landmark based alignment of the sections carried out without calling any
+external tools. Landmarks are given as label images: each label (except the
+background, 0) denotes a single landmark and the centroid of the label is
+the landmark's location. Transformations for a number of sections are
+calculated at once and written as ITK text transformation files.
+"""
+
+
+def label_centroids(label_image):
+    """
+    Calculates the physical coordinates of the centroids of all the labels
+    present in the provided image. The background label (0) is ignored.
+
+    :param label_image: Labelled image
+    :type label_image: `itk.Image`
+
+    :return: Labels and the physical coordinates of their centroids (one
+        point per row).
+    :rtype: (`numpy.ndarray`, `numpy.ndarray`)
+
+    >>> image = itk.Image[itk.UC, 2].New()
+    >>> image.SetRegions([10, 8])
+    >>> image.SetSpacing([0.5, 2.0])
+    >>> image.SetOrigin([1.0, -1.0])
+    >>> image.Allocate()
+    >>> image.FillBuffer(0)
+    >>> image.SetPixel([2, 3], 5)
+    >>> image.SetPixel([4, 3], 5)
+    >>> image.SetPixel([7, 6], 2)
+    >>> labels, points = label_centroids(image)
+    >>> labels
+    array([2, 5])
+    >>> points
+    array([[ 4.5, 11. ],
+           [ 2.5,  5. ]])
+    """
+
+    labels_array = itk.GetArrayViewFromImage(label_image)
+    dimension = label_image.GetImageDimension()
+
+    # Only the labelled voxels are of interest. Their indexes are gathered
+    # and averaged for each label separately.
+    nonzero = np.nonzero(labels_array)
+    values = labels_array[nonzero].astype(np.int64)
+    labels = np.unique(values)
+
+    # Map the labels to consecutive integers so the sums can be computed
+    # with a single `bincount` per axis.
+    positions = np.searchsorted(labels, values)
+    counts = np.bincount(positions, minlength=len(labels)).astype(np.float64)
+
+    # Note that the numpy array has the axes in the (z,) y, x order while the
+    # itk indexes are in the x, y (, z) order.
+    indexes = np.column_stack(
+        [np.bincount(positions, weights=nonzero[axis], minlength=len(labels))
+         for axis in reversed(range(dimension))]) / counts[:, np.newaxis]
+
+    geometry = possum.pos_itk_transforms.get_image_geometry(label_image)
+    points = possum.pos_itk_transforms.indexes_to_physical_points(
+        indexes.reshape(-1, dimension), *geometry)
+
+    return labels, points
+
+
+def match_landmarks(fixed, moving):
+    """
+    Selects the landmarks present in both sets.
+
+    :param fixed: Labels and coordinates of the fixed landmarks as returned
+        by :func:`label_centroids`.
+    :type fixed: tuple
+
+    :param moving: Labels and coordinates of the moving landmarks.
+    :type moving: tuple
+
+    :return: Coordinates of the corresponding fixed and moving landmarks.
+    :rtype: (`numpy.ndarray`, `numpy.ndarray`)
+
+    >>> fixed = (np.array([1, 2, 4]), np.array([[0., 0.], [1., 1.], [2., 2.]]))
+    >>> moving = (np.array([2, 3, 4]), np.array([[5., 5.], [6., 6.], [7., 7.]]))
+    >>> match_landmarks(fixed, moving)
+    (array([[1., 1.],
+           [2., 2.]]), array([[5., 5.],
+           [7., 7.]]))
+    """
+
+    common = np.intersect1d(fixed[0], moving[0])
+    return (fixed[1][np.searchsorted(fixed[0], common)],
+            moving[1][np.searchsorted(moving[0], common)])
+
+
+def fit_landmark_transforms(fixed_sets, moving_sets, rigid=False):
+    """
+    Calculates the least squares transformations mapping the fixed landmarks
+    onto the moving landmarks (which is what the ITK transformations used for
+    reslicing do). All the sets are processed at once: the sets are padded
+    to the same length and the padded points get zero weight.
+
+    :param fixed_sets: Fixed landmarks, one array of points per section.
+    :type fixed_sets: list of `numpy.ndarray`
+
+    :param moving_sets: Corresponding moving landmarks.
+    :type moving_sets: list of `numpy.ndarray`
+
+    :param rigid: Calculate rigid transformations instead of affine ones.
+    :type rigid: bool
+
+    :return: Matrices and translations of the transformations.
+    :rtype: (`numpy.ndarray`, `numpy.ndarray`)
+
+    >>> fixed = np.array([[0., 0.], [10., 0.], [0., 5.], [4., 4.]])
+    >>> angle = np.radians(30)
+    >>> rotation = np.array([[np.cos(angle), -np.sin(angle)],
+    ...                      [np.sin(angle), np.cos(angle)]])
+    >>> affine = np.array([[1.2, 0.1], [-0.3, 0.8]])
+    >>> moving_rigid = np.dot(fixed, rotation.T) + [3., -2.]
+    >>> moving_affine = np.dot(fixed, affine.T) + [1., 1.]
+
+    >>> matrices, translations = fit_landmark_transforms(
+    ...     [fixed, fixed[:3]], [moving_affine, moving_affine[:3]])
+    >>> np.allclose(matrices, affine), np.allclose(translations, [1., 1.])
+    (True, True)
+
+    >>> matrices, translations = fit_landmark_transforms(
+    ...     [fixed, fixed[:2]], [moving_rigid, moving_rigid[:2]], rigid=True)
+    >>> np.allclose(matrices, rotation), np.allclose(translations, [3., -2.])
+    (True, True)
+    """
+
+    count = len(fixed_sets)
+    dimension = fixed_sets[0].shape[1]
+    max_points = max(map(len, fixed_sets))
+
+    fixed = np.zeros((count, max_points, dimension))
+    moving = np.zeros((count, max_points, dimension))
+    weights = np.zeros((count, max_points))
+
+    for i, (f, m) in enumerate(zip(fixed_sets, moving_sets)):
+        fixed[i, :len(f)] = f
+        moving[i, :len(m)] = m
+        weights[i, :len(f)] = 1
+
+    if rigid:
+        # Procrustes analysis (a.k.a. Kabsch algorithm), batched.
+        n = np.maximum(weights.sum(axis=1), 1)[:, np.newaxis]
+        fixed_centre = np.einsum('sn,snk->sk', weights, fixed) / n
+        moving_centre = np.einsum('sn,snk->sk', weights, moving) / n
+
+        covariance = np.einsum('sn,snk,snl->skl', weights,
+            fixed - fixed_centre[:, np.newaxis],
+            moving - moving_centre[:, np.newaxis])
+        u, sigma, vt = np.linalg.svd(covariance)
+
+        # Make sure the result is a proper rotation (and not a reflection).
+        correction = np.tile(np.eye(dimension), (count, 1, 1))
+        correction[:, -1, -1] = \
+            np.sign(np.linalg.det(np.einsum('skl,slm->skm', u, vt)))
+        correction[:, -1, -1][correction[:, -1, -1] == 0] = 1
+
+        matrices = np.einsum('slk,slm,snm->skn', vt, correction, u)
+        translations = moving_centre - \
+            np.einsum('skl,sl->sk', matrices, fixed_centre)
+    else:
+        # Weighted least squares in the homogeneous coordinates. The normal
+        # equations are solved for all the sections at once.
+        design = np.concatenate(
+            [fixed, np.ones((count, max_points, 1))], axis=2)
+        normal = np.einsum('snk,sn,snl->skl', design, weights, design)
+        rhs = np.einsum('snk,sn,snl->skl', design, weights, moving)
+        solution = np.einsum('skl,slm->skm', np.linalg.pinv(normal), rhs)
+
+        matrices = np.transpose(solution[:, :dimension, :], (0, 2, 1))
+        translations = solution[:, dimension, :]
+
+    return matrices, translations
+
+
+def landmark_transforms_from_files(landmark_pairs, output_filenames,
+                                   rigid=False):
+    """
+    Calculates the landmark based transformations for a number of sections
+    and stores them as ITK text transformation files.
+
+    :param landmark_pairs: Pairs of (fixed, moving) landmark image filenames.
+    :type landmark_pairs: list of (str, str)
+
+    :param output_filenames: Output transformation filenames, one for each
+        pair of the landmark images.
+    :type output_filenames: list of str
+
+    :param rigid: Calculate rigid transformations instead of affine ones.
+    :type rigid: bool
+    """
+
+    logger = logging.getLogger('landmark_transforms_from_files')
+
+    if not landmark_pairs:
+        return
+
+    fixed_sets, moving_sets = [], []
+    for fixed_filename, moving_filename in landmark_pairs:
+        logger.debug("Extracting landmarks: %s, %s.",
+                     fixed_filename, moving_filename)
+        fixed, moving = match_landmarks(
+            label_centroids(
+                possum.pos_itk_transforms.read_itk_image(fixed_filename)),
+            label_centroids(
+                possum.pos_itk_transforms.read_itk_image(moving_filename)))
+
+        if len(fixed) == 0:
+            logger.warning("No corresponding landmarks in %s and %s.",
+                           fixed_filename, moving_filename)
+            fixed = moving = np.zeros((0, 2))
+
+        fixed_sets.append(fixed)
+        moving_sets.append(moving)
+
+    logger.info("Calculating %d landmark based transformations.",
+                len(landmark_pairs))
+    matrices, translations = \
+        fit_landmark_transforms(fixed_sets, moving_sets, rigid)
+
+    # Sections without any landmarks get the identity transformation.
+    for i, fixed in enumerate(fixed_sets):
+        if len(fixed) == 0:
+            matrices[i] = np.eye(matrices.shape[1])
+            translations[i] = 0
+
+    for matrix, translation, filename in \
+            zip(matrices, translations, output_filenames):
+        dimension = len(translation)
+        possum.pos_itk_transforms.write_transformation_txt_file(
+            filename, list(matrix.ravel()) + list(translation),
+            [0] * dimension,
+            "MatrixOffsetTransformBase_double_%d_%d" % (dimension, dimension))
+
+
+if __name__ == '__main__':
+    import doctest
+    print doctest.testmod(verbose=True)
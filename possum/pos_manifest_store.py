@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import sqlite3
+
+from possum.pos_input_data_preprocessor import worksheet_manager, \
+    input_image, COLUMN_MAPPING
+
+"""
+An indexed (SQLite) store of the specimens' manifests: the settings of the
+specimens and the metadata of all their sections (the ones provided in the
+workbooks as well as the established ones such as the files' checksums,
+image sizes or padding). Contrary to the workbooks, individual sections can
+be updated and queried (e.g. by a range of slices) without reading and
+rewriting the whole manifest. The store imports the workbooks processed by
+the :class:`worksheet_manager` and exports the manifests back into the
+workbook layout.
+"""
+
+# Settings of the specimen as stored by the `worksheet_manager`.
+SPECIMEN_SETTINGS = ['stack_size', 'slice_thickness', 'slicing_plane',
+                     'use_atlas', 'atlas_plate_spacing', 'atlas_plate_size']
+
+# The section's attributes. All of them are stored in the sections table.
+SECTION_ATTRIBUTES = sorted(COLUMN_MAPPING)
+
+# The attributes holding more than a single value.
+_LIST_ATTRIBUTES = ['image_size', 'padded_size', 'offset']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS specimens (
+    specimen_id TEXT PRIMARY KEY,
+    settings TEXT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS sections (
+    specimen_id TEXT NOT NULL REFERENCES specimens(specimen_id),
+    image_index INTEGER NOT NULL,
+    position INTEGER,
+    %s,
+    PRIMARY KEY (specimen_id, image_index));
+""" % ",\n    ".join("%s %s" % (name, 'TEXT' if name in _LIST_ATTRIBUTES
+                                 else '') for name in SECTION_ATTRIBUTES
+                     if name != 'image_index')
+
+
+def _encode(attribute, value):
+    """
+    Converts the attribute's value into a value which can be stored in the
+    database.
+
+    >>> _encode('image_size', (1200, 800))
+    '[1200, 800]'
+    >>> _encode('horizontal_flip', True), _encode('image_name', None)
+    (1, None)
+    """
+
+    if value is None:
+        return None
+    if attribute in _LIST_ATTRIBUTES:
+        return json.dumps(list(value))
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _decode(attribute, value):
+    """
+    Converts the value read from the database back into the attribute's
+    value.
+
+    >>> _decode('image_size', u'[1200, 800]')
+    [1200, 800]
+    >>> _decode('horizontal_flip', 1), _decode('image_name', u'a.jpg')
+    (True, 'a.jpg')
+    """
+
+    if value is None:
+        return None
+    if attribute in _LIST_ATTRIBUTES:
+        return json.loads(value)
+    return COLUMN_MAPPING[attribute][1](value)
+
+
+class manifest_store(object):
+    """
+    The SQLite based manifest store.
+
+    >>> store = manifest_store()
+    >>> store.put_specimen('S1', {'stack_size': 3, 'slicing_plane': 'coronal'})
+    >>> for index in [1, 2, 3]:
+    ...     section = input_image()
+    ...     section.image_index = index
+    ...     section.image_name = '%04d.jpg' % index
+    ...     section.image_size = [100 * index, 50]
+    ...     store.put_section('S1', section, position=index - 1)
+
+    >>> store.specimens(), store.get_specimen('S1')['slicing_plane']
+    (['S1'], u'coronal')
+    >>> sorted(store.sections('S1', 2, 3))
+    [2, 3]
+    >>> store.get_section('S1', 3).image_size
+    [300, 50]
+
+    Individual attributes of a section can be updated:
+
+    >>> store.update_section('S1', 2, padded_size=[400, 100], rotation=90)
+    >>> section = store.get_section('S1', 2)
+    >>> section.padded_size, section.rotation, section.image_name
+    ([400, 100], 90, '0002.jpg')
+    >>> store.get_section('S1', 7) is None
+    True
+    """
+
+    def __init__(self, filename=':memory:'):
+        """
+        :param filename: The database file. By default, the store is kept in
+            the memory.
+        :type filename: str
+        """
+
+        self._connection = sqlite3.connect(filename)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def put_specimen(self, specimen_id, settings):
+        """
+        Store (or replace) the settings of the specimen.
+
+        :param specimen_id: Specimen identifier.
+        :type specimen_id: str
+
+        :param settings: Specimen's settings (see `SPECIMEN_SETTINGS`).
+        :type settings: dict
+        """
+
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO specimens VALUES (?, ?)",
+                (specimen_id, json.dumps(settings)))
+
+    def get_specimen(self, specimen_id):
+        """
+        :return: Settings of the specimen or None if there is no such
+            specimen.
+        :rtype: dict
+        """
+
+        row = self._connection.execute(
+            "SELECT settings FROM specimens WHERE specimen_id = ?",
+            (specimen_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def specimens(self):
+        """
+        :return: Identifiers of all the specimens in the store.
+        :rtype: list of str
+        """
+
+        return [str(row[0]) for row in self._connection.execute(
+            "SELECT specimen_id FROM specimens ORDER BY specimen_id")]
+
+    def put_section(self, specimen_id, section, position=None):
+        """
+        Store (or replace) a single section of the specimen.
+
+        :param section: The section.
+        :type section: :class:`input_image`
+
+        :param position: Position of the section within the workbook (the
+            section's row). Required to export the section to a workbook.
+        :type position: int
+        """
+
+        with self._connection:
+            self._put_section(specimen_id, section, position)
+
+    def _put_section(self, specimen_id, section, position):
+        values = [_encode(name, getattr(section, name))
+                  for name in SECTION_ATTRIBUTES]
+        self._connection.execute(
+            "INSERT OR REPLACE INTO sections "
+            "(specimen_id, position, %s) VALUES (?, ?, %s)" % (
+                ", ".join(SECTION_ATTRIBUTES),
+                ", ".join("?" * len(SECTION_ATTRIBUTES))),
+            [specimen_id, position] + values)
+
+    def update_section(self, specimen_id, image_index, **attributes):
+        """
+        Update the given attributes of a single section, leaving all the
+        other attributes intact.
+        """
+
+        for name in attributes:
+            if name not in SECTION_ATTRIBUTES or name == 'image_index':
+                raise KeyError(name)
+
+        names = sorted(attributes)
+        with self._connection:
+            self._connection.execute(
+                "UPDATE sections SET %s "
+                "WHERE specimen_id = ? AND image_index = ?" %
+                ", ".join("%s = ?" % name for name in names),
+                [_encode(name, attributes[name]) for name in names] +
+                [specimen_id, image_index])
+
+    def get_section(self, specimen_id, image_index):
+        """
+        :return: The section or None if there is no such section.
+        :rtype: :class:`input_image`
+        """
+
+        sections = self.sections(specimen_id, image_index, image_index)
+        return sections.get(image_index)
+
+    def sections(self, specimen_id, first=None, last=None):
+        """
+        Query the sections of the specimen, optionally only the sections
+        with the index within the provided (inclusive) range.
+
+        :return: Mapping between the sections' indexes and the sections.
+        :rtype: dict
+        """
+
+        return dict((section.image_index, section) for position, section
+                    in self._query_sections(specimen_id, first, last))
+
+    def _query_sections(self, specimen_id, first=None, last=None):
+        query = "SELECT position, %s FROM sections WHERE specimen_id = ?" % \
+            ", ".join(SECTION_ATTRIBUTES)
+        parameters = [specimen_id]
+
+        if first is not None:
+            query += " AND image_index >= ?"
+            parameters.append(first)
+        if last is not None:
+            query += " AND image_index <= ?"
+            parameters.append(last)
+
+        for row in self._connection.execute(
+                query + " ORDER BY image_index", parameters):
+            section = input_image()
+            for name, value in zip(SECTION_ATTRIBUTES, row[1:]):
+                setattr(section, name, _decode(name, value))
+            yield row[0], section
+
+    def store_worksheet(self, manager):
+        """
+        Store the specimen processed by the :class:`worksheet_manager` (its
+        settings and all its sections) in a single transaction. The specimen
+        already present in the store is replaced.
+
+        :param manager: Worksheet manager after loading the metadata.
+        :type manager: :class:`worksheet_manager`
+        """
+
+        settings = dict((name, getattr(manager, '_' + name, None))
+                        for name in SPECIMEN_SETTINGS)
+
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO specimens VALUES (?, ?)",
+                (manager._specimen_id, json.dumps(settings)))
+            self._connection.execute(
+                "DELETE FROM sections WHERE specimen_id = ?",
+                (manager._specimen_id,))
+            for position, (index, section) in \
+                    enumerate(sorted(manager._images.items())):
+                self._put_section(manager._specimen_id, section, position)
+
+    def import_workbook(self, workbook):
+        """
+        Import an already processed workbook. The established metadata
+        (checksums, sizes, padding) are read from the workbook, nothing is
+        recalculated.
+
+        :param workbook: Workbook filename.
+        :type workbook: str
+
+        :return: Identifier of the imported specimen.
+        :rtype: str
+        """
+
+        manager = worksheet_manager(workbook)
+        manager.load_settings_from_workbook()
+        manager.read_images_from_workbook()
+        self.store_worksheet(manager)
+        return manager._specimen_id
+
+    def export_workbook(self, specimen_id, workbook_in, workbook_out):
+        """
+        Export the sections of the specimen into the workbook layout. The
+        `workbook_in` provides the layout and the settings of the specimen
+        while the sections' metadata are taken from the store.
+
+        :param workbook_in: Template workbook.
+        :type workbook_in: str
+
+        :param workbook_out: Output workbook.
+        :type workbook_out: str
+
+        The workbook exported from the store carries the same specimen and
+        sections as the imported one:
+
+        >>> import os
+        >>> workbook = os.path.join(os.path.dirname(__file__), os.pardir,
+        ...     'test', 'test_preprocess_slices_simple',
+        ...     'brainmaps_s40_processed.xls')
+        >>> store = manifest_store()
+        >>> store.import_workbook(workbook)
+        's40'
+        >>> len(store.sections('s40')), store.get_section('s40', 1).image_name
+        (56, 's17.jpg')
+        >>> store.export_workbook('s40', workbook,
+        ...     '/tmp/pos_manifest_store_test.xls')
+
+        >>> other = manifest_store()
+        >>> other.import_workbook('/tmp/pos_manifest_store_test.xls')
+        's40'
+        >>> other.get_specimen('s40') == store.get_specimen('s40')
+        True
+        >>> sections = store.sections('s40')
+        >>> all(vars(section) == vars(sections[index]) for index, section
+        ...     in other.sections('s40').items())
+        True
+        >>> os.remove('/tmp/pos_manifest_store_test.xls')
+        """
+
+        manager = worksheet_manager(workbook_in, workbook_out)
+        manager.load_settings_from_workbook()
+
+        for position, section in self._query_sections(specimen_id):
+            manager._images[section.image_index] = section
+
+            for name in SECTION_ATTRIBUTES:
+                value = getattr(section, name)
+                if value is None:
+                    continue
+                if name == 'offset':
+                    value = "x".join(map(str, value))
+
+                # The switches are read from the workbook as the truth value
+                # of the cell, so the unset ones are left empty.
+                if isinstance(value, bool):
+                    value = 1 if value else ''
+                manager._write_to_workbook(name, position, value)
+
+        manager.save_workbook()
+
+
+if __name__ == "__main__":
+    import doctest
+    print doctest.testmod()
@@ -0,0 +1,597 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+import logging
+
+import numpy as np
+from scipy import ndimage
+import itk
+
+import possum.pos_itk_core
+import possum.pos_itk_transforms
+from possum.pos_itk_transforms import get_image_geometry, \
+    indexes_to_physical_points, physical_points_to_indexes
+
+"""
+In-process reslicing of two dimensional sections. The point of the module is
+to reslice many images (e.g. grayscale, color and any number of additional
+stacks, all the channels of each of them) with a single transformation while
+computing the coordinates of the resampling grid only once. The results are
+the same as the ones obtained with the Convert3D `-reslice-itk` command used
+by the reslice wrappers in :mod:`possum.pos_wrappers`.
+"""
+
+# Mapping between the Convert3D interpolation names and the order of the
+# spline interpolation used by `scipy.ndimage.map_coordinates`.
+interpolation_name_to_order = {
+    'nearest': 0,
+    'nearestneighbor': 0,
+    'linear': 1,
+    'cubic': 3,
+    'bspline': 3}
+
+
+def get_interpolation_order(interpolation):
+    """
+    Translates the Convert3D interpolation name into the spline order.
+    Linear interpolation is used when no interpolation is provided.
+    Interpolation schemes which do not have a spline equivalent (Gaussian
+    and Sinc) are replaced by the cubic interpolation.
+
+    :param interpolation: Name of the interpolation scheme (case insensitive).
+    :type interpolation: str
+
+    :rtype: int
+
+    >>> map(get_interpolation_order, [None, 'Nearest', 'linear', 'Cubic'])
+    [1, 0, 1, 3]
+    >>> get_interpolation_order('Sinc')
+    3
+    """
+
+    if interpolation is None:
+        return 1
+
+    try:
+        return interpolation_name_to_order[interpolation.lower()]
+    except KeyError:
+        logging.getLogger('get_interpolation_order').warning(
+            "Interpolation %s is not supported. Using cubic interpolation.",
+            interpolation)
+        return 3
+
+
+def load_affine_transformation(filename):
+    """
+    Loads the ITK text matrix transformation and converts it into
+    a matrix and an offset such that `y = matrix * x + offset`.
+
+    :param filename: The ITK transformation file.
+    :type filename: str
+
+    :return: The matrix and the offset of the transformation.
+    :rtype: (`numpy.ndarray`, `numpy.ndarray`)
+
+    >>> possum.pos_itk_transforms.write_transformation_txt_file(
+    ...     '/tmp/pos_reslice_test.txt', [0, -1, 1, 0, 1, 2], [10, 0])
+    >>> matrix, offset = load_affine_transformation('/tmp/pos_reslice_test.txt')
+    >>> matrix
+    array([[ 0., -1.],
+           [ 1.,  0.]])
+    >>> list(offset)
+    [11.0, -8.0]
+    """
+
+    transformation = \
+        possum.pos_itk_transforms.read_transformation_txt_file(filename)
+    center = np.array(transformation['fixed_parameters'])
+    dimension = len(center)
+
+    parameters = np.array(transformation['parameters'])
+    matrix = parameters[:dimension ** 2].reshape(dimension, dimension)
+    translation = parameters[dimension ** 2:dimension ** 2 + dimension]
+
+    # That's how the ITK's MatrixOffsetTransformBase computes its offset.
+    offset = translation + center - np.dot(matrix, center)
+
+    return matrix, offset
+
+
+def load_point_transformation(filename, invert=False):
+    """
+    Loads a transformation (either an ITK affine transformation or
+    a displacement field) as a function transforming arrays of physical
+    points. The transformation file is read only once, so the function may
+    be applied to many batches of points.
+
+    :param filename: The ITK affine transformation (`.txt`) or the
+        displacement field (`.nii.gz`) file.
+    :type filename: str
+
+    :param invert: Use the inverse of the transformation. Only the affine
+        transformations can be inverted.
+    :type invert: bool
+
+    :return: Function mapping (n, dimension) arrays of physical points.
+    :rtype: callable
+
+    >>> possum.pos_itk_transforms.write_transformation_txt_file(
+    ...     '/tmp/pos_reslice_test.txt', [0, -1, 1, 0, 1, 2], [10, 0])
+    >>> forward = load_point_transformation('/tmp/pos_reslice_test.txt')
+    >>> inverse = load_point_transformation('/tmp/pos_reslice_test.txt', True)
+    >>> forward(np.array([[1., 1.]]))
+    array([[10., -7.]])
+    >>> inverse(forward(np.array([[1., 1.]])))
+    array([[1., 1.]])
+    """
+
+    if filename.endswith(".txt"):
+        matrix, offset = load_affine_transformation(filename)
+        if invert:
+            matrix = np.linalg.inv(matrix)
+            offset = -np.dot(matrix, offset)
+        return lambda points: np.dot(points, matrix.T) + offset
+
+    if invert:
+        raise ValueError(
+            "Displacement field %s cannot be inverted." % filename)
+
+    field = possum.pos_itk_transforms.read_itk_image(filename)
+    array, geometry = itk.GetArrayFromImage(field), get_image_geometry(field)
+    return lambda points: points + possum.pos_itk_transforms.\
+        sample_displacement_field(array, geometry, points)
+
+
+def transform_points(points, transformations):
+    """
+    Pushes the physical points through a chain of transformations (see
+    :func:`load_point_transformation`). The transformations are given in the
+    order used by :func:`possum.pos_itk_transforms.reslice_image` (and
+    `itk.CompositeTransform`): the last transformation is applied first.
+
+    :param points: Physical coordinates, one point per row.
+    :type points: `numpy.ndarray`
+
+    :param transformations: Transformations to apply.
+    :type transformations: list of callables
+
+    :return: Transformed points.
+    :rtype: `numpy.ndarray`
+
+    >>> shift = lambda points: points + [1, 0]
+    >>> scale = lambda points: points * 2
+    >>> transform_points(np.array([[1., 1.]]), [shift, scale])
+    array([[3., 2.]])
+    """
+
+    points = np.array(points, dtype=np.float64)
+    for transformation in reversed(transformations):
+        points = transformation(points)
+
+    return points
+
+
+def transform_section_points(points, geometry, slicing_axis,
+                             section_transformations, sections_number,
+                             offset=0):
+    """
+    Pushes the physical points located in a stack of sections through the
+    two dimensional transformations of the sections the points belong to.
+    Each point belongs to the section closest to it along the slicing axis.
+    The points are processed section by section: the transformations of
+    a section are obtained once and applied to all its points at once.
+
+    The in-plane coordinates are expressed exactly as in the sections
+    extracted from the stack with the direction collapsed to identity, while
+    the coordinate along the slicing axis is left intact. Points located
+    outside of the stack get `nan` coordinates.
+
+    :param points: Physical coordinates in the stack's space, one point per
+        row.
+    :type points: `numpy.ndarray`
+
+    :param geometry: Origin, spacing and direction of the stack.
+    :type geometry: tuple
+
+    :param slicing_axis: Index of the slicing axis (x, y, z order).
+    :type slicing_axis: int
+
+    :param section_transformations: Function returning the transformations
+        (see :func:`transform_points`) of the section with the given index.
+    :type section_transformations: callable
+
+    :param sections_number: Number of sections in the stack.
+    :type sections_number: int
+
+    :param offset: Index of the first section.
+    :type offset: int
+
+    :return: Transformed points.
+    :rtype: `numpy.ndarray`
+
+    >>> geometry = (np.array([0., 0., 0.]), np.array([1., 2., 1.]), np.eye(3))
+    >>> chains = {1: [lambda points: points + [1, 0]],
+    ...           2: [lambda points: points * 2]}
+    >>> transform_section_points(
+    ...     np.array([[1., 0.1, 1.], [1., 2.2, 3.], [5., 9., 0.]]),
+    ...     geometry, 1, chains.get, 2, offset=1)
+    array([[2. , 0.1, 1. ],
+           [2. , 2.2, 6. ],
+           [nan, nan, nan]])
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    indexes = physical_points_to_indexes(points, *geometry)
+
+    in_plane = [i for i in range(3) if i != slicing_axis]
+    section_geometry = \
+        (geometry[0][in_plane], geometry[1][in_plane], np.eye(2))
+
+    # Nearest plane rounds the halves up, as ITK does.
+    planes = np.floor(indexes[:, slicing_axis] + 0.5).astype(np.int64)
+    inside = (planes >= 0) & (planes < sections_number)
+
+    output = np.full(points.shape, np.nan)
+    for plane in np.unique(planes[inside]):
+        selected = planes == plane
+        section_points = indexes_to_physical_points(
+            indexes[selected][:, in_plane], *section_geometry)
+        section_points = transform_points(
+            section_points, section_transformations(plane + offset))
+
+        plane_indexes = indexes[selected]
+        plane_indexes[:, in_plane] = physical_points_to_indexes(
+            section_points, *section_geometry)
+        output[selected] = indexes_to_physical_points(plane_indexes, *geometry)
+
+    return output
+
+
+def reference_grid(reference_image, region_origin=None, region_size=None):
+    """
+    Computes the physical coordinates of the voxels of the reference image or
+    of its region of interest.
+
+    :param reference_image: The reference image.
+    :type reference_image: `itk.Image`
+
+    :param region_origin: Index of the first voxel of the region of
+        interest. The whole image is used when not provided.
+    :type region_origin: list of ints
+
+    :param region_size: Size of the region of interest.
+    :type region_size: list of ints
+
+    :return: Physical coordinates of the voxels (one point per row), the
+        shape of the output array and the geometry (origin, spacing,
+        direction) of the output image.
+    :rtype: tuple
+
+    >>> image = itk.Image[itk.UC, 2].New()
+    >>> image.SetRegions([4, 3])
+    >>> image.SetSpacing([2., 1.])
+    >>> points, shape, geometry = reference_grid(image, [1, 1], [2, 1])
+    >>> points
+    array([[2., 1.],
+           [4., 1.]])
+    >>> shape, geometry[0]
+    ((1, 2), array([2., 1.]))
+    """
+
+    origin, spacing, direction = get_image_geometry(reference_image)
+    dimension = len(origin)
+
+    if region_origin is None:
+        region_origin = [0] * dimension
+        region_size = map(int, reference_image.GetLargestPossibleRegion().GetSize())
+
+    # The output array is shaped ([z,] y, x) while the indexes are (x, y[, z])
+    shape = tuple(region_size[::-1])
+    indexes = np.indices(shape).reshape(dimension, -1)[::-1].T + region_origin
+    points = indexes_to_physical_points(indexes, origin, spacing, direction)
+
+    # The region of interest keeps its physical location, so the origin of
+    # the output image has to be moved.
+    output_origin = indexes_to_physical_points(
+        np.array([region_origin]), origin, spacing, direction)[0]
+
+    return points, shape, (output_origin, spacing, direction)
+
+
+def resample_array(array, indexes, order=1, background=0):
+    """
+    Samples the (single channel) array at the provided continuous indexes.
+    Samples outside of the image get the background value. Works like the
+    `itk.ResampleImageFilter`: points up to half of a voxel outside of the
+    image are still interpolated.
+
+    :param array: Image data shaped ([z,] y, x).
+    :type array: `numpy.ndarray`
+
+    :param indexes: Continuous indexes (x, y[, z]), one point per row.
+    :type indexes: `numpy.ndarray`
+
+    :param order: Spline interpolation order.
+    :type order: int
+
+    :param background: Value assigned to the points outside of the image.
+    :type background: float
+
+    :return: Sampled values.
+    :rtype: `numpy.ndarray`
+
+    >>> array = np.arange(12, dtype=np.float64).reshape(3, 4)
+    >>> resample_array(array, np.array([[0.5, 0.], [3.2, 2.], [1., 4.]]),
+    ...                background=-1)
+    array([ 0.5, 11. , -1. ])
+    """
+
+    size = np.array(array.shape[::-1])
+    inside = np.all((indexes >= -0.5) & (indexes < size - 0.5), axis=1)
+
+    values = ndimage.map_coordinates(
+        np.asarray(array, dtype=np.float64), indexes[:, ::-1].T,
+        order=order, mode='nearest')
+    values[~inside] = background
+
+    return values
+
+
+def resample_channels(array, indexes, order=1, background=0):
+    """
+    Samples all the channels of the array at the provided continuous indexes
+    (see :func:`resample_array`). For the nearest neighbour and the linear
+    interpolation the interpolation weights are computed only once for all
+    the channels (see
+    :func:`possum.pos_itk_transforms.interpolate_channels`), higher order
+    splines are computed channel by channel.
+
+    :param array: Multichannel image data shaped ([z,] y, x, channels).
+    :type array: `numpy.ndarray`
+
+    :return: Sampled values, one point per row, one channel per column.
+    :rtype: `numpy.ndarray`
+
+    >>> array = np.dstack([np.arange(12.).reshape(3, 4),
+    ...                    10 * np.arange(12.).reshape(3, 4)])
+    >>> indexes = np.array([[0.5, 0.], [3.2, 2.], [1., 4.]])
+    >>> resample_channels(array, indexes, background=-1)
+    array([[  0.5,   5. ],
+           [ 11. , 110. ],
+           [ -1. ,  -1. ]])
+    >>> np.allclose(resample_channels(array, indexes, order=3),
+    ...     np.column_stack([resample_array(array[..., c], indexes, order=3)
+    ...                      for c in range(2)]))
+    True
+    """
+
+    if order > 1:
+        return np.column_stack(
+            [resample_array(array[..., c], indexes, order, background)
+             for c in range(array.shape[-1])])
+
+    size = np.array(array.shape[:-1][::-1])
+    inside = np.all((indexes >= -0.5) & (indexes < size - 0.5), axis=1)
+
+    values = possum.pos_itk_transforms.interpolate_channels(
+        array, indexes, order)
+    values[~inside] = background
+
+    return values
+
+
+def read_section(filename, multichannel=False):
+    """
+    Reads the section into a numpy array. Multichannel images are returned
+    as ([z,] y, x, channels) arrays. When a multichannel image is read as
+    a grayscale one, it is converted to the luminance by ITK (which is how
+    Convert3D reads such images).
+
+    :param filename: Section to read.
+    :type filename: str
+
+    :param multichannel: Read all the image's channels.
+    :type multichannel: bool
+
+    :return: The image data and the image's geometry.
+    :rtype: (`numpy.ndarray`, tuple)
+    """
+
+    if multichannel:
+        image = possum.pos_itk_transforms.read_itk_image(filename)
+    else:
+        image_type = possum.pos_itk_core.autodetect_file_type(filename)
+        dimension = image_type.GetImageDimension()
+        reader = itk.ImageFileReader[itk.Image[itk.F, dimension]].New()
+        reader.SetFileName(filename)
+        reader.Update()
+        image = reader.GetOutput()
+
+    return itk.GetArrayFromImage(image), get_image_geometry(image)
+
+
+def reslice_section(transformation_file, reference_filename, items,
+                    region_origin=None, region_size=None):
+    """
+    Reslices a number of images of a single section with the same affine
+    transformation. The transformation is read once, the resampling grid is
+    calculated once and the transformed coordinates are calculated only once
+    for each distinct moving image geometry.
+
+    :param transformation_file: The ITK affine transformation file.
+    :type transformation_file: str
+
+    :param reference_filename: The reference image.
+    :type reference_filename: str
+
+    :param items: Images to reslice. Each item is a dictionary with the
+        following keys: `moving` (filename of the image to reslice), `output`
+        (output filename), `multichannel` (bool), `interpolation` (Convert3D
+        interpolation name or None), `background` (float or None) and `invert`
+        (bool, whether the resliced image is inverted: 255 - value).
+    :type items: list of dicts
+
+    :param region_origin: Region of interest origin (see
+        :func:`reference_grid`).
+    :type region_origin: list of ints
+
+    :param region_size: Region of interest size.
+    :type region_size: list of ints
+    """
+
+    logger = logging.getLogger('reslice_section')
+    logger.debug("Reslicing %d images with %s.", len(items), transformation_file)
+
+    matrix, offset = load_affine_transformation(transformation_file)
+    reference_image = possum.pos_itk_transforms.read_itk_image(reference_filename)
+
+    points, shape, geometry = \
+        reference_grid(reference_image, region_origin, region_size)
+    moving_points = np.dot(points, matrix.T) + offset
+
+    resample_items(moving_points, shape, geometry, items)
+
+
+def resample_items(moving_points, shape, geometry, items, output_type='uchar'):
+    """
+    Resamples the images listed in `items` at the provided (already
+    transformed) physical points and stores the results. The continuous
+    indexes of the points are calculated once for each distinct moving image
+    geometry and shared by all the images and all their channels.
+
+    :param moving_points: Physical coordinates in the moving images' space,
+        one point per row, corresponding to the voxels of the output images.
+    :type moving_points: `numpy.ndarray`
+
+    :param shape: Shape of the output arrays.
+    :type shape: tuple
+
+    :param geometry: Origin, spacing and direction of the output images.
+    :type geometry: tuple
+
+    :param items: Images to resample (see :func:`reslice_section`).
+    :type items: list of dicts
+
+    :param output_type: Either 'uchar' (the values are rounded and clipped
+        to the 0-255 range, as done by the Convert3D reslice wrappers) or
+        'float' (the values are stored as they are, like ANTS does).
+    :type output_type: str
+    """
+
+    moving_indexes = {}
+
+    for item in items:
+        array, moving_geometry = \
+            read_section(item['moving'], item.get('multichannel', False))
+
+        key = tuple(np.concatenate(map(np.ravel, moving_geometry)))
+        if key not in moving_indexes:
+            moving_indexes[key] = \
+                physical_points_to_indexes(moving_points, *moving_geometry)
+        indexes = moving_indexes[key]
+
+        order = get_interpolation_order(item.get('interpolation'))
+        background = item.get('background') or 0
+
+        if array.ndim > len(shape):
+            channels = [array[..., c] for c in range(array.shape[-1])]
+        else:
+            channels = [array]
+
+        resliced = [resample_array(channel, indexes, order, background)
+                    for channel in channels]
+
+        if item.get('invert'):
+            resliced = map(lambda x: 255 - x, resliced)
+
+        resliced = np.column_stack(resliced)
+        if output_type == 'uchar':
+            resliced = np.clip(np.round(resliced), 0, 255).astype(np.uint8)
+        else:
+            resliced = resliced.astype(np.float32)
+        resliced = resliced.reshape(shape + (len(channels),))
+
+        if len(channels) > 1:
+            output = itk.GetImageFromArray(resliced, is_vector=True)
+        else:
+            output = itk.GetImageFromArray(resliced[..., 0])
+
+        output.SetOrigin(map(float, geometry[0]))
+        output.SetSpacing(map(float, geometry[1]))
+        output.SetDirection(itk.GetMatrixFromArray(geometry[2]))
+        possum.pos_itk_transforms.write_itk_image(output, item['output'])
+
+
+def warp_section(field_files, reference_filename, items):
+    """
+    Warps a number of images of a single section with the same chain of
+    displacement fields. Each displacement field is read and interpolated
+    only once, regardless of the number of images (and their channels) to
+    warp. The fields are applied like in the ANTS `WarpImageMultiTransform`
+    (the first field is applied first) and the results are stored as float
+    images.
+
+    :param field_files: Displacement field filenames.
+    :type field_files: list of str
+
+    :param reference_filename: The reference image defining the output grid.
+    :type reference_filename: str
+
+    :param items: Images to warp (see :func:`reslice_section`). Use the
+        'bspline', 'linear' and 'nearest' interpolation names.
+    :type items: list of dicts
+
+    >>> from possum.pos_itk_transforms import array_to_displacement_field
+    >>> image = itk.GetImageFromArray(np.arange(20, dtype=np.float32).reshape(4, 5))
+    >>> possum.pos_itk_transforms.write_itk_image(image, '/tmp/pos_reslice_test.nii.gz')
+    >>> shift = np.zeros((4, 5, 2))
+    >>> shift[..., 0] = 1.0
+    >>> for i in range(2):
+    ...     possum.pos_itk_transforms.write_itk_image(
+    ...         array_to_displacement_field(shift, [0, 0], [1, 1], np.eye(2)),
+    ...         '/tmp/pos_reslice_test_warp_%d.nii.gz' % i)
+    >>> warp_section(['/tmp/pos_reslice_test_warp_0.nii.gz',
+    ...               '/tmp/pos_reslice_test_warp_1.nii.gz'],
+    ...     '/tmp/pos_reslice_test.nii.gz',
+    ...     [{'moving': '/tmp/pos_reslice_test.nii.gz',
+    ...       'output': '/tmp/pos_reslice_test_linear.nii.gz'},
+    ...      {'moving': '/tmp/pos_reslice_test.nii.gz',
+    ...       'output': '/tmp/pos_reslice_test_nn.nii.gz',
+    ...       'interpolation': 'nearest'}])
+    >>> itk.GetArrayFromImage(possum.pos_itk_transforms.read_itk_image(
+    ...     '/tmp/pos_reslice_test_nn.nii.gz'))[1].tolist()
+    [7.0, 8.0, 9.0, 0.0, 0.0]
+    """
+
+    logger = logging.getLogger('warp_section')
+    logger.debug("Warping %d images with %d displacement fields.",
+                 len(items), len(field_files))
+
+    reference_image = possum.pos_itk_transforms.read_itk_image(reference_filename)
+    points, shape, geometry = reference_grid(reference_image)
+
+    fields = map(possum.pos_itk_transforms.read_itk_image, field_files)
+    moving_points = possum.pos_itk_transforms.\
+        transform_points_with_displacement_fields(points, fields)
+
+    resample_items(moving_points, shape, geometry, items, output_type='float')
+
+
+def reslice_section_job(job):
+    """
+    A :func:`reslice_section` wrapper accepting a single tuple of arguments.
+    Useful with `multiprocessing.Pool.map`.
+    """
+    return reslice_section(*job)
+
+
+def warp_section_job(job):
+    """
+    A :func:`warp_section` wrapper accepting a single tuple of arguments.
+    """
+    return warp_section(*job)
+
+
+if __name__ == '__main__':
+    import doctest
+    print doctest.testmod(verbose=True)
@@ -0,0 +1,363 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+import os
+import logging
+
+import numpy as np
+import itk
+
+import possum.pos_itk_transforms
+
+"""
+A stack of two dimensional sections kept in a single, uncompressed, memory
+mapped three dimensional array. The store is meant to replace the
+'write every section as a separate gzipped file and then restack them'
+routine which takes place after each iteration of the deformable
+reconstruction workflow.
+"""
+
+# Mapping between numpy data types and the MetaImage element types. The
+# mapping is used to write a header which allows the raw slice store file to
+# be read directly by ITK and Convert3D.
+numpy_type_to_meta_element_type = {
+    np.dtype(np.uint8): 'MET_UCHAR',
+    np.dtype(np.int8): 'MET_CHAR',
+    np.dtype(np.uint16): 'MET_USHORT',
+    np.dtype(np.int16): 'MET_SHORT',
+    np.dtype(np.uint32): 'MET_UINT',
+    np.dtype(np.int32): 'MET_INT',
+    np.dtype(np.float32): 'MET_FLOAT',
+    np.dtype(np.float64): 'MET_DOUBLE',
+    }
+
+meta_element_type_to_numpy_type = \
+    dict((v, k) for k, v in numpy_type_to_meta_element_type.items())
+
+
+class slice_store(object):
+    """
+    A stack of equally sized sections stored in a single raw file and mapped
+    into the memory. Sections are accessed by their index (the same index
+    that is used to name the section files, e.g. `0042.nii.gz`) and each of
+    them is a view into the underlying array, so no copy is made when a
+    section is read or modified.
+
+    The array is stored in the (section, row, column) order which is exactly
+    the order in which ITK lays out the voxels of a three dimensional image.
+    Thus the raw file can be read as a volume without any reordering.
+
+    >>> store = slice_store('/tmp/pos_slice_store_test.raw', (3, 4),
+    ...                     range(10, 15), dtype=np.uint8)
+    >>> len(store)
+    5
+    >>> store.indexes
+    [10, 11, 12, 13, 14]
+    >>> store.shape
+    (5, 3, 4)
+    >>> store[12].shape
+    (3, 4)
+
+    Sections are views, so modifying a section modifies the store:
+
+    >>> section = store[12]
+    >>> section[1, 2] = 7
+    >>> int(store.array[2, 1, 2])
+    7
+    >>> store[14] = 3
+    >>> int(store[14].sum())
+    36
+
+    Referring to a section outside of the stack raises an error:
+
+    >>> store[9]
+    Traceback (most recent call last):
+    IndexError: Section 9 is not in the store (10 - 14).
+
+    The store can be described by a MetaImage header. The header does not
+    duplicate the data - it simply points to the raw file:
+
+    >>> header = store.write_header('/tmp/pos_slice_store_test.mhd',
+    ...     spacing=(0.5, 0.5, 2.0))
+    >>> print open(header).read() #doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+    ObjectType = Image
+    NDims = 3
+    BinaryData = True
+    BinaryDataByteOrderMSB = False
+    CompressedData = False
+    Offset = 0.0 0.0 0.0
+    ElementSpacing = 0.5 0.5 2.0
+    DimSize = 4 3 5
+    ElementType = MET_UCHAR
+    ElementDataFile = pos_slice_store_test.raw
+
+    An existing store can be opened using the header:
+
+    >>> store.flush()
+    >>> other = slice_store.from_header('/tmp/pos_slice_store_test.mhd',
+    ...     start_index=10)
+    >>> int(other[12][1, 2]), other.shape, other.spacing
+    (7, (5, 3, 4), (0.5, 0.5, 2.0))
+
+    The store can also be exported to any image format supported by ITK:
+
+    >>> store.export('/tmp/pos_slice_store_test.nii.gz')
+    '/tmp/pos_slice_store_test.nii.gz'
+    >>> volume = possum.pos_itk_transforms.read_itk_image(
+    ...     '/tmp/pos_slice_store_test.nii.gz')
+    >>> map(int, volume.GetLargestPossibleRegion().GetSize())
+    [4, 3, 5]
+    >>> map(float, volume.GetSpacing())
+    [0.5, 0.5, 2.0]
+    >>> volume.GetPixel([2, 1, 2])
+    7
+
+    >>> del store, other, section
+    >>> for ext in ['raw', 'mhd', 'nii.gz']:
+    ...     os.remove('/tmp/pos_slice_store_test.' + ext)
+    """
+
+    def __init__(self, filename, slice_shape, indexes, dtype=np.float32,
+                 spacing=(1., 1., 1.), origin=(0., 0., 0.), mode='w+'):
+        """
+        :param filename: Name of the raw file backing the store.
+        :type filename: str
+
+        :param slice_shape: Shape of a single section as (rows, columns) or
+            (rows, columns, components) for multichannel sections.
+        :type slice_shape: (int, int)
+
+        :param indexes: Indexes of the sections held by the store. The indexes
+            have to be consecutive.
+        :type indexes: list of ints
+
+        :param dtype: Data type of the stored sections.
+        :type dtype: `numpy.dtype`
+
+        :param spacing: Spacing of the volume (x, y, z) used when the store is
+            exported.
+        :type spacing: (float, float, float)
+
+        :param origin: Origin of the volume (x, y, z) used when the store is
+            exported.
+        :type origin: (float, float, float)
+
+        :param mode: File mode passed to `numpy.memmap`. Use 'w+' to create a
+            new store and 'r' or 'r+' to open an existing one.
+        :type mode: str
+        """
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.filename = filename
+        self.indexes = list(indexes)
+        self.spacing = tuple(map(float, spacing))
+        self.origin = tuple(map(float, origin))
+        self._start = self.indexes[0]
+
+        shape = (len(self.indexes),) + tuple(map(int, slice_shape))
+
+        self._logger.debug("Mapping slice store %s, shape: %s, type: %s.",
+                           filename, str(shape), np.dtype(dtype).name)
+        self.array = np.memmap(filename, dtype=dtype, mode=mode, shape=shape)
+
+    @classmethod
+    def from_header(cls, header_filename, start_index=0, mode='r'):
+        """
+        Open an existing store described by the MetaImage header written by
+        the :meth:`write_header` method.
+
+        :param header_filename: The MetaImage header filename.
+        :type header_filename: str
+
+        :param start_index: Index of the first section in the store.
+        :type start_index: int
+
+        :param mode: File mode passed to `numpy.memmap`.
+        :type mode: str
+
+        :return: The slice store.
+        :rtype: :class:`slice_store`
+        """
+
+        header = {}
+        for line in open(header_filename):
+            if "=" in line:
+                key, value = map(str.strip, line.split("=", 1))
+                header[key] = value
+
+        columns, rows, sections = map(int, header['DimSize'].split())
+        raw_filename = os.path.join(os.path.dirname(header_filename),
+                                    header['ElementDataFile'])
+
+        return cls(raw_filename, (rows, columns),
+                   range(start_index, start_index + sections),
+                   dtype=meta_element_type_to_numpy_type[header['ElementType']],
+                   spacing=map(float, header['ElementSpacing'].split()),
+                   origin=map(float, header['Offset'].split()),
+                   mode=mode)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def _position(self, index):
+        position = index - self._start
+        if not 0 <= position < len(self.indexes):
+            raise IndexError("Section %d is not in the store (%d - %d)." %
+                             (index, self.indexes[0], self.indexes[-1]))
+        return position
+
+    def __getitem__(self, index):
+        return self.array[self._position(index)]
+
+    def __setitem__(self, index, section):
+        self.array[self._position(index)] = section
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def flush(self):
+        """
+        Write any changes of the memory mapped array to the disk.
+        """
+        self.array.flush()
+
+    def load_section(self, index, filename):
+        """
+        Read the two dimensional image `filename` and put it into the store as
+        the section `index`.
+
+        :param index: Index of the section.
+        :type index: int
+
+        :param filename: Image to read.
+        :type filename: str
+        """
+
+        self._logger.debug("Loading section %d from %s.", index, filename)
+        image = possum.pos_itk_transforms.read_itk_image(filename)
+        self[index] = itk.GetArrayViewFromImage(image)
+
+    def write_header(self, header_filename, spacing=None, origin=None,
+                     direction=None):
+        """
+        Write a MetaImage header pointing to the raw file of the store. The
+        header allows the store to be opened as a regular three dimensional
+        image by any ITK-based tool without copying the data.
+
+        :param header_filename: Output header filename (.mhd).
+        :type header_filename: str
+
+        :param spacing: Volume spacing. If not provided, the store's spacing
+            is used.
+        :type spacing: (float, float, float)
+
+        :param origin: Volume origin. If not provided, the store's origin is
+            used.
+        :type origin: (float, float, float)
+
+        :param direction: Direction matrix of the volume. The direction is
+            written only when provided.
+        :type direction: `numpy.ndarray`
+
+        :return: The header filename.
+        :rtype: str
+
+        >>> store = slice_store('/tmp/pos_slice_store_test.raw', (3, 4, 3),
+        ...                     range(2), dtype=np.float32)
+        >>> print open(store.write_header('/tmp/pos_slice_store_test.mhd',
+        ...     direction=np.array([[1, 0, 0], [0, 0, 1], [0, -1, 0]]))).read()
+        ... #doctest: +NORMALIZE_WHITESPACE
+        ObjectType = Image
+        NDims = 3
+        BinaryData = True
+        BinaryDataByteOrderMSB = False
+        CompressedData = False
+        TransformMatrix = 1 0 0 0 0 -1 0 1 0
+        Offset = 0.0 0.0 0.0
+        ElementSpacing = 1.0 1.0 1.0
+        DimSize = 4 3 2
+        ElementNumberOfChannels = 3
+        ElementType = MET_FLOAT
+        ElementDataFile = pos_slice_store_test.raw
+
+        >>> del store
+        >>> for ext in ['raw', 'mhd']:
+        ...     os.remove('/tmp/pos_slice_store_test.' + ext)
+        """
+
+        if spacing is not None:
+            self.spacing = tuple(map(float, spacing))
+        if origin is not None:
+            self.origin = tuple(map(float, origin))
+
+        sections, rows, columns = self.shape[:3]
+        components = self.shape[3] if len(self.shape) > 3 else 1
+        element_type = numpy_type_to_meta_element_type[self.array.dtype]
+
+        # The header has to be placed in the same directory as the raw file
+        # because the raw file is referred to with a relative path.
+        header = [
+            "ObjectType = Image",
+            "NDims = 3",
+            "BinaryData = True",
+            "BinaryDataByteOrderMSB = False",
+            "CompressedData = False"]
+
+        # The MetaImage transformation matrix is the direction matrix
+        # written column by column.
+        if direction is not None:
+            header.append("TransformMatrix = %s" %
+                " ".join(map(repr, np.asarray(direction).T.ravel())))
+
+        header += [
+            "Offset = %s" % " ".join(map(repr, self.origin)),
+            "ElementSpacing = %s" % " ".join(map(repr, self.spacing)),
+            "DimSize = %d %d %d" % (columns, rows, sections)]
+
+        if components > 1:
+            header.append("ElementNumberOfChannels = %d" % components)
+
+        header += [
+            "ElementType = %s" % element_type,
+            "ElementDataFile = %s" % os.path.basename(self.filename)]
+
+        open(header_filename, 'w').write("\n".join(header) + "\n")
+
+        return header_filename
+
+    def export(self, filename, spacing=None, origin=None):
+        """
+        Export the store as a three dimensional image. The image format is
+        determined by ITK based on the filename extension.
+
+        :param filename: Output image filename.
+        :type filename: str
+
+        :param spacing: Volume spacing. If not provided, the store's spacing
+            is used.
+        :type spacing: (float, float, float)
+
+        :param origin: Volume origin. If not provided, the store's origin is
+            used.
+        :type origin: (float, float, float)
+
+        :return: The output filename.
+        :rtype: str
+        """
+
+        self._logger.info("Exporting slice store %s to %s.",
+                          self.filename, filename)
+
+        volume = itk.GetImageFromArray(np.ascontiguousarray(self.array))
+        volume.SetSpacing(map(float, spacing or self.spacing))
+        volume.SetOrigin(map(float, origin or self.origin))
+        possum.pos_itk_transforms.write_itk_image(volume, filename)
+
+        return filename
+
+
+if __name__ == '__main__':
+    import doctest
+    print doctest.testmod(verbose=True)
@@ -0,0 +1,454 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+import logging
+
+import numpy as np
+import itk
+from PIL import Image
+
+import possum.pos_itk_core
+import possum.pos_itk_transforms
+import possum.pos_median_filter
+
+"""
+Single pass ingestion of the source (raw) section images. Each source image
+is decoded only once and all the processing steps (inverting, rotating,
+flipping and extending the canvas, calculating the mask as well as writing
+the full sized and the downsampled images) are carried out in memory. This
+replaces the ImageMagick and Convert2D based conversion, which writes and
+reads back several temporary images for every section.
+"""
+
+# Named colors accepted as the canvas background (in addition to the
+# hexadecimal, `#rrggbb` notation).
+C_NAMED_COLORS = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'gray': (190, 190, 190),
+    'grey': (190, 190, 190),
+    'red': (255, 0, 0),
+    'green': (0, 128, 0),
+    'blue': (0, 0, 255)}
+
+# Mapping between the color channel names and the channel indexes.
+C_COLOR_CHANNELS = {
+    'r': 0, 'red': 0,
+    'g': 1, 'green': 1,
+    'b': 2, 'blue': 2}
+
+
+def parse_color(color):
+    """
+    Converts the color name or its hexadecimal representation into an RGB
+    triplet.
+
+    :param color: Color name (e.g. `white`) or hexadecimal code (`#rrggbb`).
+    :type color: str
+
+    :return: The RGB triplet.
+    :rtype: (int, int, int)
+
+    >>> parse_color('White'), parse_color('#0a0B0c')
+    ((255, 255, 255), (10, 11, 12))
+    >>> parse_color('magenta')
+    Traceback (most recent call last):
+    ValueError: Unsupported color: magenta.
+    """
+
+    color = color.strip().lower()
+    if color in C_NAMED_COLORS:
+        return C_NAMED_COLORS[color]
+
+    if color.startswith('#') and len(color) == 7:
+        try:
+            return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+        except ValueError:
+            pass
+
+    raise ValueError("Unsupported color: %s." % color)
+
+
+def load_rgb_array(filename, background=(255, 255, 255)):
+    """
+    Reads the source image as an 8-bit RGB array. Grayscale images are
+    converted to RGB and transparent images are composed onto the
+    `background`. The images are decoded with PIL (which handles all the
+    common formats, including gif) and with ITK when PIL cannot read them.
+
+    :param filename: Source image filename.
+    :type filename: str
+
+    :param background: Background color used for transparent pixels.
+    :type background: (int, int, int)
+
+    :return: The image as a (rows, columns, 3) array.
+    :rtype: `numpy.ndarray`
+    """
+
+    # The source images are the raw, high resolution scans which are often
+    # larger than what PIL considers a safe image size.
+    Image.MAX_IMAGE_PIXELS = None
+
+    try:
+        image = Image.open(filename)
+    except IOError:
+        image = None
+
+    if image is None:
+        array = itk.GetArrayFromImage(itk.imread(filename))
+    elif image.mode in ('RGBA', 'LA', 'PA') or \
+            'transparency' in image.info:
+        array = np.asarray(image.convert('RGBA'))
+    else:
+        array = np.asarray(image.convert('RGB'))
+
+    if array.ndim == 2:
+        array = np.repeat(array[..., np.newaxis], 3, axis=2)
+    elif array.shape[2] == 4:
+        alpha = array[..., 3:].astype(np.float32) / 255.
+        array = array[..., :3] * alpha + \
+            np.array(background, dtype=np.float32) * (1 - alpha)
+        array = np.round(array)
+    elif array.shape[2] != 3:
+        array = np.repeat(array[..., :1], 3, axis=2)
+
+    return np.ascontiguousarray(array.clip(0, 255), dtype=np.uint8)
+
+
+def rotate_array(array, angle):
+    """
+    Rotates the image clockwise around its center, keeping the size of the
+    image (this is what ImageMagick's `-distort ScaleRotateTranslate` does).
+    The area outside of the source image is filled by replicating the edge
+    pixels, as ImageMagick's default (`Edge`) virtual pixel method does.
+
+    :param array: The image as a (rows, columns, channels) array.
+    :type array: `numpy.ndarray`
+
+    :param angle: Rotation angle in degrees.
+    :type angle: float
+
+    :return: The rotated image.
+    :rtype: `numpy.ndarray`
+
+    >>> array = np.zeros((5, 5, 1), dtype=np.uint8)
+    >>> array[2, 4] = 100
+    >>> rotated = rotate_array(array, 90)
+    >>> map(tuple, np.argwhere(rotated[..., 0] == 100))
+    [(4, 2)]
+
+    The corners come from the edges of the source image:
+
+    >>> array = np.zeros((5, 5, 1), dtype=np.uint8)
+    >>> array[0, :] = 200
+    >>> rotated = rotate_array(array, 45)
+    >>> int(rotated[0, 0, 0]), int(rotated[0, 4, 0]), int(rotated[4, 4, 0])
+    (0, 200, 0)
+    """
+
+    rows, columns = array.shape[:2]
+    output = np.empty_like(array)
+
+    # ITK 5.0 does not wrap the extrapolators, so the image is padded with
+    # its edge values instead. The margin covers every point the rotated
+    # image can reach, i.e. the circle around the center going through
+    # the corners.
+    margin = int(np.ceil(np.hypot(rows, columns) / 2. -
+                         min(rows, columns) / 2.)) + 1
+
+    # The rotation center is the center of the image. Note that the angle is
+    # negated as the transformation maps the output image onto the input one.
+    transform = itk.Euler2DTransform[itk.D].New()
+    transform.SetCenter([margin + (columns - 1) / 2.,
+                         margin + (rows - 1) / 2.])
+    transform.SetAngle(-np.radians(angle))
+
+    for channel in range(array.shape[2]):
+        image = itk.GetImageFromArray(np.ascontiguousarray(
+            np.pad(array[..., channel], margin, mode='edge')))
+        resample = itk.ResampleImageFilter[image, image].New(
+            Input=image, Transform=transform,
+            Size=[columns, rows], OutputOrigin=[float(margin)] * 2,
+            OutputSpacing=[1., 1.])
+        resample.Update()
+        output[..., channel] = itk.GetArrayViewFromImage(resample.GetOutput())
+
+    return output
+
+
+def extend_canvas(array, size, gravity='NorthWest',
+                  background=(255, 255, 255)):
+    """
+    Places the image on a canvas of the given size, the same way as
+    ImageMagick's `-gravity` and `-extent` options do. Images larger than the
+    canvas are cropped.
+
+    :param array: The image as a (rows, columns, channels) array.
+    :type array: `numpy.ndarray`
+
+    :param size: Canvas size as (width, height).
+    :type size: (int, int)
+
+    :param gravity: Placement of the image: `NorthWest` or `Center`.
+    :type gravity: str
+
+    :param background: Canvas color, one value per channel.
+    :type background: tuple
+
+    :return: The image on the new canvas.
+    :rtype: `numpy.ndarray`
+
+    >>> array = np.arange(6, dtype=np.uint8).reshape(2, 3, 1)
+    >>> extend_canvas(array, (4, 3), background=(9,))[..., 0]
+    array([[0, 1, 2, 9],
+           [3, 4, 5, 9],
+           [9, 9, 9, 9]], dtype=uint8)
+    >>> extend_canvas(array, (5, 4), 'Center', background=(9,))[..., 0]
+    array([[9, 9, 9, 9, 9],
+           [9, 0, 1, 2, 9],
+           [9, 3, 4, 5, 9],
+           [9, 9, 9, 9, 9]], dtype=uint8)
+    >>> extend_canvas(array, (1, 2), 'Center', background=(9,))[..., 0]
+    array([[1],
+           [4]], dtype=uint8)
+    """
+
+    width, height = map(int, size)
+    canvas = np.empty((height, width, array.shape[2]), dtype=array.dtype)
+    canvas[...] = background
+
+    if gravity.lower() == 'center':
+        offset = [(height - array.shape[0]) // 2,
+                  (width - array.shape[1]) // 2]
+    elif gravity.lower() == 'northwest':
+        offset = [0, 0]
+    else:
+        raise ValueError("Unsupported gravity: %s." % gravity)
+
+    # The offset may be negative when the image is larger than the canvas.
+    # In such case the image is cropped.
+    target = [slice(max(o, 0), min(o + n, m))
+              for o, n, m in zip(offset, array.shape, canvas.shape)]
+    source = [slice(t.start - o, t.stop - o) for t, o in zip(target, offset)]
+    canvas[target[0], target[1]] = array[source[0], source[1]]
+
+    return canvas
+
+
+def tissue_mask(array, channel='red', median_radius=5, threshold=93.):
+    """
+    Calculates the mask of the section: the selected color channel is median
+    filtered and thresholded. Pixels brighter than `threshold` percent of the
+    intensity range are considered the background (0), all the other pixels
+    belong to the section (1).
+
+    :param array: The image as a (rows, columns, 3) array.
+    :type array: `numpy.ndarray`
+
+    :param channel: Color channel used to calculate the mask.
+    :type channel: str
+
+    :param median_radius: Radius of the median filter. Use 0 to disable the
+        filtering.
+    :type median_radius: int
+
+    :param threshold: Threshold as percent of the intensity range.
+    :type threshold: float
+
+    :return: The mask.
+    :rtype: `numpy.ndarray` of `numpy.uint8`
+
+    >>> array = np.full((5, 6, 3), 250, dtype=np.uint8)
+    >>> array[1:4, 1:4, 0] = 20
+    >>> array[0, 5, 0] = 20
+    >>> tissue_mask(array, 'r', median_radius=1)
+    array([[0, 0, 0, 0, 0, 0],
+           [0, 0, 1, 0, 0, 0],
+           [0, 1, 1, 1, 0, 0],
+           [0, 0, 1, 0, 0, 0],
+           [0, 0, 0, 0, 0, 0]], dtype=uint8)
+    >>> tissue_mask(array, 'r', median_radius=0)[:2]
+    array([[0, 0, 0, 0, 0, 1],
+           [0, 1, 1, 1, 0, 0]], dtype=uint8)
+    """
+
+    channel_array = array[..., C_COLOR_CHANNELS[channel.lower()]]
+
+    # The channel is an 8-bit image, so the histogram based median filter
+    # (giving the same results as the ITK's one) can be used.
+    if median_radius:
+        channel_array = possum.pos_median_filter.median_filter_array(
+            np.asarray(channel_array, dtype=np.uint8), int(median_radius))
+
+    return (channel_array <= threshold * 255. / 100.).astype(np.uint8)
+
+
+def ingest_source_image(input_filename, output_fullsize, output_downsampled,
+                        output_mask, spacing, downsampling,
+                        padded_size=None, rotation=None,
+                        horizontal_flip=False, vertical_flip=False,
+                        invert=False, background='white',
+                        gravity='NorthWest', mask_channel='red',
+                        mask_median=5, mask_threshold=93.):
+    """
+    Processes a single source image into the full sized and the downsampled
+    RGB images and the downsampled mask. The source image is decoded once
+    and the processing steps are applied in the following order: inverting,
+    rotation, flips, extending the canvas and then calculating the mask.
+
+    :param input_filename: Source image filename.
+    :type input_filename: str
+
+    :param output_fullsize: Full sized output image filename.
+    :type output_fullsize: str
+
+    :param output_downsampled: Downsampled output image filename.
+    :type output_downsampled: str
+
+    :param output_mask: Downsampled mask filename.
+    :type output_mask: str
+
+    :param spacing: Spacing of the source image.
+    :type spacing: float
+
+    :param downsampling: Size of the downsampled images in percent of the
+        full size.
+    :type downsampling: float
+
+    :param padded_size: Canvas size (width, height). The canvas is not
+        changed if the size is not provided.
+    :type padded_size: (int, int)
+
+    :param rotation: Clockwise rotation in degrees.
+    :type rotation: float
+
+    :param horizontal_flip: Flip the image upside down (ImageMagick's
+        `-flip`).
+    :type horizontal_flip: bool
+
+    :param vertical_flip: Mirror the image left to right (ImageMagick's
+        `-flop`).
+    :type vertical_flip: bool
+
+    :param invert: Invert the intensities of the source image.
+    :type invert: bool
+
+    :param background: Canvas color.
+    :type background: str
+
+    :param gravity: Canvas gravity (`NorthWest` or `Center`).
+    :type gravity: str
+
+    :param mask_channel: Color channel used to calculate the mask.
+    :type mask_channel: str
+
+    :param mask_median: Size of the median filter window applied before
+        thresholding, the same as for ImageMagick's `-median` (5 means a
+        5x5 window).
+    :type mask_median: int
+
+    :param mask_threshold: Mask threshold as percent of the intensity range.
+    :type mask_threshold: float
+
+    >>> array = np.full((20, 30, 3), 255, dtype=np.uint8)
+    >>> array[5:15, 10:20] = (40, 80, 120)
+    >>> itk.imwrite(itk.GetImageFromArray(array, is_vector=True),
+    ...             '/tmp/pos_source_ingestion.png')
+    >>> ingest_source_image('/tmp/pos_source_ingestion.png',
+    ...     '/tmp/pos_source_ingestion_full.nii.gz',
+    ...     '/tmp/pos_source_ingestion_small.nii.gz',
+    ...     '/tmp/pos_source_ingestion_mask.nii.gz',
+    ...     spacing=0.01, downsampling=50, padded_size=(40, 30),
+    ...     vertical_flip=True, mask_median=3)
+
+    >>> read = possum.pos_itk_transforms.read_itk_image
+    >>> full = read('/tmp/pos_source_ingestion_full.nii.gz')
+    >>> map(int, full.GetLargestPossibleRegion().GetSize())
+    [40, 30]
+    >>> map(int, full.GetPixel([29 - 12, 7])), map(int, full.GetPixel([35, 7]))
+    ([40, 80, 120], [255, 255, 255])
+
+    >>> small = read('/tmp/pos_source_ingestion_small.nii.gz')
+    >>> mask = read('/tmp/pos_source_ingestion_mask.nii.gz')
+    >>> map(int, mask.GetLargestPossibleRegion().GetSize())
+    [20, 15]
+    >>> np.allclose(list(mask.GetSpacing()), [0.02, 0.02])
+    True
+    >>> list(mask.GetSpacing()) == list(small.GetSpacing())
+    True
+    >>> list(mask.GetOrigin()) == list(small.GetOrigin())
+    True
+    >>> int(itk.GetArrayViewFromImage(mask).sum())
+    24
+
+    The default median window is 5x5, so a three pixels wide strip of
+    tissue survives the filtering (it would not with an 11x11 window):
+
+    >>> array = np.full((20, 30, 3), 255, dtype=np.uint8)
+    >>> array[:, 10:13] = 40
+    >>> itk.imwrite(itk.GetImageFromArray(array, is_vector=True),
+    ...             '/tmp/pos_source_ingestion.png')
+    >>> ingest_source_image('/tmp/pos_source_ingestion.png',
+    ...     '/tmp/pos_source_ingestion_full.nii.gz',
+    ...     '/tmp/pos_source_ingestion_small.nii.gz',
+    ...     '/tmp/pos_source_ingestion_mask.nii.gz',
+    ...     spacing=0.01, downsampling=100)
+    >>> mask = read('/tmp/pos_source_ingestion_mask.nii.gz')
+    >>> np.flatnonzero(itk.GetArrayViewFromImage(mask)[10])
+    array([10, 11, 12])
+
+    >>> import glob, os
+    >>> for filename in glob.glob('/tmp/pos_source_ingestion*'):
+    ...     os.remove(filename)
+    """
+
+    logger = logging.getLogger('ingest_source_image')
+    logger.info("Ingesting the source image: %s.", input_filename)
+
+    background = parse_color(background)
+    array = load_rgb_array(input_filename, background)
+
+    if invert:
+        np.subtract(255, array, out=array)
+
+    if rotation:
+        logger.debug("Rotating the image by %s degrees.", str(rotation))
+        array = rotate_array(array, rotation)
+
+    if horizontal_flip:
+        array = array[::-1]
+    if vertical_flip:
+        array = array[:, ::-1]
+
+    if padded_size:
+        logger.debug("Extending the canvas to %s.", str(padded_size))
+        array = extend_canvas(array, padded_size, gravity, background)
+    array = np.ascontiguousarray(array)
+
+    # The full sized image. The origin is zero and the spacing is the native
+    # resolution of the source image.
+    full_image = itk.GetImageFromArray(array, is_vector=True)
+    full_image.SetSpacing([float(spacing)] * 2)
+    full_image.SetOrigin([0., 0.])
+    possum.pos_itk_transforms.write_itk_image(full_image, output_fullsize)
+
+    scaling_factor = float(downsampling) / 100.
+    small_image = possum.pos_itk_core.process_multichannel_image(
+        full_image, lambda channel:
+        possum.pos_itk_core.resample_image_filter(channel, scaling_factor))
+    possum.pos_itk_transforms.write_itk_image(small_image, output_downsampled)
+
+    # The mask shares the geometry with the downsampled image. The median
+    # window size is converted to the radius of the filter.
+    mask_image = itk.GetImageFromArray(tissue_mask(
+        array, mask_channel, mask_median // 2, mask_threshold))
+    mask_image.CopyInformation(full_image)
+    mask_image = possum.pos_itk_core.resample_image_filter(
+        mask_image, scaling_factor, interpolation='nn')
+    possum.pos_itk_transforms.write_itk_image(mask_image, output_mask)
+
+
+if __name__ == '__main__':
+    import doctest
+    print doctest.testmod(verbose=True)
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+import os
+import struct
+import logging
+
+import numpy as np
+import itk
+
+import possum.pos_common
+import possum.pos_itk_core
+import possum.pos_itk_transforms
+from possum.pos_slice_store import slice_store
+
+"""
+Random access to the sections of a three dimensional image without
+extracting the sections into separate files. The sections may come either
+from a volume (which is memory mapped whenever its format allows it and read
+lazily otherwise) or from a series of two dimensional images. In the latter
+case the decoded sections are kept in a least recently used cache.
+"""
+
+# NIfTI-1 data type codes and the corresponding numpy data types. The RGB24
+# (128) data type is handled separately as it has three components.
+nifti_data_type_to_numpy_type = {
+    2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+    256: np.int8, 512: np.uint16, 768: np.uint32}
+
+
+def memmap_nifti(filename):
+    """
+    Maps the voxels of an uncompressed NIfTI-1 (.nii) volume into the memory.
+    The resulting array has the same layout as the array obtained from the
+    volume read by ITK: (z, y, x (, component)).
+
+    :param filename: The NIfTI-1 filename.
+    :type filename: str
+
+    :return: The memory mapped array or `None` if the file cannot be mapped
+        (e.g. it is compressed or its intensities are scaled).
+    :rtype: `numpy.memmap`
+    """
+
+    if not filename.endswith('.nii'):
+        return None
+
+    header = open(filename, 'rb').read(348)
+    if len(header) < 348:
+        return None
+
+    # Detect the byte order using the size of the header.
+    for byte_order in ['<', '>']:
+        if struct.unpack(byte_order + 'i', header[0:4])[0] == 348:
+            break
+    else:
+        return None
+
+    dim = struct.unpack(byte_order + '8h', header[40:56])
+    datatype = struct.unpack(byte_order + 'h', header[70:72])[0]
+    vox_offset, scl_slope, scl_inter = \
+        struct.unpack(byte_order + '3f', header[108:120])
+
+    # Only the plain, three dimensional volumes which intensities are not
+    # scaled can be mapped directly.
+    if dim[0] != 3 or scl_slope not in (0, 1) or scl_inter != 0:
+        return None
+
+    shape = (dim[3], dim[2], dim[1])
+    if datatype == 128:
+        dtype, shape = np.dtype(np.uint8), shape + (3,)
+    elif datatype in nifti_data_type_to_numpy_type:
+        dtype = np.dtype(nifti_data_type_to_numpy_type[datatype])
+    else:
+        return None
+
+    return np.memmap(filename, dtype=dtype.newbyteorder(byte_order),
+                     mode='r', offset=int(vox_offset), shape=shape)
+
+
+def memmap_metaimage(filename):
+    """
+    Maps the voxels of an uncompressed, single channel, three dimensional
+    MetaImage (.mhd) volume into the memory.
+
+    :param filename: The MetaImage header filename.
+    :type filename: str
+
+    :return: The memory mapped array or `None` if the file cannot be mapped.
+    :rtype: `numpy.memmap`
+    """
+
+    if not filename.endswith('.mhd'):
+        return None
+
+    header = {}
+    for line in open(filename):
+        if "=" in line:
+            key, value = map(str.strip, line.split("=", 1))
+            header[key] = value
+
+    if header.get('NDims') != '3' or \
+       header.get('CompressedData', 'False') != 'False' or \
+       header.get('BinaryDataByteOrderMSB', 'False') != 'False' or \
+       header.get('ElementNumberOfChannels', '1') != '1' or \
+       header.get('HeaderSize', '0') != '0' or \
+       header.get('ElementDataFile') in (None, 'LOCAL', 'LIST') or \
+       header.get('ElementType') not in \
+            possum.pos_slice_store.meta_element_type_to_numpy_type:
+        return None
+
+    return slice_store.from_header(filename, mode='r').array
+
+
+class virtual_stack(object):
+    """
+    A stack of sections which can be accessed by their index along any of
+    the axes, without extracting the sections into separate files.
+
+    Let's create a test volume:
+
+    >>> array = np.arange(4 * 3 * 5, dtype=np.uint8).reshape(4, 3, 5)
+    >>> volume = itk.GetImageFromArray(array)
+    >>> volume.SetSpacing([0.5, 1.0, 2.0])
+    >>> volume.SetOrigin([1.0, 2.0, 3.0])
+    >>> possum.pos_itk_transforms.write_itk_image(
+    ...     volume, '/tmp/pos_virtual_stack.nii')
+    >>> possum.pos_itk_transforms.write_itk_image(
+    ...     volume, '/tmp/pos_virtual_stack.nii.gz')
+
+    An uncompressed volume is memory mapped. A compressed one is read when
+    the first section is requested:
+
+    >>> stack = virtual_stack.from_volume('/tmp/pos_virtual_stack.nii')
+    >>> stack.memory_mapped, stack.shape, len(stack)
+    (True, (4, 3, 5), 4)
+    >>> stack.get_section(2).tolist() == array[2].tolist()
+    True
+    >>> stack.get_section(1, axis=0).tolist() == array[:, :, 1].tolist()
+    True
+
+    >>> stack = virtual_stack.from_volume('/tmp/pos_virtual_stack.nii.gz',
+    ...                                   start_index=10)
+    >>> stack.memory_mapped
+    False
+    >>> stack.get_section(12).tolist() == array[2].tolist()
+    True
+    >>> stack.get_section(14)
+    Traceback (most recent call last):
+    IndexError: Section 14 is not in the stack (10 - 13).
+
+    The sections are also available as images. Their geometry is the same as
+    the geometry of the sections extracted with the `pos_slice_volume`:
+
+    >>> section = stack.get_section_image(2, axis=1)
+    >>> map(float, section.GetOrigin()), map(float, section.GetSpacing())
+    ([1.0, 3.0], [0.5, 2.0])
+    >>> int(section.GetPixel([4, 3]))
+    59
+
+    The stack can be created from a series of two dimensional images as well.
+    The decoded images are cached:
+
+    >>> for i in range(4):
+    ...     possum.pos_itk_transforms.write_itk_image(
+    ...         itk.GetImageFromArray(array[i].copy()),
+    ...         '/tmp/pos_virtual_stack_%04d.nii.gz' % (i + 1))
+    >>> stack = virtual_stack.from_files(
+    ...     '/tmp/pos_virtual_stack_%04d.nii.gz', range(1, 5), cache_size=2)
+    >>> stack.shape
+    (4, 3, 5)
+    >>> stack.get_section(3).tolist() == array[2].tolist()
+    True
+    >>> stack.get_section(4, axis=0).tolist() == array[:, :, 4].tolist()
+    True
+    >>> len(stack._cache)
+    2
+
+    >>> del stack, section
+    >>> for filename in ['/tmp/pos_virtual_stack.nii',
+    ...                  '/tmp/pos_virtual_stack.nii.gz'] + \\
+    ...         ['/tmp/pos_virtual_stack_%04d.nii.gz' % i for i in range(1, 5)]:
+    ...     os.remove(filename)
+    """
+
+    def __init__(self, shape, spacing, origin, start_index=0,
+                 volume_filename=None, filenames=None, cache_size=32):
+        """
+        Use the :meth:`from_volume` and the :meth:`from_files` methods to
+        create the stack.
+
+        :param shape: Shape of the stack: (sections, rows, columns).
+        :type shape: (int, int, int)
+
+        :param spacing: Spacing of the stack (x, y, z).
+        :type spacing: (float, float, float)
+
+        :param origin: Origin of the stack (x, y, z).
+        :type origin: (float, float, float)
+
+        :param start_index: Index of the first section of the stack.
+        :type start_index: int
+
+        :param volume_filename: The volume holding the sections.
+        :type volume_filename: str
+
+        :param filenames: Two dimensional images, one for each section.
+        :type filenames: list of str
+
+        :param cache_size: Number of the decoded sections kept in the memory.
+        :type cache_size: int
+        """
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.shape = tuple(map(int, shape))
+        self.spacing = map(float, spacing)
+        self.origin = map(float, origin)
+        self.start_index = start_index
+
+        self._volume_filename = volume_filename
+        self._filenames = filenames
+        self._volume = None
+        self._volume_image = None
+        self._cache = possum.pos_common.lru_cache(maxsize=cache_size)
+
+        if volume_filename is not None:
+            self._volume = memmap_nifti(volume_filename)
+            if self._volume is None:
+                self._volume = memmap_metaimage(volume_filename)
+
+        self.memory_mapped = self._volume is not None
+
+    @classmethod
+    def from_volume(cls, filename, start_index=0, cache_size=32):
+        """
+        Create a stack of the sections of the provided volume. The sections
+        are the slices along the last axis of the volume.
+
+        :param filename: The volume filename.
+        :type filename: str
+
+        :param start_index: Index of the first section.
+        :type start_index: int
+
+        :param cache_size: Number of the sections kept in the memory.
+        :type cache_size: int
+
+        :return: The stack.
+        :rtype: :class:`virtual_stack`
+        """
+
+        header = possum.pos_itk_core.read_image_header(filename)
+        assert header['NumberOfDimensions'] == 3, \
+            "A three dimensional volume is required."
+
+        columns, rows, sections = header['Dimensions']
+        return cls((sections, rows, columns),
+                   header['Spacing'], header['Origin'], start_index,
+                   volume_filename=filename, cache_size=cache_size)
+
+    @classmethod
+    def from_files(cls, filename_template, indexes, slice_thickness=1.0,
+                   cache_size=32):
+        """
+        Create a stack from a series of two dimensional images.
+
+        :param filename_template: Filename template of the sections, e.g.
+            `sections/%04d.nii.gz`.
+        :type filename_template: str
+
+        :param indexes: Indexes of the sections. The indexes have to be
+            consecutive.
+        :type indexes: list of ints
+
+        :param slice_thickness: Distance between the sections.
+        :type slice_thickness: float
+
+        :param cache_size: Number of the decoded sections kept in the memory.
+        :type cache_size: int
+
+        :return: The stack.
+        :rtype: :class:`virtual_stack`
+        """
+
+        indexes = list(indexes)
+        filenames = [filename_template % idx for idx in indexes]
+
+        header = possum.pos_itk_core.read_image_header(filenames[0])
+        columns, rows = header['Dimensions']
+
+        return cls((len(indexes), rows, columns),
+                   header['Spacing'] + [slice_thickness],
+                   header['Origin'] + [0.0], indexes[0],
+                   filenames=filenames, cache_size=cache_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.get_section(index)
+
+    def _position(self, index):
+        position = index - self.start_index
+        if not 0 <= position < self.shape[0]:
+            raise IndexError("Section %d is not in the stack (%d - %d)." %
+                (index, self.start_index, self.start_index + self.shape[0] - 1))
+        return position
+
+    def _read_volume(self):
+        """
+        Read the whole volume. This happens only when the volume cannot be
+        memory mapped and only once, when the first section is requested.
+        """
+        if self._volume is None:
+            self._logger.info("Reading volume: %s.", self._volume_filename)
+            self._volume_image = possum.pos_itk_transforms.read_itk_image(
+                self._volume_filename)
+            self._volume = itk.GetArrayViewFromImage(self._volume_image)
+        return self._volume
+
+    def _read_file_section(self, position):
+        """
+        Decode the image holding the given section or take it from the cache.
+        """
+        section = self._cache.get(position)
+        if section is None:
+            filename = self._filenames[position]
+            self._logger.debug("Reading section: %s.", filename)
+            section = itk.GetArrayFromImage(
+                possum.pos_itk_transforms.read_itk_image(filename))
+            self._cache.put(position, section)
+        return section
+
+    def get_section(self, index, axis=2):
+        """
+        Get the section as an array.
+
+        :param index: Index of the section. Along the stacking axis (2), the
+            index is the section index (see the `start_index`). Along the
+            remaining axes, it is simply the index of the column (axis 0) or
+            the row (axis 1) of the stack.
+        :type index: int
+
+        :param axis: The axis along which the section is taken (the itk
+            convention: 0 - x, 1 - y, 2 - z).
+        :type axis: int
+
+        :return: The section. For the sections taken from a volume, the
+            returned array is a view of the volume.
+        :rtype: `numpy.ndarray`
+        """
+
+        assert axis in [0, 1, 2], "The axis has to be either 0, 1 or 2."
+
+        if axis == 2:
+            position = self._position(index)
+            if self._filenames is not None:
+                return self._read_file_section(position)
+            return self._read_volume()[position]
+
+        # Note that the numpy arrays have the axes in the reversed order.
+        region = [slice(None)] * 2
+        region[1 - axis] = index
+
+        if self._filenames is not None:
+            key = (index, axis)
+            section = self._cache.get(key)
+            if section is None:
+                section = np.stack(
+                    [self._read_file_section(position)[tuple(region)]
+                     for position in range(self.shape[0])])
+                self._cache.put(key, section)
+            return section
+
+        return self._read_volume()[(slice(None),) + tuple(region)]
+
+    def get_section_image(self, index, axis=2):
+        """
+        Get the section as an image. The origin and the spacing of the image
+        are the same as the origin and the spacing of the sections extracted
+        from the volume with the `pos_slice_volume` script.
+
+        :param index: Index of the section, see :meth:`get_section`.
+        :type index: int
+
+        :param axis: The axis along which the section is taken.
+        :type axis: int
+
+        :return: The section.
+        :rtype: `itk.Image`
+        """
+
+        section = np.ascontiguousarray(self.get_section(index, axis))
+        section = section.astype(section.dtype.newbyteorder('='))
+
+        image = itk.GetImageFromArray(section, is_vector=section.ndim > 2)
+        in_plane = [i for i in range(3) if i != axis]
+        image.SetSpacing([self.spacing[i] for i in in_plane])
+        image.SetOrigin([self.origin[i] for i in in_plane])
+        return image
+
+
+if __name__ == '__main__':
+    import doctest
+    print doctest.testmod(verbose=True)
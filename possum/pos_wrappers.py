@@ -1,4 +1,5 @@
 import copy
+import json
 import subprocess as sub
 
 from pos_parameters import string_parameter, value_parameter, filename_parameter, \
@@ -1232,6 +1233,142 @@ class alignment_preprocessor_wrapper(generic_wrapper):
         'invert_multichannel': switch_parameter('invert-rgb-image', False, str_template="--{_name}")}
 
 
+class alignment_preprocessor_batch_wrapper(generic_wrapper):
+    """
+    A wrapper for the `pos_preprocess_image` script processing a whole batch
+    of images within a single process. The images, as well as their
+    settings, are listed in a manifest file. The manifest can be created
+    out of a number of :class:`alignment_preprocessor_wrapper` commands.
+
+    >>> print alignment_preprocessor_batch_wrapper(manifest='batch.json')
+    pos_preprocess_image --batch batch.json
+
+    >>> print alignment_preprocessor_batch_wrapper(manifest='batch.json',
+    ... workers=2)
+    pos_preprocess_image --batch batch.json --batch-workers 2
+
+    >>> command = alignment_preprocessor_wrapper(input_image="i.nii.gz",
+    ... grayscale_output_image="g.nii.gz",
+    ... registration_resize=0.5, median_filter_radius=[2, 2],
+    ... invert_grayscale=True)
+    >>> sorted(alignment_preprocessor_batch_wrapper.manifest_entry(
+    ...     command).items()) #doctest: +NORMALIZE_WHITESPACE
+    [('input_image', 'i.nii.gz'), ('invert_rgb_image', False),
+     ('invert_source_image', True), ('median_filter_radius', [2, 2]),
+     ('output_grayscale_image', 'g.nii.gz'), ('resize_factor', 0.5)]
+
+    >>> alignment_preprocessor_batch_wrapper.write_manifest(
+    ...     '/tmp/pos_wrappers_batch.json', [command, command])
+    >>> len(json.load(open('/tmp/pos_wrappers_batch.json')))
+    2
+
+    >>> import os
+    >>> os.remove('/tmp/pos_wrappers_batch.json')
+    """
+
+    _template = """pos_preprocess_image --batch {manifest} {workers}"""
+
+    _parameters = {
+        'manifest': filename_parameter('manifest', None),
+        'workers': value_parameter('batch-workers', None, str_template="--{_name} {_value}")}
+
+    # Mapping between the parameters of the single image wrapper and the
+    # names of the script's command line options (as used in the manifest).
+    _manifest_options = {
+        'input_image': 'input_image',
+        'grayscale_output_image': 'output_grayscale_image',
+        'color_output_image': 'output_rgb_image',
+        'registration_roi': 'extract_roi',
+        'registration_resize': 'resize_factor',
+        'registration_color': 'color_channel',
+        'median_filter_radius': 'median_filter_radius'}
+
+    _manifest_switches = {
+        'invert_grayscale': 'invert_source_image',
+        'invert_multichannel': 'invert_rgb_image'}
+
+    @classmethod
+    def manifest_entry(cls, command):
+        """
+        Describe the image processed by the provided
+        :class:`alignment_preprocessor_wrapper` command as a manifest entry.
+
+        :param command: Single image processing command.
+        :type command: :class:`alignment_preprocessor_wrapper`
+
+        :rtype: dict
+        """
+
+        entry = {}
+        for name, option in cls._manifest_options.items():
+            if command.p[name].value is not None:
+                entry[option] = command.p[name].value
+
+        # The switches are set in the same way as in the command line.
+        for name, option in cls._manifest_switches.items():
+            entry[option] = bool(str(command.p[name]))
+
+        return entry
+
+    @classmethod
+    def write_manifest(cls, filename, commands):
+        """
+        Write the batch manifest describing the images processed by the
+        provided commands.
+
+        :param filename: Manifest filename.
+        :type filename: str
+
+        :param commands: Single image processing commands.
+        :type commands: list of :class:`alignment_preprocessor_wrapper`
+        """
+
+        entries = map(cls.manifest_entry, commands)
+        json.dump(entries, open(filename, 'w'), indent=1)
+
+    @classmethod
+    def from_commands(cls, commands, manifests):
+        """
+        Distribute the single image processing commands evenly over a number
+        of batches, one batch per manifest file. The manifests are written
+        immediately.
+
+        :param commands: Single image processing commands.
+        :type commands: list of :class:`alignment_preprocessor_wrapper`
+
+        :param manifests: Manifest filenames, one per batch.
+        :type manifests: list of str
+
+        :return: Batch processing commands.
+        :rtype: list of :class:`alignment_preprocessor_batch_wrapper`
+
+        >>> commands = [alignment_preprocessor_wrapper(input_image=str(i))
+        ...             for i in range(5)]
+        >>> batches = alignment_preprocessor_batch_wrapper.from_commands(
+        ...     commands, ['/tmp/pos_wrappers_%d.json' % i for i in range(3)])
+        >>> print "\\n".join(map(str, batches))
+        pos_preprocess_image --batch /tmp/pos_wrappers_0.json
+        pos_preprocess_image --batch /tmp/pos_wrappers_1.json
+        pos_preprocess_image --batch /tmp/pos_wrappers_2.json
+        >>> [entry['input_image'] for entry
+        ...  in json.load(open('/tmp/pos_wrappers_0.json'))]
+        [u'0', u'3']
+
+        >>> import os
+        >>> for i in range(3): os.remove('/tmp/pos_wrappers_%d.json' % i)
+        """
+
+        batches = []
+        for index, manifest in enumerate(manifests):
+            batch_commands = commands[index::len(manifests)]
+            if not batch_commands:
+                continue
+            cls.write_manifest(manifest, batch_commands)
+            batches.append(cls(manifest=manifest))
+
+        return batches
+
+
 class command_warp_rgb_slice(generic_wrapper):
     """
     A flexible RGB image __affine__ reslice wrapper. The wrapper is designed to
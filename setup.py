@@ -36,9 +36,20 @@ class run_tests(TestCommand):
         print doctest.testmod(possum.pos_common, verbose=verbose_flag)
         print doctest.testmod(possum.pos_color, verbose=verbose_flag)
         print doctest.testmod(possum.pos_segmentation_parser, verbose=verbose_flag)
+        print doctest.testmod(possum.pos_manifest_store, verbose=verbose_flag)
         if os.environ.get('TRAVIS') != 'true' and \
         os.environ.get('CI') != 'true':
                 print doctest.testmod(possum.pos_itk_core, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_itk_transforms, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_slice_store, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_landmarks, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_reslice, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_virtual_stack, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_histogram_matching, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_source_ingestion, verbose=verbose_flag)
+                print doctest.testmod(possum.pos_median_filter, verbose=verbose_flag)
+                from possum import dev_possum_map_reverse_and_forward
+                print doctest.testmod(dev_possum_map_reverse_and_forward, verbose=verbose_flag)
 
 setup(
     name='possum-reconstruction',